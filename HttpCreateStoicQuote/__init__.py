@@ -1,37 +1,59 @@
 import logging
 import json
+import time
 import openai
 import datetime as dt
 import azure.functions as func
 from azure.identity import DefaultAzureCredential
 from azure.keyvault.secrets import SecretClient
-from blob_manager_append import get_old_terms, add_term
+from blob_manager_append import get_old_terms, add_term, blob_service_client, CONTAINER_NAME
 from twitter_manager import publish_tweet
+from shared_code import run_coordinator
+from shared_code.audit_log import make_audit_log
+from shared_code.deadline import DeadlineExceeded, start_deadline
+from shared_code.profiler import profiled
+from shared_code.openai_client import ModelRouter
+from shared_code.draft_queue import DraftPipeline, BatchApiExecutor, LocalBatchExecutor
+from shared_code.tweet_text import checked_tweet, validate_tweet
 
 # Constants
 KEYVAULT_NAME = 'keyvaultforbot'  # replace with your own keyvault
+DRAFTS_NAME = 'stoic_drafts.json'
+DRAFT_MODE = 'batch'  # 'batch' for the OpenAI Batch API, 'local' for a local batched executor
+DRAFT_BATCH_SIZE = 14  # one week of tweets at two per day
 
 # Globals
 keyvault_client = SecretClient(f"https://{KEYVAULT_NAME}.vault.azure.net/", DefaultAzureCredential())
 openai_api_key = keyvault_client.get_secret('openai-api-key').value
 openai.api_key = openai_api_key
+router = ModelRouter(openai)
+audit_log = make_audit_log(blob_service_client, CONTAINER_NAME, 'stoic')
+
+def chat_request(instructions, task, sample, model_engine='gpt-3.5-turbo', max_tokens=300):
+    """Define the body of an OpenAI chat completion request."""
 
-def openai_request(instructions, task, sample, model_engine='gpt-3.5-turbo'):
-    """Create an OpenAI request."""
-    
     prompt = [
         {"role": "system", "content": instructions},
         {"role": "user", "content": task}
     ]
     prompt = sample + prompt
-    completion = openai.chat.completions.create(
-        model=model_engine,
-        messages=prompt,
-        temperature=1.0,
-        max_tokens=300
-    )
-    logging.info(completion.choices[0].message.content)
-    return completion.choices[0].message.content
+    return {'model': model_engine, 'messages': prompt, 'temperature': 1.0, 'max_tokens': max_tokens}
+
+def openai_request(instructions, task, sample, route, usage=None, validate=None):
+    """Create an OpenAI request on the models of the task's routing policy; the token cost is added to usage."""
+    
+    answer = router.complete(route, usage=usage, validate=validate, **chat_request(instructions, task, sample))
+    logging.info(answer)
+    return answer
+
+def clean_quote(quote, old_terms):
+    """Validate a new quote; a rejected quote is escalated to the next model."""
+    quote = quote.strip()
+    if validate_tweet(quote):
+        raise ValueError(f'not a quote: {quote[:100]}')
+    if quote in old_terms:
+        raise ValueError('quote was already posted')
+    return quote
 
 def create_tweet_prompt(quote):
     """Define OpenAI Prompt for News Tweet."""
@@ -57,36 +79,83 @@ def create_term_prompt(old_terms):
     sample = []
     return instructions, task, sample
 
+def create_terms_prompt(old_terms, n):
+    """Define OpenAI Prompt for a batch of quotes."""
+
+    instructions = f'Your job is to continue a given list of stoic quotes and return {n} other stoic quotes in the same format as a Python list of strings.'
+    task = f'{old_terms}'
+
+    sample = []
+    return instructions, task, sample
+
+def term_batch_request(old_terms, n):
+    """Request for n new quotes, used to pre-generate drafts."""
+    instructions, task, sample = create_terms_prompt(old_terms[0:25], n)
+    return chat_request(instructions, task, sample, max_tokens=100 * n)
+
+def tweet_batch_request(term):
+    """Request for the tweet about a quote, used to pre-generate drafts."""
+    instructions, task, sample = create_tweet_prompt(term)
+    return chat_request(instructions, task, sample)
+
+drafts = DraftPipeline(
+    run_coordinator.document(blob_service_client, CONTAINER_NAME, DRAFTS_NAME),
+    BatchApiExecutor(openai) if DRAFT_MODE == 'batch' else LocalBatchExecutor(openai),
+    term_batch_request, tweet_batch_request, batch_size=DRAFT_BATCH_SIZE)
+
 def create_tweet():
     """Create and post a tweet."""
+    started = time.perf_counter()
+    usage = {}
     # Get old terms from blob
-    old_terms = get_old_terms()['term'].to_list()
+    old_terms = [term for term in get_old_terms() if term]
     logging.info(f'Old terms: {old_terms}')
 
+    # Publish a pre-generated draft if one is ready
+    draft = drafts.next_draft(old_terms)
+    if draft is not None:
+        status = publish_tweet(draft['tweet'])
+        if status != 'error tweet too long':
+            audit_log.record(status.data['id'], draft['tweet'], latency_ms=round((time.perf_counter() - started) * 1000, 1),
+                             term=draft['term'], draft=True)
+            logging.info(f"Draft tweet published: {draft['tweet']}")
+            add_term(draft['term'])
+            logging.info(f"Term added: {draft['term']}")
+            return
+
+    # Otherwise generate the tweet synchronously
+
     # Define prompt
     instructions, task, sample = create_term_prompt(old_terms[0:25])
-    term = openai_request(instructions, task, sample)
+    try:
+        term = openai_request(instructions, task, sample, 'stoic_term', usage,
+                              validate=lambda answer: clean_quote(answer, old_terms))
+    except (ValueError, DeadlineExceeded) as ex:
+        logging.error(f'No usable quote: {ex}')
+        return
     logging.info(f'Term created: {term}')
 
     instructions, task, sample = create_tweet_prompt(term)
-    # Try three times to create a tweet with a length below 280 characters
-    for _ in range(3):
-        # Tweet creation
-        tweet_text = openai_request(instructions, task, sample)
-        
-        # If tweet length > 280 characters, create a new tweet
-        status = publish_tweet(tweet_text)
-        if status != 'error tweet too long':
-            logging.info(f'Tweet created: {tweet_text}')
+    # The router escalates tweets above 280 characters to a stronger model
+    try:
+        tweet_text = openai_request(instructions, task, sample, 'stoic_tweet', usage, validate=checked_tweet)
+    except (ValueError, DeadlineExceeded) as ex:
+        logging.error(f'No usable tweet: {ex}')
+        return
 
-            # Add term to list of old terms and store to blob storage
-            add_term(old_terms, term)
+    status = publish_tweet(tweet_text)
+    if status != 'error tweet too long':
+        audit_log.record(status.data['id'], tweet_text, latency_ms=round((time.perf_counter() - started) * 1000, 1),
+                         tokens=usage.get('tokens'), term=term, draft=False)
+        logging.info(f'Tweet created: {tweet_text}')
+
+        # Add term to list of old terms and store to blob storage
+        add_term(term)
+
+        logging.info(f'Term added: {term}')
 
-            logging.info(f'Term added: {term}')
-            break
-        
-    
 
+@profiled(blob_service_client, CONTAINER_NAME)
 def main(mytimer: func.TimerRequest) -> None:
     """Main function for handling the timer trigger."""
     utc_timestamp = dt.datetime.utcnow().replace(
@@ -94,8 +163,13 @@ def main(mytimer: func.TimerRequest) -> None:
 
     if mytimer.past_due:
         logging.info('The timer is past due!')
+    start_deadline()
 
-    create_tweet()
+    try:
+        create_tweet()
+    finally:
+        audit_log.flush()
+        router.log_report()
 
     logging.info('Python timer trigger function ran at %s', utc_timestamp)
 
@@ -2,6 +2,7 @@ import logging
 import tweepy
 from azure.identity import DefaultAzureCredential
 from azure.keyvault.secrets import SecretClient
+from shared_code.tweet_text import validate_tweet, weighted_length
 
 # Constants
 KEYVAULT_NAME = 'keyvaultforbot'  # replace with your own keyvault
@@ -19,11 +20,12 @@ twitter_api = tweepy.Client(
 def check_tweet_length(tweet):
     """Check if tweet length is within Twitter's limit."""
     
-    if len(tweet) > 280:
-        logging.error(f'Tweet too long: {len(tweet)}')
+    reason = validate_tweet(tweet)
+    if reason:
+        logging.error(f'Tweet rejected: {reason}')
         return False
     else:
-        logging.info(f'Tweet length OK: {len(tweet)}')
+        logging.info(f'Tweet length OK: {weighted_length(tweet)}')
         return True
 
 def publish_tweet(tweet_text):
@@ -33,5 +35,4 @@ def publish_tweet(tweet_text):
         logging.info(f'Tweet posted: {status}')
         return status
     else:
-        logging.error(f'Tweet too long: {len(tweet_text)}')
         return 'error tweet too long'
\ No newline at end of file
@@ -1,22 +1,36 @@
+import asyncio
 import logging
 import io
 import azure.functions as func
 from azure.identity import DefaultAzureCredential
 from azure.keyvault.secrets import SecretClient
 from azure.storage.blob import BlobServiceClient
-from openai import OpenAI
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
+from openai import AsyncOpenAI, OpenAI
 import pandas as pd
-import tweepy
+from tweepy.asynchronous import AsyncClient
 import json
+import time
+from shared_code import run_coordinator
+from shared_code.audit_log import AsyncBlobAuditBackend, make_audit_log
+from shared_code.deadline import DEADLINE_HEADER, DeadlineExceeded, start_deadline
+from shared_code.profiler import profiled
+from shared_code.openai_client import ModelRouter
+from shared_code.draft_queue import DraftPipeline, BatchApiExecutor, LocalBatchExecutor
+from shared_code.tweet_text import checked_tweet, validate_tweet, weighted_length
 
 # Constants
 KEYVAULT_NAME = 'keyvaultforbot' # replace with your own keyvault
 CONTAINER_NAME = 'botdata'
 CSV_NAME = 'facts_log_test.csv'
+DRAFTS_NAME = 'facts_drafts.json'
+DRAFT_MODE = 'batch'  # 'batch' for the OpenAI Batch API, 'local' for a local batched executor
+DRAFT_BATCH_SIZE = 10
 
 # Globals
 keyvault_client = None
 blob_service_client = None
+async_blob_service_client = None
 openai_api_key = None
 twitter_api = None
 
@@ -31,9 +45,10 @@ keyvault_client = SecretClient(f"https://{KEYVAULT_NAME}.vault.azure.net/", Defa
 blobstorage_account_name = keyvault_client.get_secret('blobstorage-account-name').value
 blobstorage_secret = keyvault_client.get_secret('blobstorage-secret').value
 blob_service_client = BlobServiceClient(account_url=f"https://{blobstorage_account_name}.blob.core.windows.net", credential=blobstorage_secret)
+async_blob_service_client = AsyncBlobServiceClient(account_url=f"https://{blobstorage_account_name}.blob.core.windows.net", credential=blobstorage_secret)
 
 # Twitter Auth
-twitter_api = tweepy.Client(
+twitter_api = AsyncClient(
     bearer_token=keyvault_client.get_secret('twitterbearertoken').value,
     access_token=keyvault_client.get_secret('twitter-access-token').value,
     access_token_secret=keyvault_client.get_secret('twitter-access-secret').value,
@@ -41,48 +56,66 @@ twitter_api = tweepy.Client(
     consumer_secret=keyvault_client.get_secret('twitter-api-secret').value
 )
 
-# OpenAI API Key
-openaiclient = OpenAI(api_key=keyvault_client.get_secret('openai-api-key').value)
+# OpenAI API Key; the synchronous client submits the draft batches, the async one answers requests
+openai_api_key = keyvault_client.get_secret('openai-api-key').value
+openaiclient = OpenAI(api_key=openai_api_key)
+router = ModelRouter(AsyncOpenAI(api_key=openai_api_key))
 
+# Audit log of published tweets
+audit_log = make_audit_log(async_blob_service_client, CONTAINER_NAME, 'fact', backend=AsyncBlobAuditBackend)
 
-def ensure_container_exists():
+
+async def ensure_container_exists():
     """Ensure the blob container exists; if not, create it."""
 
-    if not blob_service_client.get_container_client(CONTAINER_NAME).exists():
-        blob_service_client.create_container(CONTAINER_NAME)
+    if not await async_blob_service_client.get_container_client(CONTAINER_NAME).exists():
+        await async_blob_service_client.create_container(CONTAINER_NAME)
         logging.info(f'Container {CONTAINER_NAME} created')
 
 
-def get_old_terms():
+async def get_old_terms():
     """Retrieve old terms from blob storage."""
 
-    blob_client = blob_service_client.get_blob_client(container=CONTAINER_NAME, blob=CSV_NAME)
-    if not blob_client.exists():
+    blob_client = async_blob_service_client.get_blob_client(container=CONTAINER_NAME, blob=CSV_NAME)
+    if not await blob_client.exists():
         empty_df = pd.DataFrame(columns=['term'])
-        blob_client.upload_blob(data=empty_df.to_csv(index=False), overwrite=True)
+        await blob_client.upload_blob(data=empty_df.to_csv(index=False), overwrite=True)
 
-    data = blob_client.download_blob().content_as_text()
+    downloader = await blob_client.download_blob()
+    data = await downloader.content_as_text()
     df = pd.read_csv(io.StringIO(data))
     logging.info('Posts log retrieved from blob storage')
     return df
 
 
-def openai_request(instructions, task, sample, model_engine='gpt-4-1106-preview'):
-    """Create an OpenAI request."""
+def chat_request(instructions, task, sample, model_engine='gpt-4-1106-preview', max_tokens=300):
+    """Define the body of an OpenAI chat completion request."""
 
     prompt = [
         {"role": "system", "content": instructions},
         {"role": "user", "content": task}
     ]
     prompt = sample + prompt
-    completion = openaiclient.chat.completions.create(
-        model=model_engine,
-        messages=prompt,
-        temperature=1.0,
-        max_tokens=300
-    )
-    logging.info(completion.choices[0].message.content)
-    return completion.choices[0].message.content
+    return {'model': model_engine, 'messages': prompt, 'temperature': 1.0, 'max_tokens': max_tokens}
+
+
+async def openai_request(instructions, task, sample, route, usage=None, validate=None):
+    """Create an OpenAI request on the models of the task's routing policy; the token cost is added to usage."""
+
+    answer = await router.acomplete(route, usage=usage, validate=validate, **chat_request(instructions, task, sample))
+    logging.info(answer)
+    return answer
+
+
+def clean_term(term, old_terms):
+    """Validate a new term; a rejected term is escalated to the next model."""
+
+    term = term.strip().strip('\'"').strip()
+    if not term or len(term) > 100:
+        raise ValueError(f'not a term: {term[:100]}')
+    if term.lower() in {str(old).strip('\'"').lower() for old in old_terms}:
+        raise ValueError(f'{term} is not new')
+    return term
 
 
 def create_tweet_prompt(term):
@@ -118,72 +151,127 @@ def create_term_prompt(old_terms):
     ]
     return instructions, task, sample
 
+def create_terms_prompt(old_terms, n):
+    """Define OpenAI Prompt for a batch of terms."""
+
+    instructions = f'Your job is to continue a given list and return {n} related terms that are not in the list as a Python list of strings.'
+    task = f'{old_terms}'
+
+    sample = [
+        {"role": "user", "content": f"machine learning, gradient descent, neural network, hyperparameter tuning"},
+        {"role": "assistant", "content": "['deep learning', 'prompt engineering', 'supervised learning']"}
+    ]
+    return instructions, task, sample
+
+
+def term_batch_request(old_terms, n):
+    """Request for n new terms, used to pre-generate drafts."""
+
+    instructions, task, sample = create_terms_prompt(old_terms[0:25], n)
+    return chat_request(instructions, task, sample, max_tokens=20 * n)
+
+
+def tweet_batch_request(term):
+    """Request for the tweet about a term, used to pre-generate drafts."""
+
+    instructions, task, sample = create_tweet_prompt(term)
+    return chat_request(instructions, task, sample)
+
+
+drafts = DraftPipeline(
+    run_coordinator.document(blob_service_client, CONTAINER_NAME, DRAFTS_NAME),
+    BatchApiExecutor(openaiclient) if DRAFT_MODE == 'batch' else LocalBatchExecutor(openaiclient),
+    term_batch_request, tweet_batch_request, batch_size=DRAFT_BATCH_SIZE)
+
+
 def check_tweet_length(tweet):
     """Check if tweet length is within Twitter's limit."""
     
-    if len(tweet) > 280:
-        logging.error(f'Tweet too long: {len(tweet)}')
+    reason = validate_tweet(tweet)
+    if reason:
+        logging.error(f'Tweet rejected: {reason}')
         return False
     else:
-        logging.info(f'Tweet length OK: {len(tweet)}')
+        logging.info(f'Tweet length OK: {weighted_length(tweet)}')
         return True
 
 
-def add_term(old_terms, term):
+async def add_term(old_terms, term):
     """Add a new term to old terms and store in blob storage."""
 
     old_terms.append(term)
     df = pd.DataFrame(old_terms, columns=['term'])
-    blob_client = blob_service_client.get_blob_client(container=CONTAINER_NAME, blob=CSV_NAME)
-    blob_client.upload_blob(data=df.to_csv(index=False), overwrite=True)
+    blob_client = async_blob_service_client.get_blob_client(container=CONTAINER_NAME, blob=CSV_NAME)
+    await blob_client.upload_blob(data=df.to_csv(index=False), overwrite=True)
 
 
-def create_tweet():
+async def create_tweet():
     """Create and post a tweet."""
 
+    started = time.perf_counter()
+    usage = {}
+
     # Get old terms from blob
-    old_terms = get_old_terms()['term'].to_list()
+    old_terms = (await get_old_terms())['term'].to_list()
     logging.info(f'Old terms: {old_terms}')
 
-    # Define prompt
+    # Publish a pre-generated draft if one is ready; the draft queue is synchronous, so it runs in a thread
+    draft = await asyncio.to_thread(drafts.next_draft, old_terms)
+    if draft is not None and check_tweet_length(draft['tweet']):
+        status = await twitter_api.create_tweet(text=draft['tweet'])
+        audit_log.record(status.data['id'], draft['tweet'], latency_ms=round((time.perf_counter() - started) * 1000, 1),
+                         term=draft['term'], draft=True)
+        await add_term(old_terms, draft['term'])
+        logging.info(f'Draft tweet posted: {status}')
+        logging.info(f"Term added: {draft['term']}")
+        return status, draft['term'], draft['tweet']
+
+    # Otherwise generate the tweet synchronously
     instructions, task, sample = create_term_prompt(old_terms[0:25])
-    term = openai_request(instructions, task, sample)
+    try:
+        term = await openai_request(instructions, task, sample, 'fact_term', usage,
+                              validate=lambda answer: clean_term(answer, old_terms))
+    except (ValueError, DeadlineExceeded) as ex:
+        logging.error(f'No usable term: {ex}')
+        return 'error no new term', None, None
     logging.info(f'Term created: {term}')
 
     instructions, task, sample = create_tweet_prompt(term)
-    # Try three times to create a tweet with a length below 280 characters
-    for _ in range(1):
-        # Tweet creation
-        
-        tweet_text = openai_request(instructions, task, sample)
-        
-        # If tweet length > 280 characters, create a new tweet
-        if check_tweet_length(tweet_text):
-            logging.info(f'Tweet created: {tweet_text}')
-
-            # Create tweet
-            status = twitter_api.create_tweet(text=tweet_text)
-
-            # Add term to list of old terms and store to blob storage
-            add_term(old_terms, term)
-
-            logging.info(f'Tweet posted: {status}')
-            logging.info(f'Term added: {term}')
-            break
-        else: 
-            status = 'error tweet too long'
-        
+    # The router escalates tweets above 280 characters to a stronger model
+    try:
+        tweet_text = await openai_request(instructions, task, sample, 'fact_tweet', usage, validate=checked_tweet)
+    except ValueError:
+        return 'error tweet too long', term, None
+    except DeadlineExceeded:
+        return 'error no time left', term, None
+    logging.info(f'Tweet created: {tweet_text}')
+
+    # Create tweet
+    status = await twitter_api.create_tweet(text=tweet_text)
+    audit_log.record(status.data['id'], tweet_text, latency_ms=round((time.perf_counter() - started) * 1000, 1),
+                     tokens=usage.get('tokens'), term=term, draft=False)
+
+    # Add term to list of old terms and store to blob storage
+    await add_term(old_terms, term)
+
+    logging.info(f'Tweet posted: {status}')
+    logging.info(f'Term added: {term}')
     return status, term, tweet_text
             
 
 
-def main(req: func.HttpRequest) -> func.HttpResponse:
+@profiled(async_blob_service_client, CONTAINER_NAME)
+async def main(req: func.HttpRequest) -> func.HttpResponse:
     """Main function for handling the HTTP trigger."""
 
     logging.info('Python HTTP trigger function processed a request.')
+    start_deadline(req.headers.get(DEADLINE_HEADER))
 
-
-    status, term, tweet = create_tweet()
+    try:
+        status, term, tweet = await create_tweet()
+    finally:
+        await audit_log.aflush()
+        router.log_report()
 
     body = {
         'message': "This HTTP triggered function executed successfully.",
@@ -201,5 +289,5 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
 
 
 if __name__ == "__main__":
-    ensure_container_exists()
-    main()
+    asyncio.run(ensure_container_exists())
+    asyncio.run(main())
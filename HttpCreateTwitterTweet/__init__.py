@@ -1,35 +1,67 @@
 
+import asyncio
 import azure.functions as func
 import logging
-from openai import OpenAI
-import requests
+from openai import AsyncOpenAI
 import logging
 from azure.identity import DefaultAzureCredential
 from azure.keyvault.secrets import SecretClient
-import tweepy
+from azure.storage.blob.aio import BlobServiceClient
+from tweepy.asynchronous import AsyncClient
+import time
+from shared_code.audit_log import AsyncBlobAuditBackend, make_audit_log
+from shared_code.deadline import DEADLINE_HEADER, DeadlineExceeded, current_deadline, start_deadline
+from shared_code.profiler import profiled
+from shared_code.openai_client import ModelRouter
+from shared_code.tweet_text import checked_tweet
+from shared_code.link_shortener import LinkShortener, TinyUrlProvider, PassthroughProvider, AsyncBlobLinkCache
+
+# Link shortening: 'tinyurl' or 'passthrough' (rely on t.co)
+LINK_PROVIDER = 'tinyurl'
+CONTAINER_NAME = 'botdata'
+LINK_CACHE_NAME = 'link_cache.jsonl'
+TWEET_MIN_SECONDS = 5  # time a tweet post needs to be worth starting
 
 # Set up the Azure Key Vault client and retrieve the Blob Storage account credentials
 keyvault_name = 'keyvaultforbot' # replace with your own keyvault
 client = SecretClient(f"https://{keyvault_name}.vault.azure.net/", DefaultAzureCredential())
 
 #### Twitter Auth
-twitter_api = tweepy.Client(bearer_token=client.get_secret('twitterbearertoken').value,
+twitter_api = AsyncClient(bearer_token=client.get_secret('twitterbearertoken').value,
                     access_token=client.get_secret('twitter-access-token').value,
                     access_token_secret=client.get_secret('twitter-access-secret').value,
                     consumer_key=client.get_secret('twitter-api-key').value,
                     consumer_secret=client.get_secret('twitter-api-secret').value)
 
 logging.info('Twitter API ready')
+twitter_apis = {'': twitter_api}
+twitter_apis_lock = asyncio.Lock()
 
 ##### OpenAI API Key
-openaiclient = OpenAI(api_key=client.get_secret('openai-api-key').value)
-
-def main(req: func.HttpRequest) -> func.HttpResponse:
+openaiclient = AsyncOpenAI(api_key=client.get_secret('openai-api-key').value)
+router = ModelRouter(openaiclient)
+
+##### Link shortener with a persistent cache, so retried articles do not hit the provider again
+blob_service_client = BlobServiceClient(account_url=f"https://{client.get_secret('blobstorage-account-name').value}.blob.core.windows.net",
+                                        credential=client.get_secret('blobstorage-secret').value)
+if LINK_PROVIDER == 'passthrough':
+    link_provider = PassthroughProvider()
+else:
+    link_provider = TinyUrlProvider()
+audit_log = make_audit_log(blob_service_client, CONTAINER_NAME, 'news', backend=AsyncBlobAuditBackend)
+link_shortener = LinkShortener(link_provider, AsyncBlobLinkCache(blob_service_client.get_blob_client(container=CONTAINER_NAME, blob=LINK_CACHE_NAME)))
+
+# Async, so one worker serves many concurrent tweet requests on its event loop while they wait for I/O
+@profiled(blob_service_client, CONTAINER_NAME)
+async def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a request.')
+    # The caller passes its remaining budget so that we finish before it gives up
+    start_deadline(req.headers.get(DEADLINE_HEADER))
 
     title = req.params.get('title')
     description = req.params.get('description')
     url = req.params.get('url')
+    account = req.params.get('account', '')
     if not title:
         try:
             req_body = req.get_json()
@@ -39,8 +71,17 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             title = req_body.get('title')
 
     if title:
-        create_tweet(title, description, url)
-
+        try:
+            status = await create_tweet(title, description, url, account)
+        finally:
+            await audit_log.aflush()
+            router.log_report()
+
+        # Nothing was posted: a non-2xx answer makes the caller keep the candidate and retry it
+        if status == 'error no time left':
+            return func.HttpResponse(f"{title}. Not posted, no time left.", status_code=503)
+        if isinstance(status, str):
+            return func.HttpResponse(f"{title}. Not posted: {status}.", status_code=422)
         return func.HttpResponse(f"{title}. This HTTP triggered function executed successfully.")
     else:
         return func.HttpResponse(
@@ -49,17 +90,35 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         )
     
 
-def create_tiny_url(url):
-    response = requests.get(f'http://tinyurl.com/api-create.php?url={url}')
-    shortened_url = response.text
-    return shortened_url
+def load_twitter_api(account):
+    # Other accounts store their secrets under the account name as prefix, e.g. robotics-twitter-api-key
+    return AsyncClient(bearer_token=client.get_secret(f'{account}-twitterbearertoken').value,
+                    access_token=client.get_secret(f'{account}-twitter-access-token').value,
+                    access_token_secret=client.get_secret(f'{account}-twitter-access-secret').value,
+                    consumer_key=client.get_secret(f'{account}-twitter-api-key').value,
+                    consumer_secret=client.get_secret(f'{account}-twitter-api-secret').value)
+
+
+async def get_twitter_api(account):
+    # The Key Vault client is synchronous, so the secrets of a new account are read in a thread
+    # instead of blocking every request on the event loop; one request loads them, the others wait
+    if account not in twitter_apis:
+        async with twitter_apis_lock:
+            if account not in twitter_apis:
+                twitter_apis[account] = await asyncio.to_thread(load_twitter_api, account)
+    return twitter_apis[account]
+
+
+async def create_tiny_url(url):
+    # Cached, with a timeout, and falls back to the raw url if the provider fails
+    return await link_shortener.ashorten(url)
 
 ### OpenAI API
-def openai_request(instructions, task, model_engine='gpt-3.5-turbo'):
+async def openai_request(instructions, task, route='news_tweet', usage=None, validate=None):
+    # the model is picked by the routing policy of the task, see shared_code.openai_client
     prompt = [{"role": "system", "content": instructions }, 
               {"role": "user", "content": task }]
-    response = openaiclient.chat.completions.create(model=model_engine, messages=prompt, temperature=0.5, max_tokens=300)
-    return response.choices[0].message.content
+    return await router.acomplete(route, prompt, validate, usage=usage, temperature=0.5, max_tokens=300)
 
 
 #### Define OpenAI Prompt for News Tweet
@@ -75,30 +134,34 @@ def create_tweet_prompt(title, description, tiny_url):
     return instructions, task
 
 
-def check_tweet_length(tweet):
-    if len(tweet) > 280:
-        print(f'Tweet too long: {len(tweet)}')
-        return False
-    else:
-        print(f'Tweet length OK: {len(tweet)}')
-        return True
-    
-def create_tweet(title, description, url):
+async def create_tweet(title, description, url, account=''):
+    started = time.perf_counter()
+    usage = {}
     # create tiny url
-    tiny_url = create_tiny_url(url)
+    tiny_url = await create_tiny_url(url)
 
     # define prompt
     instructions, task = create_tweet_prompt(title, description, tiny_url)
 
-    # tweet creation
-    tweet = openai_request(instructions, task)
-    tweet = tweet.replace('"', '')
-
-    # check tweet length and post tweet
-    if check_tweet_length(tweet):
-            print(f'Creating tweet: {tweet}')
-            status = twitter_api.create_tweet(text=tweet)
-            #logging.info(f'Tweet posted: {status.id}')
-    else: 
-        status = 'error tweet too long'
+    # tweet creation, checked for length before it is accepted
+    try:
+        # quotes are dropped, rejected tweets are escalated to the next model of the routing policy
+        tweet = await openai_request(instructions, task, usage=usage,
+                                     validate=lambda answer: checked_tweet(answer.replace('"', '')))
+    except ValueError as ex:
+        print(f'No usable tweet: {ex}')
+        return 'error tweet too long'
+    except DeadlineExceeded as ex:
+        print(f'No tweet: {ex}')
+        return 'error no time left'
+
+    # post tweet, unless the caller has likely given up already
+    account_api = await get_twitter_api(account)
+    if not current_deadline().allows(TWEET_MIN_SECONDS):
+        print('No time left to post the tweet')
+        return 'error no time left'
+    print(f'Creating tweet: {tweet}')
+    status = await account_api.create_tweet(text=tweet)
+    audit_log.record(status.data['id'], tweet, latency_ms=round((time.perf_counter() - started) * 1000, 1),
+                     tokens=usage.get('tokens'), account=account or None, url=url)
     return status
\ No newline at end of file
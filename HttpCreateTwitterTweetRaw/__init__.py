@@ -5,16 +5,27 @@ import logging
 from azure.identity import DefaultAzureCredential
 from azure.keyvault.secrets import SecretClient
 import tweepy
-import csv
-import os.path
-import datetime as dt
+import json
+import time
+import asyncio
+from tweepy.asynchronous import AsyncClient
+from azure.storage.blob.aio import BlobServiceClient
+from shared_code.audit_log import AsyncBlobAuditBackend, make_audit_log
+from shared_code.deadline import DEADLINE_HEADER, current_deadline, start_deadline
+from shared_code.profiler import profiled
+from shared_code.tweet_text import validate_tweet, weighted_length
+
+# Bulk publishing
+MAX_CONCURRENT_POSTS = 4  # posts in flight at the same time
+MAX_POSTS_PER_REQUEST = 100
+POST_MIN_SECONDS = 5  # time a post needs to be worth starting
 
 # Set up the Azure Key Vault client and retrieve the Blob Storage account credentials
 keyvault_name = 'keyvaultforbot' # replace with your own keyvault
 client = SecretClient(f"https://{keyvault_name}.vault.azure.net/", DefaultAzureCredential())
 
 #### Twitter Auth
-twitter_api = tweepy.Client(bearer_token=client.get_secret('twitterbearertoken').value,
+twitter_api = AsyncClient(bearer_token=client.get_secret('twitterbearertoken').value,
                     access_token=client.get_secret('twitter-access-token').value,
                     access_token_secret=client.get_secret('twitter-access-secret').value,
                     consumer_key=client.get_secret('twitter-api-key').value,
@@ -22,15 +33,48 @@ twitter_api = tweepy.Client(bearer_token=client.get_secret('twitterbearertoken')
 
 logging.info('Twitter API ready')
 
-def main(req: func.HttpRequest) -> func.HttpResponse:
+##### Audit log of published tweets
+CONTAINER_NAME = 'botdata'
+blob_service_client = BlobServiceClient(account_url=f"https://{client.get_secret('blobstorage-account-name').value}.blob.core.windows.net",
+                                        credential=client.get_secret('blobstorage-secret').value)
+audit_log = make_audit_log(blob_service_client, CONTAINER_NAME, 'raw', backend=AsyncBlobAuditBackend)
+
+@profiled(blob_service_client, CONTAINER_NAME)
+async def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a request.')
+    start_deadline(req.headers.get(DEADLINE_HEADER))
 
     title = req.params.get('tweet')
 
     if title:
-        create_tweet(tweet)
+        try:
+            await create_tweet(title)
+        finally:
+            await audit_log.aflush()
 
         return func.HttpResponse(f"{title}. This HTTP triggered function executed successfully.")
+    elif req.get_body():
+        # Bulk mode: a JSON array of posts, {"tweets": [...]}, or one post per line (NDJSON)
+        try:
+            tweets = parse_tweets(req.get_body().decode('utf-8'))
+        except ValueError as ex:
+            return func.HttpResponse(json.dumps({'error': str(ex)}), status_code=400, mimetype='application/json')
+        if len(tweets) > MAX_POSTS_PER_REQUEST:
+            return func.HttpResponse(json.dumps({'error': f'at most {MAX_POSTS_PER_REQUEST} posts per request'}),
+                                     status_code=413, mimetype='application/json')
+
+        try:
+            results = await create_tweets(tweets)
+        finally:
+            await audit_log.aflush()
+        body = {
+            'published': sum(result['status'] == 'published' for result in results),
+            'failed': sum(result['status'] != 'published' for result in results),
+            'results': results
+        }
+        # 207 Multi-Status when some but not all posts were published
+        status_code = 200 if body['failed'] == 0 else 207 if body['published'] else 422
+        return func.HttpResponse(json.dumps(body), status_code=status_code, mimetype='application/json')
     else:
         return func.HttpResponse(
              "This HTTP triggered function executed successfully. Pass a name in the query string or in the request body for a personalized response.",
@@ -38,23 +82,63 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         )
     
 
-def log_to_csv(tweet):
+def parse_tweets(body):
+    """Parse the posts of a bulk request; each post is a string or an object with a 'tweet' field."""
+    body = body.strip()
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        payload = [json.loads(line) for line in body.splitlines() if line.strip()]
+    if isinstance(payload, dict):
+        payload = payload.get('tweets', [payload])
+    if not isinstance(payload, list):
+        payload = [payload]
+    return [post.get('tweet') if isinstance(post, dict) else post for post in payload]
 
-    if not os.path.isfile('tweets.csv'):
-        with open('tweets.csv', 'w') as f:
-            writer = csv.writer(f)
-            writer.writerow(['tweet', 'date'])
-    
-    with open('tweets.csv', 'a') as f:
-         writer = csv.writer(f)
-         timestamp = dt.datetime.now()
-         writer.writerow([tweet, timestamp])
 
-def create_tweet(tweet):
+async def create_tweets(tweets):
+    """Validate every post up front, then publish the valid ones with bounded concurrency."""
+    results = [{'index': i, 'status': 'pending'} for i in range(len(tweets))]
+    valid = []
+    for result, tweet in zip(results, tweets):
+        error = validate_tweet(tweet)
+        if error:
+            result.update(status='invalid', error=error)
+        else:
+            result['weighted_length'] = weighted_length(tweet)
+            valid.append((result, tweet))
+
+    rate_limited = asyncio.Event()
+    slots = asyncio.Semaphore(MAX_CONCURRENT_POSTS)
+    deadline = current_deadline()
+
+    async def publish(result, tweet):
+        async with slots:
+            if rate_limited.is_set():
+                result.update(status='rate_limited', error='not attempted after a rate limit response')
+                return
+            if not deadline.allows(POST_MIN_SECONDS):
+                result.update(status='deadline', error='not attempted, the request ran out of time')
+                return
+            try:
+                status = await create_tweet(tweet)
+                result.update(status='published', id=status.data['id'])
+            except tweepy.TooManyRequests as ex:
+                rate_limited.set()
+                result.update(status='rate_limited', error=str(ex),
+                              retry_at=ex.response.headers.get('x-rate-limit-reset') if ex.response is not None else None)
+            except Exception as ex:
+                result.update(status='error', error=str(ex))
+
+    await asyncio.gather(*[publish(result, tweet) for result, tweet in valid])
+    logging.info(f'Bulk publish: {sum(r["status"] == "published" for r in results)} of {len(results)} posted')
+    return results
+
 
-    status = twitter_api.create_tweet(text=tweet)
-    # create a csv if it does not exist
+async def create_tweet(tweet):
 
-    log_to_csv(tweet)
+    started = time.perf_counter()
+    status = await twitter_api.create_tweet(text=tweet)
+    audit_log.record(status.data['id'], tweet, latency_ms=round((time.perf_counter() - started) * 1000, 1))
 
     return status
\ No newline at end of file
@@ -3,15 +3,48 @@ import logging
 import requests
 import pandas as pd
 import azure.functions as func
-from openai import OpenAI
+from openai import APIError, OpenAI
 from azure.identity import DefaultAzureCredential
 from azure.keyvault.secrets import SecretClient
 from azure.storage.blob import BlobServiceClient
+import ast
 import io
+import os
+import time
 from newspaper import Article
 from bs4 import BeautifulSoup
 from hackernews import HackerNews
 import json
+from shared_code import run_coordinator
+from shared_code.candidate_backlog import MAX_AGE_HOURS, history_key, load_backlog, save_backlog
+from shared_code.deadline import DEADLINE_HEADER, DeadlineExceeded, current_deadline, start_deadline
+from shared_code.openai_client import ModelRouter
+from shared_code.poll_scheduler import PollScheduler
+from shared_code.profiler import profiled, timed
+
+# Constants
+TENANTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tenants.json')
+TENANT_DEFAULTS = {
+    'account': '',  # prefix of the Twitter secrets in Key Vault, '' for the default account
+    'query': 'Artificial Intelligence',
+    'history_blob': 'news_log.csv',
+    'backlog_blob': 'news_backlog.json',
+    'publish_per_tick': 1,  # articles published per timer tick
+    'min_publish_interval_minutes': 120,  # minimum time between two publications
+    'fact_tweets': False,
+}
+RUN_NAME = 'news_trigger'  # lease blob is news_trigger.lock, idempotency keys news_trigger_keys.json
+NOVELTY_CHECKS_PER_TICK = 5  # novelty LLM calls per tenant and timer tick, the rest wait for the next tick
+SCHEDULER_NAME = 'news_scheduler.json'  # polling intervals and last result IDs per news query
+MAX_UNSCORED = 50  # candidates kept in the scheduler state until relevance scoring succeeds
+RELEVANCE_MAX_TOKENS = 4000  # output limit of a relevance request, below that of every model it may run on
+RELEVANCE_TOKENS_PER_ANSWER = 8  # output tokens of one title's answer for one tenant
+# Stage timeouts, each shortened to the remaining invocation budget
+BING_TIMEOUT_SECONDS = 10
+TWEET_FUNCTION_TIMEOUT_SECONDS = 45  # below the run lease, the tweet function gets the same budget
+# Time a stage needs to be worth starting; optional stages are skipped below it
+NOVELTY_MIN_SECONDS = 20
+PUBLISH_MIN_SECONDS = 30
 
 # Use environment variables for API key
 keyvault_name = 'keyvaultforbot' # replace with your own keyvault
@@ -21,10 +54,14 @@ NEWSAPI_API_KEY = client.get_secret('newsapi-api-key').value
 
 logging.info('Setting OpenAI API Key')
 openaiclient = OpenAI(api_key=client.get_secret('openai-api-key').value)
+router = ModelRouter(openaiclient)
 
 logging.info('Setting Function App API Key')
 API_KEY = client.get_secret('function-app-api').value
 
+logging.info('Setting Bing Search API Key')
+BING_API_KEY = client.get_secret('bingsearchapi').value
+
 ##### Azure Blob Storage
 blobstorage_account_name = client.get_secret('blobstorage-account-name').value
 blobstorage_secret = client.get_secret('blobstorage-secret').value
@@ -38,18 +75,20 @@ if not blob_service_client.get_container_client(CONTAINER_NAME).exists():
     logging.info(f'Container {CONTAINER_NAME} created')
 container_client = blob_service_client.get_container_client(CONTAINER_NAME)
 logging.info ('Container client ready')
+poll_scheduler = PollScheduler(run_coordinator.document(blob_service_client, CONTAINER_NAME, SCHEDULER_NAME))
 
-def get_old_news():
-    blob_client = blob_service_client.get_blob_client(container=CONTAINER_NAME, blob=CSV_NAME)
-    data = blob_client.download_blob().content_as_text()
+def get_old_news(news_log):
+    data = news_log.read()
+    if data is None:
+        return pd.DataFrame(columns=['title'])
     df = pd.read_csv(io.StringIO(data))
     logging.info('Posts log retrieved from blob storage')
     return df
 
-def save_posts_log(df):
+def save_posts_log(df, news_log):
     # try:
-    blob_client = blob_service_client.get_blob_client(container=CONTAINER_NAME, blob=CSV_NAME)
-    blob_client.upload_blob(data=df.to_csv(index=False), overwrite=True)
+    # fails with WriteConflict if another run wrote the log since we read it
+    news_log.write(df.to_csv(index=False))
 
     print(f'File {CSV_NAME} saved to blob storage')
     # except:
@@ -73,8 +112,10 @@ def save_posts_log(df):
 
 def fetch_main_content_from_url(url):
     article = Article(url)
-    article.download()
-    article.parse()
+    with timed('http', 'article download'):
+        article.download()
+    with timed('parse', 'article parse'):
+        article.parse()
     return article.text
 
 # #### HackerNews
@@ -107,12 +148,38 @@ def fetch_main_content_from_url(url):
 #     return df
 
 #### OpenAI Engine
-def openai_request(instructions, task, sample = [], temperature=0.5, model_engine='gpt-3.5-turbo-1106'):
+def openai_request(instructions, task, sample = [], temperature=0.5, route='relevance', max_tokens=400, validate=None,
+                   response_format=None):
+    # the model is picked by the routing policy of the task, see shared_code.openai_client
     prompt = [{"role": "system", "content": instructions }, 
               {"role": "user", "content": task }]
     prompt = sample + prompt
-    response = openaiclient.chat.completions.create(model=model_engine, messages=prompt, temperature=temperature, max_tokens=400)
-    return response.choices[0].message.content
+    params = {'response_format': response_format} if response_format else {}
+    return router.complete(route, prompt, validate, temperature=temperature, max_tokens=max_tokens, **params)
+
+
+#### Answer validation, a rejected answer is escalated to the next model
+def parse_relevance(answer, count):
+    relevance = ast.literal_eval(answer.strip())
+    if not isinstance(relevance, list) or len(relevance) != count or not all(isinstance(v, bool) for v in relevance):
+        raise ValueError(f'expected {count} booleans')
+    return relevance
+
+
+def parse_relevance_multi(answer, names, count):
+    relevance = json.loads(answer)
+    for name in names:
+        values = relevance.get(name) if isinstance(relevance, dict) else None
+        if not isinstance(values, list) or len(values) != count or not all(isinstance(v, bool) for v in values):
+            raise ValueError(f'expected {count} booleans for {name}')
+    return relevance
+
+
+def parse_novelty(answer):
+    score = int(answer.strip().strip("'\"."))
+    if not 0 <= score <= 5:
+        raise ValueError(f'score {score} out of range')
+    return score
 
 
 #### Define OpenAI Prompt for news Relevance
@@ -151,6 +218,20 @@ def select_relevant_news_prompt(news_articles, topics, n):
     return instructions, task, sample
 
 
+#### Define OpenAI Prompt for news Relevance of several audiences
+def select_relevant_news_multi_prompt(news_articles, audiences):
+    instructions = "Please review the given list of news titles and determine their relevance to each of the audiences. Each audience is keen on the themes listed for it. \
+    Return a JSON object that maps each audience name to a list of boolean values (true or false) corresponding to each title's relevance."
+    task = json.dumps({'audiences': audiences, 'titles': news_articles})
+    sample = [
+        {"role": "user", "content": json.dumps({
+            'audiences': {'ai': '[machine learning, openai, nvidia]', 'cars': '[electric vehicles, toyota, tesla]'},
+            'titles': ['new LLM model from Nvidia', 'Toyota launches new car model', 'New Zelda Game Now Available']})},
+        {"role": "assistant", "content": json.dumps({'ai': [True, False, False], 'cars': [False, True, False]})}
+        ]
+    return instructions, task, sample
+
+
 #### Define OpenAI Prompt for news Relevance
 def check_previous_posts_prompt(title, old_posts):    
     instructions = f'Assess the level of novelty in a given list of articles. You will compare a news title with a list of previous news and score the noveliy of the articles on a scale of 0 to 5, where 5 indicates a complete overlap and 0 signifies a novel topic.'
@@ -168,12 +249,24 @@ def check_previous_posts_prompt(title, old_posts):
 
 
 #### Define OpenAI Prompt for news Relevance
-def call_tweet_function(title, description, url):
+def call_tweet_function(title, description, url, account='', timeout=None):
     logging.info('Calling Azure Function App to Create Tweet')
     # Define the Azure Function App URL
     request_url = f"https://relatalyfunc.azurewebsites.net/api/HttpCreateTwitterTweet?title={title}&description={description}&url={url}"
+    if account:
+        request_url += f"&account={account}"
     headers = {"x-functions-key": API_KEY}
-    response = requests.post(request_url, headers=headers)
+    # The tweet function plans with the time we wait for it, so it answers before we give up
+    if timeout is None:
+        timeout = current_deadline().timeout(TWEET_FUNCTION_TIMEOUT_SECONDS, 'tweet function')
+    headers[DEADLINE_HEADER] = str(int(timeout * 1000))
+    try:
+        with timed('http', 'tweet function'):
+            response = requests.post(request_url, headers=headers, timeout=timeout)
+    except requests.ReadTimeout:
+        # The request was sent and the tweet may still be published, so the caller must not retry it
+        logging.error(f'Tweet function timed out for {title}')
+        return 'timeout'
 
     # Check the response status
     if response.status_code == 200:
@@ -191,7 +284,18 @@ def create_fact_tweet(input=""):
     # Define the Azure Function App URL
     request_url = f"https://relatalyfunc.azurewebsites.net/api/HttpCreateTwitterFactTweet?input={input}"
     headers = {"x-functions-key": API_KEY}
-    response = requests.post(request_url, headers=headers)
+    deadline = current_deadline()
+    if not deadline.allows(PUBLISH_MIN_SECONDS):
+        logging.info('Budget is tight, no fact tweet this tick')
+        return 'skipped'
+    timeout = deadline.timeout(TWEET_FUNCTION_TIMEOUT_SECONDS, 'fact tweet function')
+    headers[DEADLINE_HEADER] = str(int(timeout * 1000))
+    try:
+        with timed('http', 'fact tweet function'):
+            response = requests.post(request_url, headers=headers, timeout=timeout)
+    except requests.Timeout:
+        logging.error('Fact tweet function timed out')
+        return 'timeout'
 
     # Check the response status
     if response.status_code == 200:
@@ -205,72 +309,248 @@ def create_fact_tweet(input=""):
 #### Define OpenAI Prompt for news Relevance
 def previous_post_check(title, old_posts):
     instructions, task, sample = check_previous_posts_prompt(title, old_posts)
-    response = openai_request(instructions, task, sample, 0.5, "gpt-4-1106-preview")
-    logging.info('doublicate_check:' + response)
     try:
-        response = eval(response)
-    except:
-        print('Error in previous_post_check: ' + response)
+        response = openai_request(instructions, task, sample, 0.5, 'novelty', validate=parse_novelty)
+    except ValueError as ex:
+        print(f'Error in previous_post_check: {ex}')
         response = 0
     logging.info('doublicate_check:' + str(response))
     return response
 
 
 #### Main Bot
-def main_bot(df):
-    df_old = get_old_news()
+def clean_title(title):
+    title = title.replace('"', "").replace("'", "").replace("’", "").replace("“", "").replace("”", "")
+    return title.replace("'", "")
+
+
+def load_tenants(path=TENANTS_PATH):
+    """Read the tenant configuration; each tenant is one account with its own topics, cadence and history."""
+    with open(path, encoding='utf-8') as f:
+        tenants = json.load(f)
+    return [{**TENANT_DEFAULTS, **tenant} for tenant in tenants]
+
+
+def normalise_candidates(df):
+    """Clean titles and drop candidates fetched by more than one query."""
+    df = df.assign(title=df['title'].map(clean_title))
+    return df.drop_duplicates(subset='url').drop_duplicates(subset='title')
+
+
+def score_relevance_multi(titles, audiences):
+    """Relevance answer of one multi-tenant request, {tenant name: [bool, ...]} with the usable answers."""
+    instructions, task, sample = select_relevant_news_multi_prompt(titles, audiences)
+    names = list(audiences)
+    try:
+        return openai_request(instructions, task, sample, 0.0, 'relevance_multi',
+                              max_tokens=400 + RELEVANCE_TOKENS_PER_ANSWER * len(titles) * len(names),
+                              response_format={'type': 'json_object'},
+                              validate=lambda answer: parse_relevance_multi(answer, names, len(titles)))
+    except ValueError as ex:
+        # Keep the usable answers of the last model, the other tenants are filtered out by the caller
+        try:
+            answers = json.loads(getattr(ex, 'content', '') or '{}')
+        except ValueError:
+            answers = {}
+        return answers if isinstance(answers, dict) else {}
+
+
+def score_relevance(titles, tenants):
+    """Relevance of every title for every tenant in one LLM call per chunk of titles, one boolean column per tenant.
+
+    Tenants whose answer cannot be used are left out, so their candidates
+    stay unscored and are offered again on the next tick.
+    """
+    temperature=0.0
+    if len(tenants) == 1:
+        instructions, task, sample = select_relevant_news_prompt(titles, tenants[0]['topics'], len(titles))
+        try:
+            relevance = openai_request(instructions, task, sample, temperature,
+                                       validate=lambda answer: parse_relevance(answer, len(titles)))
+            answers = {tenants[0]['name']: relevance}
+        except ValueError:
+            answers = {}
+        logging.info(f'relevance: {answers}')
+    else:
+        audiences = {tenant['name']: tenant['topics'] for tenant in tenants}
+        # Titles are scored in chunks whose answers fit the output limit of every model of the policy
+        size = max(1, (RELEVANCE_MAX_TOKENS - 400) // (RELEVANCE_TOKENS_PER_ANSWER * len(tenants)))
+        answers = {}
+        for start in range(0, len(titles), size):
+            chunk = titles[start:start + size]
+            part = score_relevance_multi(chunk, audiences)
+            for name in audiences:
+                value = part.get(name)
+                if answers.get(name, []) is not None and isinstance(value, list) and len(value) == len(chunk):
+                    answers[name] = answers.get(name, []) + value
+                else:
+                    answers[name] = None
+        logging.info(f'relevance: {answers}')
+
+    columns = {}
+    for tenant in tenants:
+        answer = answers.get(tenant['name'])
+        if isinstance(answer, list) and len(answer) == len(titles):
+            columns[tenant['name']] = [bool(value) for value in answer]
+        else:
+            logging.error(f"Unusable relevance answer for {tenant['name']}: {answer}")
+    return pd.DataFrame(columns, index=range(len(titles)), dtype=bool)
+
+
+def hold_relevant_candidates(df, relevant, state, now):
+    """Hold the relevant new candidates of one tenant until their novelty is scored."""
+    backlog, df_old = state['backlog'], state['df_old']
+    for (index, row), is_relevant in zip(df.iterrows(), relevant):
+        title = row['title']
+        if not is_relevant:
+            backlog.mark_seen(title, now)
+        elif title in df_old.title.values:
+            print(f"Already tweeted: {title}")
+            logging.info(f"Already tweeted: {title}")
+            backlog.mark_seen(title, now)
+        else:
+            backlog.defer(title, row['description'], row['url'], relevance=1.0, now=now)
+
+
+def score_novelty(df_old, backlog, now, duplicates):
+    """Score the novelty of at most NOVELTY_CHECKS_PER_TICK held candidates and queue the novel ones."""
+    deadline = current_deadline()
+    for _ in range(NOVELTY_CHECKS_PER_TICK):
+        # The novelty re-check is optional, held candidates wait for a tick with more time
+        if not deadline.allows(NOVELTY_MIN_SECONDS):
+            logging.info(f'Budget is tight, {len(backlog.pending)} novelty checks left for the next tick')
+            break
+        taken = backlog.take_pending(1)
+        if not taken:
+            break
+        candidate = taken[0]
+        title = candidate['title']
+        old_posts = list(df_old.tail(10)['title'])
+        try:
+            doublicate_check = previous_post_check(title, old_posts)
+        except Exception:
+            backlog.pending.append(candidate)
+            raise
+        if doublicate_check < 3:
+            backlog.push(title, candidate['description'], candidate['url'], relevance=candidate['relevance'],
+                         novelty=doublicate_check, now=now, first_seen=candidate['first_seen'],
+                         scored_against=history_key(old_posts))
+            logging.info(f"Queued: {title}")
+        else:
+            print(f"Doublicate Context Check True: {title}")
+            logging.info(f"Context Doublicate: {title}")
+            duplicates.append(title)
+
+
+def publish_from_backlog(tenant, df_old, backlog, coordinator, now, published, duplicates):
+    """Publish the candidates at the head of a tenant's backlog, at most publish_per_tick.
+
+    A candidate whose novelty was scored against an older history is checked
+    again, so that another outlet's take on a story published since is not
+    posted as well. Published titles and duplicates found are appended to
+    the lists passed in, so they are kept when a stage stops early.
+    """
+    if backlog.last_published and now - backlog.last_published < tenant['min_publish_interval_minutes'] * 60:
+        logging.info(f"{tenant['name']}: minimum publish interval not reached, skipping publication")
+        return
+
+    deadline = current_deadline()
+    while len(published) < tenant['publish_per_tick']:
+        if not deadline.allows(PUBLISH_MIN_SECONDS):
+            logging.info(f"{tenant['name']}: budget is tight, publishing on the next tick")
+            break
+        candidate = backlog.pop(now)
+        if candidate is None:
+            break
+        title = candidate['title']
+        claim = f"{tenant['name']}: {title}"
+        if title in df_old.title.values or title in published:
+            print(f"Already tweeted: {title}")
+            logging.info(f"Already tweeted: {title}")
+            continue
+        old_posts = (list(df_old['title']) + duplicates + published)[-10:]
+        if candidate.get('scored_against') != history_key(old_posts):
+            try:
+                doublicate_check = previous_post_check(title, old_posts)
+            except Exception:
+                backlog.requeue(candidate)
+                raise
+            if doublicate_check >= 3:
+                logging.info(f"Context Doublicate since it was queued: {title}")
+                duplicates.append(title)
+                continue
+        try:
+            # Taken before claiming, so a tick without time left does not block the story with its claim
+            timeout = current_deadline().timeout(TWEET_FUNCTION_TIMEOUT_SECONDS, 'tweet function')
+            claimed = coordinator.claim(claim)
+        except Exception:
+            backlog.requeue(candidate)
+            raise
+        if not claimed:
+            logging.info(f"Already claimed by another run: {claim}")
+            continue
+
+        # create tweet
+        try:
+            response = call_tweet_function(title, candidate['description'], candidate['url'], tenant['account'],
+                                           timeout=timeout)
+        except Exception:
+            # Only a read timeout is answered with 'timeout', the tweet function did not get this request
+            coordinator.release_claim(claim)
+            backlog.retry(candidate)
+            raise
+        if response == 200:
+            print(f"Tweeted: {title}")
+            coordinator.complete(claim)
+            published.append(title)
+            backlog.last_published = now
+        elif response == 'timeout':
+            # Keep the claim so that a tweet that did go out is not posted twice
+            published.append(title)
+            backlog.last_published = now
+        else:
+            print(f"Error: {response}")
+            logging.info(f"Error: {response}")
+            coordinator.release_claim(claim)
+            backlog.retry(candidate)
+
+
+def load_tenant_state(tenant, now):
+    """Load the history and backlog of one tenant."""
+    news_log = run_coordinator.document(blob_service_client, CONTAINER_NAME, tenant['history_blob'])
+    df_old = get_old_news(news_log)
     df_old = df_old.tail(16)
     logging.info(df_old)
     print(df_old)
-    # Fetch news data
-    
-    logging.info(df['title'])
-    
-    # Check the Relevance of the News and Filter those not relevant
-    relevant_topics ="[machine learning, data science, robotics, openai, artificial intelligence, ai, neural networks, data mining, tensorflow, pytorch, nlp, data analytics, virtual assistants, chatbots, augmented reality, chatgpt, gpu, anthropic, microsoft, apple, nvidia]"
-    instructions, task, sample = select_relevant_news_prompt(list(df['title']), relevant_topics, len(list(df['title'])))
-    temperature=0.0
-    relevance = openai_request(instructions, task, sample, temperature)
-    logging.info(len(list(df['title'])))
-    logging.info('relevance:' + relevance)
-    relevance_list = eval(relevance)
-    logging.info(len(relevance_list))
-
-    s = 0
-    df = df[relevance_list]
-    if len(df) > 0:
-        for index, row in df.iterrows():
-            if s == 1:
-                break
-            logging.info('info:' + row['title'])
-            title = row['title'].replace('"', "").replace("'", "").replace("’", "").replace("“", "").replace("”", "")
-            title = title.replace("'", "")
-            print(f"title {title}")
-            description = row['description']
-            url = row['url']            
-                                             
-            if (title not in df_old.title.values):
-                doublicate_check = previous_post_check(title, list(df_old.tail(10)['title']))
-                if doublicate_check < 3:
-                    # create tweet
-                    response = call_tweet_function(title, description, url)
-                    if response == 200:
-                        print(f"Tweeted: {title}")
-                        #add title to the csv file  
-                        save_posts_log(pd.concat([df_old, pd.DataFrame({'title': [title]})], ignore_index=True))
-                        s += 1
-                    else:
-                        print(f"Error: {response}")
-                        logging.info(f"Error: {response}")
-                else: 
-                    print(f"Doublicate Context Check True: {title}")
-                    logging.info(f"Context Doublicate: {title}")
-                    save_posts_log(pd.concat([df_old, pd.DataFrame({'title': [title]})], ignore_index=True))
-            else: 
-                print(f"Already tweeted: {title}")
-                logging.info(f"Already tweeted: {title}")
-                
-    else: 
+
+    backlog_document = run_coordinator.document(blob_service_client, CONTAINER_NAME, tenant['backlog_blob'])
+    backlog = load_backlog(backlog_document)
+    backlog.expire(now)
+    return {'tenant': tenant, 'news_log': news_log, 'df_old': df_old,
+            'backlog_document': backlog_document, 'backlog': backlog}
+
+
+def publish_tenant(state, coordinator, now):
+    """Score novelty, publish and persist for one tenant."""
+    tenant, df_old, backlog = state['tenant'], state['df_old'], state['backlog']
+    duplicates, published = [], []
+    coordinator.checkpoint()
+    try:
+        score_novelty(df_old, backlog, now, duplicates)
+        publish_from_backlog(tenant, df_old, backlog, coordinator, now, published, duplicates)
+    except (DeadlineExceeded, APIError, requests.RequestException) as ex:
+        # Whatever was done so far is persisted below, the rest waits for the next tick
+        logging.error(f"{tenant['name']}: stopped early: {ex}")
+
+    # add titles to the csv file, always, the persist reserve of the budget is kept for this
+    coordinator.checkpoint()
+    if duplicates or published:
+        save_posts_log(pd.concat([df_old, pd.DataFrame({'title': duplicates + published})], ignore_index=True),
+                       state['news_log'])
+    save_backlog(state['backlog_document'], backlog)
+    logging.info(f"{tenant['name']}: published {len(published)}, backlog size {len(backlog)}")
+
+    if not published and len(backlog) == 0 and not backlog.pending and tenant['fact_tweets']:
         print("No news articles found")
         logging.info("No news articles found")
         # 3% chance to tweet a fact
@@ -287,17 +567,75 @@ def main_bot(df):
                 print(f"Error: {response}")
                 logging.info(f"Error: {response}")
 
-def bingsearch(news_count=10):
+
+def next_work_due(states, now):
+    """Earliest time a backlog has work without a new poll, None if all backlogs are empty."""
+    due = []
+    for state in states:
+        tenant, backlog = state['tenant'], state['backlog']
+        if backlog.pending:
+            due.append(now)
+        elif len(backlog):
+            due.append(max(now, (backlog.last_published or 0) + tenant['min_publish_interval_minutes'] * 60))
+    return min(due, default=None)
+
+
+def main_bot(df, coordinator, tenants=None):
+    """Score new candidates and publish for every tenant.
+
+    Returns when the backlogs have work next and the candidates some tenant
+    could not score, which the next tick retries without polling again.
+    """
+    tenants = tenants or load_tenants()
+    df = normalise_candidates(df).reset_index(drop=True)
+    logging.info(df['title'])
+    now = time.time()
+    states = [load_tenant_state(tenant, now) for tenant in tenants]
+
+    # Which candidates each tenant has not scored yet; only these cost LLM calls
+    new = pd.DataFrame({state['tenant']['name']: df['title'].map(lambda title: not state['backlog'].is_known(title))
+                        for state in states}, index=df.index, dtype=bool)
+    candidates = df[new.any(axis=1)].reset_index(drop=True)
+    new = new[new.any(axis=1)].reset_index(drop=True)
+    logging.info(f'New candidates to score: {len(candidates)}')
+
+    # One relevance pass for all tenants, then fan out to the tenant backlogs
+    scoring = [state['tenant'] for state in states if new[state['tenant']['name']].any()]
+    if len(candidates) > 0 and scoring:
+        coordinator.checkpoint()
+        try:
+            relevance = score_relevance(list(candidates['title']), scoring)
+        except (DeadlineExceeded, APIError) as ex:
+            # A timed out or failed request is handled like a deadline, the candidates stay unscored
+            logging.error(f'Relevance scoring skipped: {ex}')
+            relevance = pd.DataFrame()
+        for state in states:
+            name = state['tenant']['name']
+            if name in relevance:
+                mask = new[name]
+                hold_relevant_candidates(candidates[mask], relevance.loc[mask, name], state, now)
+
+    for state in states:
+        publish_tenant(state, coordinator, now)
+
+    unscored = candidates[candidates['title'].map(
+        lambda title: any(not state['backlog'].is_known(title) for state in states)).astype(bool)]
+    if len(unscored):
+        logging.info(f'Candidates left unscored, retried on the next tick: {len(unscored)}')
+    first_seen = unscored['first_seen'].fillna(now) if 'first_seen' in unscored else now
+    unscored = unscored[['title', 'description', 'url']].assign(first_seen=first_seen).head(MAX_UNSCORED)
+    work_due = now if len(unscored) else next_work_due(states, now)
+    return work_due, unscored.to_dict('records')
+
+def bingsearch(news_count=10, query="Artificial Intelligence", subscription_key=None):
     # bing search example
     # https://docs.microsoft.com/en-us/azure/cognitive-services/bing-web-search/quickstarts/python
 
     # Add your Bing Search V7 subscription key and endpoint to your environment variables.
-    subscription_key = client.get_secret('bingsearchapi').value
+    if subscription_key is None:
+        subscription_key = BING_API_KEY
     endpoint = "https://api.bing.microsoft.com/v7.0/news/search"
 
-    # Query term(s) to search for.
-    query = "Artificial Intelligence"
-
     # Construct a request
     mkt = "en-US"
     params = {'q': query, 'mkt': mkt}
@@ -305,7 +643,9 @@ def bingsearch(news_count=10):
 
     # Call the API
     try:
-        response = requests.get(endpoint, headers=headers, params=params)
+        with timed('http', 'bing search'):
+            response = requests.get(endpoint, headers=headers, params=params,
+                                    timeout=current_deadline().timeout(BING_TIMEOUT_SECONDS, 'Bing search'))
         response.raise_for_status()
 
         # Print the response
@@ -339,7 +679,29 @@ def bingsearch(news_count=10):
     return df_limited
 
 
+def ingest(queries, news_count=10, schedule=None, now=None):
+    """Fetch the news of each query once; returns the results and how many of them the last polls did not return.
 
+    Every result is kept, main_bot only scores the ones the tenants have not
+    scored yet, so candidates left unscored by an earlier tick are retried.
+    """
+    frames = [pd.DataFrame(columns=['title', 'description', 'url'])]
+    new_count = 0
+    for query in queries:
+        try:
+            df = bingsearch(news_count, query)
+        except (DeadlineExceeded, requests.RequestException) as ex:
+            logging.error(f'Skipping query {query}: {ex}')
+            continue
+        if schedule is not None:
+            # Result-ID diff: the url identifies a result across polls
+            new_count += len(poll_scheduler.observe(schedule, query, list(df['url']) if len(df) else [], now))
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True), new_count
+
+
+
+@profiled(blob_service_client, CONTAINER_NAME)
 def main(mytimer: func.TimerRequest) -> None:
     utc_timestamp = dt.datetime.utcnow().replace(
         tzinfo=dt.timezone.utc).isoformat()
@@ -350,7 +712,43 @@ def main(mytimer: func.TimerRequest) -> None:
     # main_bot(df_news_api)
     # df_hacker_news = fetch_newsapi_news(10)
     # main_bot(df_hacker_news)
-    df_bing = bingsearch(10)
-    main_bot(df_bing)
+
+    # Stages take their timeouts from this budget, time for persisting is kept in reserve
+    start_deadline()
+
+    # Poll only the sources that are due, and run the pipeline only if there is something to do
+    now = time.time()
+    tenants = load_tenants()
+    queries = list(dict.fromkeys(tenant['query'] for tenant in tenants))
+    # A first look without the lease, so that quiet ticks cost a single read
+    schedule = poll_scheduler.load()
+    if not poll_scheduler.due(schedule, queries, now) and not poll_scheduler.work_due(schedule, now):
+        logging.info('No source due and no backlog work, skipping this tick')
+        return
+
+    # Overlapping or past-due runs skip the tick instead of duplicating work
+    coordinator = run_coordinator.make_coordinator(blob_service_client, CONTAINER_NAME, RUN_NAME)
+    if not coordinator.acquire():
+        logging.info('Another run is in progress, skipping this tick')
+        return
+    try:
+        # Reloaded under the lease, a run that finished since the first look may have saved a newer state
+        schedule = poll_scheduler.load()
+        due = poll_scheduler.due(schedule, queries, now)
+        df_bing, new_count = ingest(due, 10, schedule, now)
+        # Candidates a failed relevance call left unscored go first, so they keep their first_seen
+        unscored = pd.DataFrame([c for c in schedule.get('unscored', [])
+                                 if now - c['first_seen'] <= MAX_AGE_HOURS * 3600],
+                                columns=['title', 'description', 'url', 'first_seen'])
+        if new_count or len(unscored) or poll_scheduler.work_due(schedule, now):
+            schedule['work_due'], schedule['unscored'] = main_bot(
+                pd.concat([unscored, df_bing], ignore_index=True), coordinator, tenants)
+        else:
+            logging.info('No new results, skipping relevance scoring')
+        coordinator.checkpoint()
+        poll_scheduler.save(schedule)
+    finally:
+        coordinator.release()
+        router.log_report()
 
     logging.info('Python timer trigger function ran at %s', utc_timestamp)
\ No newline at end of file
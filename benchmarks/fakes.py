@@ -0,0 +1,682 @@
+"""Local stand-ins for Key Vault, OpenAI, Bing/TinyURL, Twitter and Blob Storage."""
+import asyncio
+import collections
+import itertools
+import json
+import math
+import sys
+import time
+import types
+import uuid
+import urllib.parse
+
+# Globals
+calls = collections.Counter()
+
+
+def reset_calls():
+    """Reset the external call counters."""
+    calls.clear()
+
+
+#### Key Vault
+class FakeCredential:
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+class FakeSecret:
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+
+class FakeSecretClient:
+    """Secret store that returns a deterministic value for every secret name."""
+
+    secrets = {}
+
+    def __init__(self, vault_url, credential=None, **kwargs):
+        self.vault_url = vault_url
+
+    def get_secret(self, name):
+        calls['keyvault.get_secret'] += 1
+        return FakeSecret(name, self.secrets.get(name, f'fake-{name}'))
+
+
+#### OpenAI
+class APIError(Exception):
+    pass
+
+
+class APIConnectionError(APIError):
+    pass
+
+
+class APITimeoutError(APIConnectionError):
+    def __init__(self, request=None):
+        super().__init__('Request timed out.')
+
+
+class APIStatusError(APIError):
+    pass
+
+
+class RateLimitError(APIStatusError):
+    pass
+
+
+class FakeCompletions:
+    """Replays recorded completions, picked by matching the system instructions.
+
+    Setting `fail_with` to an exception class makes every completion raise it.
+    """
+
+    fail_with = None
+
+    def __init__(self, replay):
+        self.replay = replay
+
+    def create(self, model, messages, **kwargs):
+        calls['openai.chat'] += 1
+        if self.fail_with is not None:
+            raise self.fail_with()
+        calls[f'openai.chat.{model}'] += 1
+        return self.replay.complete(model, messages, logprobs=kwargs.get('logprobs', False))
+
+
+class FakeAsyncCompletions(FakeCompletions):
+    """FakeCompletions for AsyncOpenAI; the latency is awaited instead of slept."""
+
+    async def create(self, model, messages, **kwargs):
+        calls['openai.chat'] += 1
+        if self.fail_with is not None:
+            raise self.fail_with()
+        calls[f'openai.chat.{model}'] += 1
+        await asyncio.sleep(self.replay.delay(model))
+        return self.replay.answer(model, messages, logprobs=kwargs.get('logprobs', False))
+
+
+class Replay:
+    """Recorded completions with a configurable per-request latency.
+
+    A kind may record `model_responses` that replace its responses for one
+    model, and `confidence` values that are returned as the logprobs of the
+    least likely token. `models` scales the latency per model.
+    """
+
+    def __init__(self, fixtures, latency_ms=0.0):
+        self.kinds = fixtures['kinds']
+        self.default = fixtures.get('default', '')
+        self.latency_ms = latency_ms
+        self.latency_factors = {model: spec.get('latency_factor', 1.0)
+                                for model, spec in fixtures.get('models', {}).items()}
+        self.cycles = {kind['kind']: itertools.cycle(kind['responses']) for kind in self.kinds}
+        self.model_cycles = {(kind['kind'], model): itertools.cycle(responses) for kind in self.kinds
+                             for model, responses in kind.get('model_responses', {}).items()}
+        self.confidences = {kind['kind']: itertools.cycle(kind['confidence'])
+                            for kind in self.kinds if kind.get('confidence')}
+        self.seq = itertools.count(1)
+
+    def match(self, messages):
+        system = next((m['content'] for m in reversed(messages) if m['role'] == 'system'), '')
+        for kind in self.kinds:
+            if kind['match'] in system:
+                return kind
+        return None
+
+    def render(self, kind, model, messages):
+        response = next(self.model_cycles.get((kind['kind'], model), self.cycles[kind['kind']]))
+        if kind.get('tile') == 'audiences':
+            # Tile a recorded pattern to every audience and title of a JSON task
+            task = json.loads(messages[-1]['content'])
+            count = len(task['titles'])
+            return json.dumps({audience: [response[(i + j) % len(response)] for i in range(count)]
+                               for j, audience in enumerate(task['audiences'])})
+        if kind.get('tile'):
+            # Tile a recorded pattern to the number of items in the task
+            task = messages[-1]['content'].rstrip('?')
+            try:
+                count = len(eval(task))
+            except Exception:
+                count = len(response)
+            response = str([response[i % len(response)] for i in range(count)])
+        # Recorded responses may contain {seq} to make every completion distinct
+        return response.replace('{seq}', str(next(self.seq)))
+
+    def delay(self, model):
+        """Simulated latency of a completion on `model` in seconds."""
+        return self.latency_ms * self.latency_factors.get(model, 1.0) / 1000
+
+    def complete(self, model, messages, logprobs=False):
+        if self.latency_ms:
+            time.sleep(self.delay(model))
+        return self.answer(model, messages, logprobs)
+
+    def answer(self, model, messages, logprobs=False):
+        kind = self.match(messages)
+        content = self.render(kind, model, messages) if kind else self.default
+        token_logprobs = None
+        if logprobs:
+            confidence = next(self.confidences[kind['kind']]) if kind and kind['kind'] in self.confidences else 1.0
+            token_logprobs = types.SimpleNamespace(content=[
+                types.SimpleNamespace(token=content[:4], logprob=math.log(confidence))])
+        prompt_tokens = sum(len(str(m['content'])) for m in messages) // 4
+        return types.SimpleNamespace(
+            id=f'chatcmpl-{uuid.uuid4().hex[:12]}',
+            model=model,
+            choices=[types.SimpleNamespace(
+                index=0,
+                finish_reason='stop',
+                logprobs=token_logprobs,
+                message=types.SimpleNamespace(role='assistant', content=content))],
+            usage=types.SimpleNamespace(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=len(content) // 4,
+                total_tokens=prompt_tokens + len(content) // 4))
+
+
+class FakeFiles:
+    """OpenAI file storage; batch input and output files live in memory."""
+
+    contents = {}
+
+    def create(self, file, purpose, **kwargs):
+        calls['openai.files'] += 1
+        name, data = file if isinstance(file, tuple) else ('file', file)
+        data = data.read() if hasattr(data, 'read') else data
+        file_id = f'file-{uuid.uuid4().hex[:12]}'
+        self.contents[file_id] = data.decode('utf-8') if isinstance(data, bytes) else data
+        return types.SimpleNamespace(id=file_id, filename=name, purpose=purpose)
+
+    def content(self, file_id):
+        calls['openai.files'] += 1
+        return types.SimpleNamespace(text=self.contents[file_id])
+
+
+class FakeBatches:
+    """Batch API that completes every batch as soon as it is created."""
+
+    batches = {}
+
+    def __init__(self, replay):
+        self.replay = replay
+
+    def create(self, input_file_id, endpoint, completion_window, **kwargs):
+        calls['openai.batches'] += 1
+        lines = []
+        for line in FakeFiles.contents[input_file_id].splitlines():
+            request = json.loads(line)
+            calls['openai.batch_requests'] += 1
+            completion = self.replay.complete(request['body']['model'], request['body']['messages'])
+            body = {'choices': [{'index': 0, 'message': {'role': 'assistant',
+                                                         'content': completion.choices[0].message.content}}]}
+            lines.append(json.dumps({'custom_id': request['custom_id'],
+                                     'response': {'status_code': 200, 'body': body}, 'error': None}))
+        output_id = f'file-{uuid.uuid4().hex[:12]}'
+        FakeFiles.contents[output_id] = '\n'.join(lines)
+        batch = types.SimpleNamespace(id=f'batch_{uuid.uuid4().hex[:12]}', status='completed',
+                                      output_file_id=output_id)
+        self.batches[batch.id] = batch
+        return batch
+
+    def retrieve(self, batch_id):
+        calls['openai.batches'] += 1
+        return self.batches[batch_id]
+
+
+class FakeOpenAI:
+    replay = None
+
+    def __init__(self, api_key=None, **kwargs):
+        self.api_key = api_key
+        self.chat = types.SimpleNamespace(completions=FakeCompletions(FakeOpenAI.replay))
+        self.files = FakeFiles()
+        self.batches = FakeBatches(FakeOpenAI.replay)
+
+
+class FakeAsyncOpenAI:
+    def __init__(self, api_key=None, **kwargs):
+        self.api_key = api_key
+        self.chat = types.SimpleNamespace(completions=FakeAsyncCompletions(FakeOpenAI.replay))
+
+
+#### Twitter
+class TweepyException(Exception):
+    pass
+
+
+class TooManyRequests(TweepyException):
+    def __init__(self, response=None):
+        super().__init__('429 Too Many Requests')
+        self.response = response
+
+
+TwitterResponse = collections.namedtuple('Response', ('data', 'includes', 'errors', 'meta'))
+
+
+class FakeTwitterClient:
+    """Accepts every tweet and returns a tweepy-style response."""
+
+    latency_ms = 0.0  # simulated latency of a post
+
+    def __init__(self, *args, **kwargs):
+        self.ids = itertools.count(1700000000000000000)
+
+    def _post(self, text):
+        calls['twitter.create_tweet'] += 1
+        data = {'id': str(next(self.ids)), 'text': text, 'edit_history_tweet_ids': []}
+        return TwitterResponse(data=data, includes={}, errors=[], meta={})
+
+    def create_tweet(self, text=None, **kwargs):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        return self._post(text)
+
+
+class FakeAsyncTwitterClient(FakeTwitterClient):
+    """tweepy.asynchronous.AsyncClient stand-in."""
+
+    async def create_tweet(self, text=None, **kwargs):
+        await asyncio.sleep(self.latency_ms / 1000)
+        return self._post(text)
+
+
+#### Blob Storage
+class HttpResponseError(Exception):
+    pass
+
+
+class ResourceNotFoundError(HttpResponseError):
+    pass
+
+
+class ResourceExistsError(HttpResponseError):
+    pass
+
+
+class ResourceModifiedError(HttpResponseError):
+    pass
+
+
+class MatchConditions:
+    Unconditionally = 1
+    IfNotModified = 2
+    IfModified = 3
+    IfPresent = 4
+    IfMissing = 5
+
+
+class FakeDownload:
+    def __init__(self, data, etag):
+        self.data = data
+        self.properties = types.SimpleNamespace(etag=etag)
+
+    def readall(self):
+        return self.data
+
+    def content_as_text(self, encoding='utf-8'):
+        return self.data.decode(encoding)
+
+
+class FakeLease:
+    def __init__(self, blob_client, duration):
+        self.blob_client = blob_client
+        self.id = uuid.uuid4().hex
+        self.duration = duration
+        self.expires = time.monotonic() + duration
+
+    def renew(self, **kwargs):
+        calls['blob.lease'] += 1
+        holder = self.blob_client.store.leases.get(self.blob_client.key)
+        if holder is not self and holder is not None and holder.expires > time.monotonic():
+            raise HttpResponseError('LeaseIdMismatchWithLeaseOperation')
+        self.expires = time.monotonic() + self.duration
+        self.blob_client.store.leases[self.blob_client.key] = self
+
+    def release(self, **kwargs):
+        calls['blob.lease'] += 1
+        if self.blob_client.store.leases.get(self.blob_client.key) is self:
+            del self.blob_client.store.leases[self.blob_client.key]
+
+
+class FakeBlobClient:
+    def __init__(self, store, container, blob):
+        self.store = store
+        self.container_name = container
+        self.blob_name = blob
+
+    @property
+    def key(self):
+        return (self.container_name, self.blob_name)
+
+    def etag(self):
+        return f'"0x{self.store.versions.get(self.key, 0):x}"'
+
+    def _write(self, data):
+        self.store.blobs[self.key] = data
+        self.store.versions[self.key] = self.store.versions.get(self.key, 0) + 1
+        return {'etag': self.etag(), 'last_modified': time.time()}
+
+    def exists(self):
+        calls['blob.exists'] += 1
+        return self.key in self.store.blobs
+
+    def upload_blob(self, data, blob_type='BlockBlob', overwrite=False, etag=None, match_condition=None, **kwargs):
+        calls['blob.upload'] += 1
+        if self.key in self.store.blobs and not overwrite:
+            raise ResourceExistsError(self.blob_name)
+        if match_condition == MatchConditions.IfNotModified and etag != self.etag():
+            raise ResourceModifiedError(self.blob_name)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        elif not isinstance(data, bytes):
+            data = data.read()
+        return self._write(data)
+
+    def append_block(self, data, **kwargs):
+        calls['blob.append'] += 1
+        if self.key not in self.store.blobs:
+            raise ResourceNotFoundError(self.blob_name)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return self._write(self.store.blobs[self.key] + data)
+
+    def download_blob(self, **kwargs):
+        calls['blob.download'] += 1
+        if self.key not in self.store.blobs:
+            raise ResourceNotFoundError(self.blob_name)
+        return FakeDownload(self.store.blobs[self.key], self.etag())
+
+    def delete_blob(self, **kwargs):
+        calls['blob.delete'] += 1
+        self.store.blobs.pop(self.key, None)
+
+    def acquire_lease(self, lease_duration=-1, **kwargs):
+        calls['blob.lease'] += 1
+        holder = self.store.leases.get(self.key)
+        if holder is not None and holder.expires > time.monotonic():
+            raise ResourceExistsError('LeaseAlreadyPresent')
+        lease = FakeLease(self, lease_duration if lease_duration > 0 else 10 ** 9)
+        self.store.leases[self.key] = lease
+        return lease
+
+    def get_blob_properties(self, **kwargs):
+        calls['blob.properties'] += 1
+        if self.key not in self.store.blobs:
+            raise ResourceNotFoundError(self.blob_name)
+        return types.SimpleNamespace(etag=self.etag(), metadata=dict(self.store.metadata.get(self.key, {})),
+                                     size=len(self.store.blobs[self.key]))
+
+    def set_blob_metadata(self, metadata=None, **kwargs):
+        calls['blob.metadata'] += 1
+        self.store.metadata[self.key] = dict(metadata or {})
+        self.store.versions[self.key] = self.store.versions.get(self.key, 0) + 1
+        return {'etag': self.etag()}
+
+
+class FakeContainerClient:
+    def __init__(self, store, name):
+        self.store = store
+        self.container_name = name
+
+    def exists(self):
+        calls['blob.container_exists'] += 1
+        return self.container_name in self.store.containers
+
+    def get_blob_client(self, blob):
+        return FakeBlobClient(self.store, self.container_name, blob)
+
+
+class BlobStore:
+    """In-memory blob account shared by every client created during a run."""
+
+    def __init__(self):
+        self.containers = set()
+        self.blobs = {}
+        self.versions = {}
+        self.metadata = {}
+        self.leases = {}
+
+    def reset(self):
+        for state in [self.containers, self.blobs, self.versions, self.metadata, self.leases]:
+            state.clear()
+
+
+class FakeBlobServiceClient:
+    store = BlobStore()
+
+    def __init__(self, account_url=None, credential=None, **kwargs):
+        self.account_url = account_url
+
+    def get_container_client(self, container):
+        return FakeContainerClient(self.store, container)
+
+    def create_container(self, container):
+        calls['blob.create_container'] += 1
+        self.store.containers.add(container)
+        return FakeContainerClient(self.store, container)
+
+    def get_blob_client(self, container, blob):
+        return FakeBlobClient(self.store, container, blob)
+
+
+class FakeAsyncDownload(FakeDownload):
+    async def readall(self):
+        return self.data
+
+    async def content_as_text(self, encoding='utf-8'):
+        return self.data.decode(encoding)
+
+
+class FakeAsyncBlobClient:
+    """azure.storage.blob.aio blob client: the in-memory blob client behind coroutines."""
+
+    def __init__(self, store, container, blob):
+        self.blob_client = FakeBlobClient(store, container, blob)
+        self.container_name = container
+        self.blob_name = blob
+
+    async def exists(self):
+        return self.blob_client.exists()
+
+    async def upload_blob(self, data, **kwargs):
+        return self.blob_client.upload_blob(data, **kwargs)
+
+    async def append_block(self, data, **kwargs):
+        return self.blob_client.append_block(data, **kwargs)
+
+    async def download_blob(self, **kwargs):
+        download = self.blob_client.download_blob(**kwargs)
+        return FakeAsyncDownload(download.data, download.properties.etag)
+
+    async def delete_blob(self, **kwargs):
+        return self.blob_client.delete_blob(**kwargs)
+
+
+class FakeAsyncContainerClient(FakeContainerClient):
+    async def exists(self):
+        return super().exists()
+
+    def get_blob_client(self, blob):
+        return FakeAsyncBlobClient(self.store, self.container_name, blob)
+
+
+class FakeAsyncBlobServiceClient(FakeBlobServiceClient):
+    def get_container_client(self, container):
+        return FakeAsyncContainerClient(self.store, container)
+
+    async def create_container(self, container):
+        super().create_container(container)
+        return FakeAsyncContainerClient(self.store, container)
+
+    def get_blob_client(self, container, blob):
+        return FakeAsyncBlobClient(self.store, container, blob)
+
+
+#### HTTP
+class FakeResponse:
+    def __init__(self, status_code=200, text='', json_data=None, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self._json = json_data
+        self.text = json.dumps(json_data) if json_data is not None else text
+        self.content = self.text.encode('utf-8')
+
+    def json(self):
+        return self._json if self._json is not None else json.loads(self.text)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise HTTPError(f'{self.status_code} Error')
+
+
+class RequestException(Exception):
+    pass
+
+
+class HTTPError(RequestException):
+    pass
+
+
+class Timeout(RequestException):
+    pass
+
+
+class ConnectionError(RequestException):
+    pass
+
+
+class ConnectTimeout(ConnectionError, Timeout):
+    pass
+
+
+class ReadTimeout(Timeout):
+    pass
+
+
+class FakeHttp:
+    """Routes `requests` calls to local handlers by URL prefix."""
+
+    def __init__(self):
+        self.routes = []
+
+    def route(self, prefix, handler):
+        self.routes.append((prefix, handler))
+
+    def request(self, method, url, params=None, headers=None, data=None, json=None, timeout=None, **kwargs):
+        for prefix, handler in self.routes:
+            if url.startswith(prefix):
+                calls[f'http.{urllib.parse.urlsplit(prefix).hostname}'] += 1
+                return handler(method, url, params or {}, headers or {}, data if json is None else json)
+        raise RequestException(f'No stand-in route for {url}')
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+class FakeAsyncHttpClient:
+    """httpx.AsyncClient stand-in that routes through the FakeHttp of the run."""
+
+    http = None
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    async def get(self, url, **kwargs):
+        return self.http.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return self.http.request('POST', url, **kwargs)
+
+    async def aclose(self):
+        pass
+
+
+def query_params(url, params=None):
+    """Merge the query string of `url` with explicit params."""
+    parsed = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(url).query, keep_blank_values=True))
+    parsed.update(params or {})
+    return parsed
+
+
+def bing_handler(candidates):
+    """Serve the Bing News Search response from a list of candidate dicts."""
+    def handler(method, url, params, headers, body):
+        return FakeResponse(json_data={'value': candidates()})
+    return handler
+
+
+def tinyurl_handler(method, url, params, headers, body):
+    target = query_params(url, params).get('url', '')
+    return FakeResponse(text=f'https://tinyurl.com/{uuid.uuid5(uuid.NAMESPACE_URL, target).hex[:8]}')
+
+
+#### Clock
+class SimulatedClock:
+    """Stand-in for the time module whose time() is moved forward by the scenario."""
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+#### Module installation
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    return module
+
+
+def install(replay, http):
+    """Register the stand-ins in sys.modules before the function apps are imported."""
+    FakeOpenAI.replay = replay
+    FakeAsyncHttpClient.http = http
+    openai = _module('openai', OpenAI=FakeOpenAI, AsyncOpenAI=FakeAsyncOpenAI, api_key=None,
+                     APIError=APIError, APIConnectionError=APIConnectionError, APITimeoutError=APITimeoutError,
+                     APIStatusError=APIStatusError, RateLimitError=RateLimitError,
+                     chat=types.SimpleNamespace(completions=FakeCompletions(replay)),
+                     files=FakeFiles(), batches=FakeBatches(replay))
+    requests = _module('requests', get=http.get, post=http.post, request=http.request,
+                       Response=FakeResponse, RequestException=RequestException,
+                       HTTPError=HTTPError, Timeout=Timeout, ConnectionError=ConnectionError,
+                       ConnectTimeout=ConnectTimeout, ReadTimeout=ReadTimeout,
+                       exceptions=_module('requests.exceptions', RequestException=RequestException,
+                                          HTTPError=HTTPError, Timeout=Timeout, ConnectionError=ConnectionError,
+                                          ConnectTimeout=ConnectTimeout, ReadTimeout=ReadTimeout))
+    modules = {
+        'openai': openai,
+        'requests': requests,
+        'requests.exceptions': requests.exceptions,
+        'tweepy': _module('tweepy', Client=FakeTwitterClient, Response=TwitterResponse,
+                          TweepyException=TweepyException, TooManyRequests=TooManyRequests),
+        'tweepy.asynchronous': _module('tweepy.asynchronous', AsyncClient=FakeAsyncTwitterClient),
+        'httpx': _module('httpx', AsyncClient=FakeAsyncHttpClient, HTTPError=RequestException,
+                         HTTPStatusError=HTTPError, TimeoutException=Timeout),
+        'azure.identity': _module('azure.identity', DefaultAzureCredential=FakeCredential),
+        'azure.keyvault': _module('azure.keyvault'),
+        'azure.keyvault.secrets': _module('azure.keyvault.secrets', SecretClient=FakeSecretClient),
+        'azure.storage': _module('azure.storage'),
+        'azure.storage.blob': _module('azure.storage.blob', BlobServiceClient=FakeBlobServiceClient,
+                                      BlobClient=FakeBlobClient, ContainerClient=FakeContainerClient),
+        'azure.storage.blob.aio': _module('azure.storage.blob.aio', BlobServiceClient=FakeAsyncBlobServiceClient,
+                                          BlobClient=FakeAsyncBlobClient, ContainerClient=FakeAsyncContainerClient),
+        'azure.core': _module('azure.core', MatchConditions=MatchConditions),
+        'azure.core.exceptions': _module('azure.core.exceptions', HttpResponseError=HttpResponseError,
+                                         ResourceNotFoundError=ResourceNotFoundError,
+                                         ResourceExistsError=ResourceExistsError,
+                                         ResourceModifiedError=ResourceModifiedError),
+        'newspaper': _module('newspaper', Article=object),
+        'bs4': _module('bs4', BeautifulSoup=object),
+        'hackernews': _module('hackernews', HackerNews=object),
+    }
+    sys.modules.update(modules)
+    return modules
@@ -0,0 +1,542 @@
+"""Offline benchmark for the bot functions.
+
+Every external dependency is replaced by a stand-in from `benchmarks.fakes`, so
+the functions can be driven at scale without credentials or network access:
+
+    python -m benchmarks.run --scales 100,1000,10000 --history 16,1000 --save bench.json
+    python -m benchmarks.run --baseline bench.json --tolerance 0.25
+
+With `--baseline` the run exits non-zero when a scenario regresses.
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import importlib
+import inspect
+import io
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.parse
+
+from benchmarks import fakes
+
+# Constants
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'benchmarks', 'fixtures', 'completions.json')
+FUNCTION_APP_URL = 'https://relatalyfunc.azurewebsites.net/api/'
+BING_URL = 'https://api.bing.microsoft.com/v7.0/news/search'
+TINYURL_URL = 'https://tinyurl.com/api-create.php'
+TOPICS = ['Nvidia', 'OpenAI', 'Robotics', 'Toyota', 'PyTorch', 'Elections', 'Football', 'Anthropic']
+LOAD_REQUESTS = 32  # concurrent tweet requests per invocation of the load scenarios
+LOAD_LLM_LATENCY_MS = 50.0  # service latencies of the load scenarios, so that requests wait on I/O
+LOAD_TWITTER_LATENCY_MS = 20.0
+SYNC_WORKER_THREADS = 5  # thread pool of the Python worker for sync functions, min(32, cores + 4) on one core
+
+# Globals
+state = {'candidates': lambda: [], 'replay': None}  # Bing results served by the stand-in
+modules = {}
+loop = asyncio.new_event_loop()  # runs the async functions, as the worker's event loop does
+
+
+#### Stand-in data
+def make_candidates(count):
+    """Create `count` distinct Bing news results."""
+    return [{
+        'name': f'{TOPICS[i % len(TOPICS)]} headline {i}: new results announced',
+        'description': f'Description of story {i} about {TOPICS[i % len(TOPICS)]}.',
+        'url': f'https://news.example.com/story/{i}',
+    } for i in range(count)]
+
+
+def seed_storage(history):
+    """Reset blob storage and seed every history log with `history` entries."""
+    store = fakes.FakeBlobServiceClient.store
+    store.reset()
+    store.containers.add('botdata')
+    titles = '\n'.join(['title'] + [f'Old headline number {i}' for i in range(history)]) + '\n'
+    terms = '\n'.join(['term'] + [f'term {i}' for i in range(history)]) + '\n'
+    quotes = ''.join(f"'Old stoic quote {i}' - Seneca\n" for i in range(history))
+    store.blobs[('botdata', 'news_log.csv')] = titles.encode('utf-8')
+    store.blobs[('botdata', 'facts_log_test.csv')] = terms.encode('utf-8')
+    store.blobs[('botdata', 'stoic_quotes_log_test')] = quotes.encode('utf-8')
+    # Drop in-memory caches of blobs that were just reset
+    if 'HttpCreateTwitterTweet' in modules:
+        modules['HttpCreateTwitterTweet'].link_shortener.cache.links = None
+
+
+def function_app_handler(method, url, params, headers, body):
+    """Dispatch a call to the function app into the in-process function."""
+    name = urllib.parse.urlsplit(url).path.rsplit('/', 1)[-1]
+    req = modules['azure.functions'].HttpRequest(
+        method=method, url=url, params=fakes.query_params(url, params), headers=headers,
+        body=json.dumps(body).encode('utf-8') if body is not None else b'')
+    try:
+        resp = call_function(name, req)
+    except Exception as ex:
+        return fakes.FakeResponse(status_code=500, text=repr(ex))
+    return fakes.FakeResponse(status_code=resp.status_code, text=resp.get_body().decode('utf-8'))
+
+
+def call_function(name, req):
+    """Invoke a function app's main; async functions run on the bench's event loop."""
+    result = modules[name].main(req)
+    return loop.run_until_complete(result) if inspect.isawaitable(result) else result
+
+
+def load_functions(latency_ms):
+    """Install the stand-ins and import every function app."""
+    with open(FIXTURES, encoding='utf-8') as f:
+        replay = fakes.Replay(json.load(f), latency_ms=latency_ms)
+    state['replay'] = replay
+    http = fakes.FakeHttp()
+    http.route(BING_URL, fakes.bing_handler(lambda: state['candidates']()))
+    http.route(TINYURL_URL, fakes.tinyurl_handler)
+    http.route(FUNCTION_APP_URL, function_app_handler)
+    fakes.install(replay, http)
+
+    sys.path[:0] = [ROOT, os.path.join(ROOT, 'HttpCreateStoicQuote')]
+    modules['azure.functions'] = importlib.import_module('azure.functions')
+    seed_storage(0)
+    fakes.reset_calls()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for name in ['NewsTrigger', 'HttpCreateTwitterTweet', 'HttpCreateTwitterFactTweet',
+                     'HttpCreateTwitterTweetRaw', 'HttpCreateStoicQuote']:
+            modules[name] = importlib.import_module(name)
+    return dict(fakes.calls)
+
+
+#### Scenarios
+def timer():
+    from azure.functions.timer import TimerRequest
+    return TimerRequest(past_due=False)
+
+
+def http_request(name, params):
+    return modules['azure.functions'].HttpRequest(
+        method='GET', url=f'{FUNCTION_APP_URL}{name}', params=params, body=b'')
+
+
+def run_news_trigger(scale):
+    candidates = make_candidates(scale)
+    state['candidates'] = lambda: candidates
+    return lambda: modules['NewsTrigger'].main(timer())
+
+
+def run_news_main_bot(scale):
+    news = modules['NewsTrigger']
+    df = news.pd.DataFrame([
+        {'title': c['name'], 'description': c['description'], 'url': c['url']} for c in make_candidates(scale)])
+
+    def invoke():
+        coordinator = news.run_coordinator.make_coordinator(news.blob_service_client, news.CONTAINER_NAME, news.RUN_NAME)
+        coordinator.acquire()
+        try:
+            news.main_bot(df.copy(), coordinator)
+        finally:
+            coordinator.release()
+    return invoke
+
+
+def run_news_tenants(scale):
+    """Twelve tenants with distinct topics sharing one ingestion pass."""
+    news = modules['NewsTrigger']
+    df = news.pd.DataFrame([
+        {'title': c['name'], 'description': c['description'], 'url': c['url']} for c in make_candidates(scale)])
+    tenants = [{**news.TENANT_DEFAULTS, 'name': f'tenant{i}', 'account': f'tenant{i}', 'topics': f'[{topic}]',
+                'history_blob': 'news_log.csv' if i == 0 else f'news_log_tenant{i}.csv',
+                'backlog_blob': f'news_backlog_tenant{i}.json'}
+               for i, topic in enumerate(TOPICS + TOPICS[:4])]
+
+    def invoke():
+        coordinator = news.run_coordinator.make_coordinator(news.blob_service_client, news.CONTAINER_NAME, news.RUN_NAME)
+        coordinator.acquire()
+        try:
+            news.main_bot(df.copy(), coordinator, tenants)
+        finally:
+            coordinator.release()
+    return invoke
+
+
+def run_news_trigger_tight(scale):
+    """Timer ticks with a 25 second SLO: optional stages are skipped, persisting still happens."""
+    candidates = make_candidates(scale)
+    state['candidates'] = lambda: candidates
+    news = modules['NewsTrigger']
+
+    def invoke():
+        os.environ['FUNCTION_SLO_SECONDS'] = '25'
+        try:
+            news.main(timer())
+        finally:
+            del os.environ['FUNCTION_SLO_SECONDS']
+    return invoke
+
+
+def run_news_openai_timeout(scale):
+    """Timer ticks on which every OpenAI request times out: the backlog and scheduler state are still saved.
+
+    The scheduler state is kept, so ticks after the first poll only run to
+    retry the candidates the failed relevance call left unscored.
+    """
+    candidates = make_candidates(scale)
+    state['candidates'] = lambda: candidates
+    news = modules['NewsTrigger']
+
+    def invoke():
+        fakes.FakeCompletions.fail_with = fakes.APITimeoutError
+        try:
+            news.main(timer())
+        finally:
+            fakes.FakeCompletions.fail_with = None
+    return invoke
+
+
+def news_day_arrivals():
+    """Minutes after midnight at which stories appear: a quiet night, a morning burst, then a trickle."""
+    return list(range(6 * 60, 8 * 60, 5)) + list(range(8 * 60, 24 * 60, 45))
+
+
+def run_news_day(scale):
+    """A simulated day of 10 minute timer ticks; one invocation is 144 ticks."""
+    news = modules['NewsTrigger']
+    arrivals = news_day_arrivals()
+    days = itertools.count()
+    midnight = 1767225600  # 2026-01-01 00:00 UTC
+
+    def invoke():
+        day = next(days)
+        clock = fakes.SimulatedClock(midnight + day * 86400)
+        stories = [{'name': f'{TOPICS[i % len(TOPICS)]} day {day} story {i}: new results announced',
+                    'description': f'Story {i} of day {day}.', 'url': f'https://news.example.com/{day}/{i}'}
+                   for i in range(len(arrivals))]
+        # Bing returns the ten latest stories that have appeared by now
+        state['candidates'] = lambda: [stories[i] for i, minute in enumerate(arrivals)
+                                       if midnight + day * 86400 + minute * 60 <= clock.now][::-1][:10]
+        news.time = clock
+        try:
+            for tick in range(144):
+                clock.now = midnight + day * 86400 + tick * 600
+                news.main(timer())
+        finally:
+            news.time = time
+    return invoke
+
+
+def tweet_requests():
+    """Requests to HttpCreateTwitterTweet, each about a different article."""
+    return (http_request('HttpCreateTwitterTweet', {'title': c['name'], 'description': c['description'],
+                                                    'url': c['url']})
+            for c in make_candidates(10 ** 6))
+
+
+def run_http_tweet(scale):
+    requests = tweet_requests()
+    return lambda: call_function('HttpCreateTwitterTweet', next(requests))
+
+
+def run_http_tweet_retry(scale):
+    """Tweets about the same ten articles, as when articles are regenerated or retried."""
+    candidates = itertools.cycle(make_candidates(10))
+
+    def invoke():
+        c = next(candidates)
+        call_function('HttpCreateTwitterTweet', http_request(
+            'HttpCreateTwitterTweet', {'title': c['name'], 'description': c['description'], 'url': c['url']}))
+    return invoke
+
+
+def run_http_tweet_profiled(scale):
+    """Tweet requests with a signed profile header; the profiles are written to the scratch directory."""
+    from shared_code import profiler
+    requests = tweet_requests()
+
+    def invoke():
+        req = next(requests)
+        os.environ.update({profiler.SIGNING_KEY_SETTING: 'bench-key', profiler.LOCAL_DIR_SETTING: os.getcwd()})
+        try:
+            call_function('HttpCreateTwitterTweet', modules['azure.functions'].HttpRequest(
+                method=req.method, url=req.url, params=dict(req.params), body=b'',
+                headers={profiler.PROFILE_HEADER: profiler.sign('HttpCreateTwitterTweet', 'bench-key')}))
+        finally:
+            del os.environ[profiler.SIGNING_KEY_SETTING], os.environ[profiler.LOCAL_DIR_SETTING]
+    return invoke
+
+
+@contextlib.contextmanager
+def load_latency():
+    """Simulated OpenAI and Twitter latency of the load scenarios."""
+    replay = state['replay']
+    saved = replay.latency_ms, fakes.FakeTwitterClient.latency_ms
+    replay.latency_ms = max(replay.latency_ms, LOAD_LLM_LATENCY_MS)
+    fakes.FakeTwitterClient.latency_ms = LOAD_TWITTER_LATENCY_MS
+    try:
+        yield
+    finally:
+        replay.latency_ms, fakes.FakeTwitterClient.latency_ms = saved
+
+
+def run_http_load_async(scale):
+    """LOAD_REQUESTS tweet requests in flight at once on one event loop."""
+    requests = tweet_requests()
+    main = modules['HttpCreateTwitterTweet'].main
+
+    async def burst():
+        await asyncio.gather(*[main(next(requests)) for _ in range(LOAD_REQUESTS)])
+
+    def invoke():
+        with load_latency():
+            loop.run_until_complete(burst())
+    invoke.requests = LOAD_REQUESTS
+    return invoke
+
+
+def run_http_load_threads(scale):
+    """The same requests with the concurrency of a sync function: one request per worker thread."""
+    requests = tweet_requests()
+    main = modules['HttpCreateTwitterTweet'].main
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=SYNC_WORKER_THREADS)
+
+    def invoke():
+        with load_latency():
+            list(pool.map(lambda req: asyncio.run(main(req)), [next(requests) for _ in range(LOAD_REQUESTS)]))
+    invoke.requests = LOAD_REQUESTS
+    return invoke
+
+
+def run_http_fact(scale):
+    return lambda: call_function('HttpCreateTwitterFactTweet', http_request('HttpCreateTwitterFactTweet', {}))
+
+
+def run_http_raw(scale):
+    return lambda: call_function('HttpCreateTwitterTweetRaw',
+                                 http_request('HttpCreateTwitterTweetRaw', {'tweet': 'Benchmark post #AI'}))
+
+
+def run_http_raw_bulk(scale):
+    """One bulk request with 50 posts, two of them over the length limit."""
+    posts = [{'tweet': f'Scheduled post {i} about #AI https://news.example.com/story/{i}'} for i in range(48)]
+    posts += [{'tweet': 'x' * 300}, {'tweet': '長' * 141}]
+    body = json.dumps(posts).encode('utf-8')
+    return lambda: call_function('HttpCreateTwitterTweetRaw', modules['azure.functions'].HttpRequest(
+        method='POST', url=f'{FUNCTION_APP_URL}HttpCreateTwitterTweetRaw', params={}, body=body))
+
+
+def run_stoic_timer(scale):
+    return lambda: modules['HttpCreateStoicQuote'].main(timer())
+
+
+# name -> (factory, whether the scenario depends on the candidate scale)
+SCENARIOS = {
+    'news_trigger': (run_news_trigger, True),
+    'news_main_bot': (run_news_main_bot, True),
+    'news_tenants': (run_news_tenants, True),
+    'news_trigger_tight': (run_news_trigger_tight, True),
+    'news_openai_timeout': (run_news_openai_timeout, True),
+    'news_day': (run_news_day, False),
+    'http_tweet': (run_http_tweet, False),
+    'http_tweet_retry': (run_http_tweet_retry, False),
+    'http_tweet_profiled': (run_http_tweet_profiled, False),
+    'http_load_threads': (run_http_load_threads, False),
+    'http_load_async': (run_http_load_async, False),
+    'http_fact': (run_http_fact, False),
+    'http_raw': (run_http_raw, False),
+    'http_raw_bulk': (run_http_raw_bulk, False),
+    'stoic_timer': (run_stoic_timer, False),
+}
+
+
+#### Measurement
+def model_routers():
+    return [module.router for module in modules.values() if hasattr(module, 'router')]
+
+
+def routing_report():
+    """Escalation rates per LLM task, merged over the model routers of all functions."""
+    from shared_code.openai_client import ModelRouter
+    merged = ModelRouter(None, policies={})
+    for router in model_routers():
+        for task, stats in router.stats.items():
+            merged.stats[task].update(stats)
+    return merged.report()
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a list of numbers."""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def measure(name, scale, history, repeat):
+    """Run one scenario `repeat` times and collect latency, memory and call counts."""
+    factory, _ = SCENARIOS[name]
+    seed_storage(history)
+    random.seed(0)
+    invoke = factory(scale)
+    fakes.reset_calls()
+    for router in model_routers():
+        router.stats.clear()
+    latencies, errors = [], []
+    with contextlib.redirect_stdout(io.StringIO()):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            try:
+                invoke()
+            except Exception as ex:
+                errors.append(repr(ex))
+            latencies.append(time.perf_counter() - t0)
+        elapsed = time.perf_counter() - started
+        calls = {key: value / repeat for key, value in sorted(fakes.calls.items())}
+        routing = routing_report()
+
+        # Peak memory is taken from one extra traced invocation so that
+        # tracemalloc does not distort the latency figures
+        tracemalloc.start()
+        try:
+            invoke()
+        except Exception:
+            pass
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        'scenario': name,
+        'scale': scale,
+        'history': history,
+        'invocations': repeat,
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+        'throughput_per_s': round(repeat / elapsed, 2) if elapsed else None,
+        'requests_per_invocation': getattr(invoke, 'requests', 1),
+        'requests_per_s': round(repeat * getattr(invoke, 'requests', 1) / elapsed, 2) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'peak_memory_kb': round(peak / 1024, 1),
+        'calls_per_invocation': calls,
+        'routing': routing,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return a list of regressions of `results` against a baseline run."""
+    previous = {(r['scenario'], r['scale'], r['history']): r for r in baseline['results']}
+    regressions = []
+    for r in results:
+        old = previous.get((r['scenario'], r['scale'], r['history']))
+        if old is None:
+            continue
+        label = f"{r['scenario']} scale={r['scale']} history={r['history']}"
+        for metric in ['p50_ms', 'p99_ms', 'peak_memory_kb']:
+            if old[metric] and r[metric] > old[metric] * (1 + tolerance):
+                regressions.append(f'{label}: {metric} {old[metric]} -> {r[metric]}')
+        if r['errors'] > old['errors']:
+            regressions.append(f"{label}: errors {old['errors']} -> {r['errors']}")
+        for key, value in r['calls_per_invocation'].items():
+            if value > old['calls_per_invocation'].get(key, 0) + 1e-9:
+                regressions.append(f"{label}: {key} calls {old['calls_per_invocation'].get(key, 0)} -> {value}")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(results):
+    print(f"{'scenario':<20}{'scale':>7}{'history':>9}{'inv/s':>10}{'p50 ms':>10}{'p99 ms':>10}"
+          f"{'peak KB':>11}{'errors':>8}  external calls / invocation")
+    for r in results:
+        calls = ', '.join(f'{k}={v:g}' for k, v in r['calls_per_invocation'].items()
+                          if not k.startswith('openai.chat.'))
+        print(f"{r['scenario']:<20}{r['scale']:>7}{r['history']:>9}{r['throughput_per_s']:>10}{r['p50_ms']:>10}"
+              f"{r['p99_ms']:>10}{r['peak_memory_kb']:>11}{r['errors']:>8}  {calls}")
+
+
+def print_load(results):
+    rows = [r for r in results if r.get('requests_per_invocation', 1) > 1]
+    if not rows:
+        return
+    print()
+    print(f"{'scenario':<20}{'requests':>10}{'req/s':>10}")
+    for r in rows:
+        print(f"{r['scenario']:<20}{r['requests_per_invocation']:>10}{r['requests_per_s']:>10}")
+
+
+def print_routing(results):
+    rows = [(r, task, entry) for r in results for task, entry in r.get('routing', {}).items()]
+    if not rows:
+        return
+    print()
+    print(f"{'scenario':<20}{'task':<18}{'calls':>7}{'escalated':>11}{'failed':>8}  calls per model")
+    for r, task, entry in rows:
+        models = ', '.join(f'{model}={count}' for model, count in entry['models'].items())
+        print(f"{r['scenario']:<20}{task:<18}{entry['calls']:>7}{entry['escalation_rate']:>11.1%}"
+              f"{entry['failure_rate']:>8.1%}  {models}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated scenario names')
+    parser.add_argument('--scales', default='100,1000', help='candidate counts served by the Bing stand-in')
+    parser.add_argument('--history', default='16,1000', help='entries pre-seeded into each history log')
+    parser.add_argument('--repeat', type=int, default=20, help='invocations per scenario')
+    parser.add_argument('--llm-latency-ms', type=float, default=0.0, help='simulated OpenAI latency')
+    parser.add_argument('--save', help='write the results as JSON to this path')
+    parser.add_argument('--baseline', help='compare against a previously saved run')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown')
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.CRITICAL)
+    # Paths given on the command line are relative to where the bench was started, not the scratch directory
+    save = os.path.abspath(args.save) if args.save else None
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    # Functions that write local files do so in a scratch directory
+    os.chdir(tempfile.mkdtemp(prefix='bench-'))
+    cold_start_calls = load_functions(args.llm_latency_ms)
+
+    results = []
+    for name in args.scenarios.split(','):
+        scales = [int(s) for s in args.scales.split(',')] if SCENARIOS[name][1] else [0]
+        for scale in scales:
+            for history in [int(h) for h in args.history.split(',')]:
+                results.append(measure(name, scale, history, args.repeat))
+
+    run = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'config': vars(args),
+        'cold_start_calls': cold_start_calls,
+        'results': results,
+    }
+    print_table(results)
+    print_load(results)
+    print_routing(results)
+    if save:
+        with open(save, 'w', encoding='utf-8') as f:
+            json.dump(run, f, indent=2)
+
+    if baseline:
+        with open(baseline, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
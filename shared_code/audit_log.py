@@ -0,0 +1,296 @@
+import atexit
+import datetime as dt
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from shared_code.run_coordinator import (AsyncBlobDocument, BlobDocument, FileDocument, MAX_CONFLICT_RETRIES,
+                                         WriteConflict)
+
+# Constants
+PREFIX = 'tweet_audit'
+MAX_BUFFERED_RECORDS = 50
+MAX_BUFFERED_SECONDS = 30.0
+MAX_BLOCK_BYTES = 4 * 1024 * 1024  # append blob block limit
+LOCAL_DIR_SETTING = 'AUDIT_LOG_DIR'  # app setting that selects the local backend
+
+
+def add_counts(data, counts):
+    """Index document content with per-day record and byte counts added."""
+    index = json.loads(data) if data else {}
+    for day, (records, size) in counts.items():
+        entry = index.setdefault(day, {'records': 0, 'bytes': 0})
+        entry['records'] += records
+        entry['bytes'] += size
+    return json.dumps(index, sort_keys=True)
+
+
+def update_index(document, counts):
+    """Add per-day record and byte counts to the index document."""
+    for _ in range(MAX_CONFLICT_RETRIES):
+        data = add_counts(document.read(), counts)
+        try:
+            document.write(data)
+            return
+        except WriteConflict:
+            continue
+    logging.error('Audit log index is busy, counts not updated')
+
+
+async def aupdate_index(document, counts):
+    """update_index() for an async document; a file document is updated directly."""
+    for _ in range(MAX_CONFLICT_RETRIES):
+        data = document.read()
+        data = add_counts(await data if inspect.isawaitable(data) else data, counts)
+        try:
+            result = document.write(data)
+            if inspect.isawaitable(result):
+                await result
+            return
+        except WriteConflict:
+            continue
+    logging.error('Audit log index is busy, counts not updated')
+
+
+#### Backends
+class BlobAuditBackend:
+    """One append blob of JSON lines per day, plus a small index.json of the days present."""
+
+    def __init__(self, blob_service_client, container, prefix=PREFIX):
+        self.blob_service_client = blob_service_client
+        self.container = container
+        self.prefix = prefix
+        self.index = BlobDocument(blob_service_client.get_blob_client(container=container, blob=f'{prefix}/index.json'))
+
+    def _blob(self, day):
+        return self.blob_service_client.get_blob_client(container=self.container, blob=f'{self.prefix}/{day}.jsonl')
+
+    def append(self, day, data):
+        blob_client = self._blob(day)
+        for start in range(0, len(data), MAX_BLOCK_BYTES):
+            block = data[start:start + MAX_BLOCK_BYTES]
+            try:
+                blob_client.append_block(block)
+            except ResourceNotFoundError:
+                try:
+                    blob_client.upload_blob(b'', blob_type='AppendBlob', overwrite=False)
+                except ResourceExistsError:
+                    pass
+                blob_client.append_block(block)
+
+    def read_index(self):
+        data = self.index.read()
+        return json.loads(data) if data else {}
+
+    def read_day(self, day):
+        try:
+            return self._blob(day).download_blob().content_as_text()
+        except ResourceNotFoundError:
+            return ''
+
+
+class AsyncBlobAuditBackend:
+    """BlobAuditBackend on an azure.storage.blob.aio service client."""
+
+    def __init__(self, blob_service_client, container, prefix=PREFIX):
+        self.blob_service_client = blob_service_client
+        self.container = container
+        self.prefix = prefix
+
+    @property
+    def index(self):
+        # A document per update, so concurrent flushes on one event loop do not share an etag
+        return AsyncBlobDocument(self.blob_service_client.get_blob_client(container=self.container,
+                                                                          blob=f'{self.prefix}/index.json'))
+
+    def _blob(self, day):
+        return self.blob_service_client.get_blob_client(container=self.container, blob=f'{self.prefix}/{day}.jsonl')
+
+    async def append(self, day, data):
+        blob_client = self._blob(day)
+        for start in range(0, len(data), MAX_BLOCK_BYTES):
+            block = data[start:start + MAX_BLOCK_BYTES]
+            try:
+                await blob_client.append_block(block)
+            except ResourceNotFoundError:
+                try:
+                    await blob_client.upload_blob(b'', blob_type='AppendBlob', overwrite=False)
+                except ResourceExistsError:
+                    pass
+                await blob_client.append_block(block)
+
+    async def read_index(self):
+        data = await self.index.read()
+        return json.loads(data) if data else {}
+
+    async def read_day(self, day):
+        try:
+            downloader = await self._blob(day).download_blob()
+        except ResourceNotFoundError:
+            return ''
+        return await downloader.content_as_text()
+
+
+class LocalAuditBackend:
+    """Local stand-in for BlobAuditBackend."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.index = FileDocument(os.path.join(directory, 'index.json'))
+
+    def append(self, day, data):
+        # A single O_APPEND write keeps concurrent writers from interleaving records
+        fd = os.open(os.path.join(self.directory, f'{day}.jsonl'), os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def read_index(self):
+        data = self.index.read()
+        return json.loads(data) if data else {}
+
+    def read_day(self, day):
+        try:
+            with open(os.path.join(self.directory, f'{day}.jsonl'), encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return ''
+
+
+class AuditLog:
+    """Buffered audit log of published tweets.
+
+    Records are kept in memory and written as JSON lines in one append per
+    day when the buffer holds MAX_BUFFERED_RECORDS records or is older than
+    MAX_BUFFERED_SECONDS. Functions call flush() before they return so
+    nothing is lost when the worker is recycled. Async functions use an
+    async backend and call aflush() and arecent() instead; their buffer is
+    only written there.
+    """
+
+    def __init__(self, backend, source, max_records=MAX_BUFFERED_RECORDS, max_seconds=MAX_BUFFERED_SECONDS):
+        self.backend = backend
+        self.source = source
+        self.max_records = max_records
+        self.max_seconds = max_seconds
+        self.buffer = []
+        self.buffered_since = None
+        self.lock = threading.Lock()
+        self.asynchronous = inspect.iscoroutinefunction(backend.append)
+        if not self.asynchronous:
+            atexit.register(self.flush)
+
+    def record(self, tweet_id, text, latency_ms=None, tokens=None, **extra):
+        """Buffer one published tweet."""
+        now = dt.datetime.now(dt.timezone.utc)
+        entry = {'ts': now.isoformat(timespec='milliseconds'), 'source': self.source, 'tweet_id': tweet_id,
+                 'text': text, 'latency_ms': latency_ms, 'tokens': tokens, **extra}
+        with self.lock:
+            self.buffer.append(entry)
+            if self.buffered_since is None:
+                self.buffered_since = time.monotonic()
+            due = len(self.buffer) >= self.max_records or time.monotonic() - self.buffered_since >= self.max_seconds
+        if due and not self.asynchronous:
+            self.flush()
+
+    def _take(self):
+        """Empty the buffer; returns the records grouped by day."""
+        with self.lock:
+            records, self.buffer, self.buffered_since = self.buffer, [], None
+        days = {}
+        for entry in records:
+            days.setdefault(entry['ts'][:10], []).append(entry)
+        return days
+
+    def _restore(self, days, written, ex):
+        """Put the records of the days that were not written back in front of the buffer."""
+        records = [entry for day, entries in days.items() if day not in written for entry in entries]
+        logging.error(f'Audit log flush failed, keeping {len(records)} records buffered: {ex}')
+        with self.lock:
+            self.buffer[:0] = records
+            self.buffered_since = self.buffered_since or time.monotonic()
+
+    @staticmethod
+    def _encode(entries):
+        data = ''.join(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n' for entry in entries)
+        return data.encode('utf-8')
+
+    def flush(self):
+        """Write the buffered records; records that cannot be written stay buffered, nothing is raised."""
+        days = self._take()
+        counts = {}
+        try:
+            for day, entries in days.items():
+                data = self._encode(entries)
+                self.backend.append(day, data)
+                counts[day] = (len(entries), len(data))
+        except Exception as ex:
+            self._restore(days, counts, ex)
+        if counts:
+            # The records are written, a failed index update must not fail the publish path
+            try:
+                update_index(self.backend.index, counts)
+            except Exception as ex:
+                logging.error(f'Audit log index not updated: {ex}')
+            logging.info(f'Audit log flushed: {sum(c[0] for c in counts.values())} records')
+
+    async def aflush(self):
+        """flush() for async backends; a local backend is written directly."""
+        days = self._take()
+        counts = {}
+        try:
+            for day, entries in days.items():
+                data = self._encode(entries)
+                if self.asynchronous:
+                    await self.backend.append(day, data)
+                else:
+                    self.backend.append(day, data)
+                counts[day] = (len(entries), len(data))
+        except Exception as ex:
+            self._restore(days, counts, ex)
+        if counts:
+            try:
+                await aupdate_index(self.backend.index, counts)
+            except Exception as ex:
+                logging.error(f'Audit log index not updated: {ex}')
+            logging.info(f'Audit log flushed: {sum(c[0] for c in counts.values())} records')
+
+    @staticmethod
+    def _parse(data):
+        return [json.loads(line) for line in data.splitlines() if line.strip()]
+
+    def recent(self, days=1):
+        """Records of the most recent `days` days present in the index, oldest first; async backends use arecent()."""
+        if self.asynchronous:
+            raise TypeError('recent() needs a synchronous backend, use arecent()')
+        index = self.backend.read_index()
+        lines = []
+        for day in sorted(index)[-days:]:
+            lines += self._parse(self.backend.read_day(day))
+        return lines
+
+    async def arecent(self, days=1):
+        """recent() for async backends; a local backend is read directly."""
+        if not self.asynchronous:
+            return self.recent(days)
+        index = await self.backend.read_index()
+        lines = []
+        for day in sorted(index)[-days:]:
+            lines += self._parse(await self.backend.read_day(day))
+        return lines
+
+
+def make_audit_log(blob_service_client, container, source, backend=BlobAuditBackend):
+    """Audit log for one publishing path, backed by blob storage or a local directory.
+
+    Async functions pass an azure.storage.blob.aio client with backend=AsyncBlobAuditBackend.
+    """
+    local_dir = os.environ.get(LOCAL_DIR_SETTING)
+    if local_dir:
+        return AuditLog(LocalAuditBackend(local_dir), source)
+    return AuditLog(backend(blob_service_client, container), source)
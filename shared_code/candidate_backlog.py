@@ -0,0 +1,155 @@
+import hashlib
+import heapq
+import json
+import logging
+import math
+import time
+
+# Constants
+HALF_LIFE_HOURS = 6.0  # priority of a candidate halves every HALF_LIFE_HOURS
+MAX_AGE_HOURS = 24.0  # candidates older than this are dropped unpublished
+SEEN_TTL_HOURS = 48.0  # scored titles are not scored again within this window, must exceed MAX_AGE_HOURS
+MAX_ATTEMPTS = 3  # failed publish attempts before a candidate is dropped
+MAX_NOVELTY = 5
+
+
+def candidate_key(title):
+    """Normalise a title so that the same story maps to the same key."""
+    return ' '.join(title.lower().split())
+
+
+def history_key(titles):
+    """Fingerprint of the published titles a candidate's novelty was scored against."""
+    return hashlib.sha256('\n'.join(candidate_key(title) for title in titles).encode('utf-8')).hexdigest()[:16]
+
+
+class CandidateBacklog:
+    """Scored news candidates kept across timer ticks, ordered by priority.
+
+    The priority of a candidate is its relevance times its novelty, decayed
+    exponentially with age. All candidates decay at the same rate, so the
+    order never changes over time and the heap key can be fixed when a
+    candidate is pushed.
+    """
+
+    def __init__(self, candidates=None, seen=None, last_published=None, pending=None,
+                 half_life_hours=HALF_LIFE_HOURS, max_age_hours=MAX_AGE_HOURS, seen_ttl_hours=SEEN_TTL_HOURS):
+        self.half_life = half_life_hours * 3600
+        self.max_age = max_age_hours * 3600
+        self.seen_ttl = seen_ttl_hours * 3600
+        self.seen = dict(seen or {})
+        self.pending = list(pending or [])
+        self.last_published = last_published
+        self.heap = [(self.heap_key(c), c['key'], c) for c in candidates or []]
+        heapq.heapify(self.heap)
+
+    def __len__(self):
+        return len(self.heap)
+
+    def heap_key(self, candidate):
+        base = candidate['relevance'] * (1 - candidate['novelty'] / MAX_NOVELTY)
+        # log(base * 0.5 ** (-first_seen / half_life)), negated for the min-heap
+        return -(math.log(max(base, 1e-9)) + candidate['first_seen'] * math.log(2) / self.half_life)
+
+    def priority(self, candidate, now=None):
+        """Current priority of a candidate in [0, 1]."""
+        now = time.time() if now is None else now
+        base = candidate['relevance'] * (1 - candidate['novelty'] / MAX_NOVELTY)
+        return base * 0.5 ** ((now - candidate['first_seen']) / self.half_life)
+
+    def is_known(self, title):
+        """True if the title was already scored, whether it was queued or rejected."""
+        return candidate_key(title) in self.seen
+
+    def mark_seen(self, title, now=None):
+        """Remember a scored title so that it is not scored again."""
+        self.seen[candidate_key(title)] = time.time() if now is None else now
+
+    def defer(self, title, description, url, relevance=1.0, now=None):
+        """Hold a relevant candidate whose novelty has not been scored yet."""
+        now = time.time() if now is None else now
+        self.mark_seen(title, now)
+        self.pending.append({'title': title, 'description': description, 'url': url,
+                             'relevance': float(relevance), 'first_seen': now})
+
+    def take_pending(self, n):
+        """Remove and return up to n unscored candidates, freshest first."""
+        self.pending.sort(key=lambda c: c['first_seen'], reverse=True)
+        taken, self.pending = self.pending[:n], self.pending[n:]
+        return taken
+
+    def push(self, title, description, url, relevance=1.0, novelty=0, now=None, attempts=0, first_seen=None,
+             scored_against=None):
+        """Queue a scored candidate; scored_against is the history_key of the titles it was compared with."""
+        now = time.time() if now is None else now
+        candidate = {
+            'key': candidate_key(title),
+            'title': title,
+            'description': description,
+            'url': url,
+            'relevance': float(relevance),
+            'novelty': float(novelty),
+            'first_seen': now if first_seen is None else first_seen,
+            'attempts': attempts,
+            'scored_against': scored_against,
+        }
+        self.mark_seen(title, now)
+        heapq.heappush(self.heap, (self.heap_key(candidate), candidate['key'], candidate))
+        return candidate
+
+    def requeue(self, candidate):
+        """Put back a popped candidate that was not attempted."""
+        heapq.heappush(self.heap, (self.heap_key(candidate), candidate['key'], candidate))
+
+    def retry(self, candidate):
+        """Put back a candidate whose publication failed, unless it failed too often."""
+        candidate['attempts'] += 1
+        if candidate['attempts'] < MAX_ATTEMPTS:
+            heapq.heappush(self.heap, (self.heap_key(candidate), candidate['key'], candidate))
+        else:
+            logging.info(f"Dropping candidate after {candidate['attempts']} attempts: {candidate['title']}")
+
+    def pop(self, now=None):
+        """Remove and return the candidate with the highest priority, or None."""
+        now = time.time() if now is None else now
+        while self.heap:
+            _, _, candidate = heapq.heappop(self.heap)
+            if now - candidate['first_seen'] <= self.max_age:
+                return candidate
+            logging.info(f"Candidate expired: {candidate['title']}")
+        return None
+
+    def expire(self, now=None):
+        """Drop expired candidates and forget old seen titles."""
+        now = time.time() if now is None else now
+        self.heap = [entry for entry in self.heap if now - entry[2]['first_seen'] <= self.max_age]
+        heapq.heapify(self.heap)
+        self.pending = [c for c in self.pending if now - c['first_seen'] <= self.max_age]
+        self.seen = {key: ts for key, ts in self.seen.items() if now - ts <= self.seen_ttl}
+
+    def to_json(self):
+        return json.dumps({
+            'candidates': [entry[2] for entry in self.heap],
+            'pending': self.pending,
+            'seen': self.seen,
+            'last_published': self.last_published,
+        })
+
+    @classmethod
+    def from_json(cls, data, **kwargs):
+        state = json.loads(data) if data else {}
+        return cls(state.get('candidates'), state.get('seen'), state.get('last_published'), state.get('pending'),
+                   **kwargs)
+
+
+def load_backlog(document, **kwargs):
+    """Load the backlog from a document; an absent document is an empty backlog."""
+    backlog = CandidateBacklog.from_json(document.read(), **kwargs)
+    logging.info(f'Candidate backlog retrieved: {len(backlog)} candidates')
+    return backlog
+
+
+def save_backlog(document, backlog):
+    """Store the backlog; raises WriteConflict if another run wrote it since it was loaded."""
+    document.write(backlog.to_json())
+    logging.info(f'Candidate backlog saved: {len(backlog)} candidates')
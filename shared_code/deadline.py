@@ -0,0 +1,92 @@
+import contextvars
+import json
+import logging
+import math
+import os
+import re
+import time
+
+# Constants
+HOST_JSON = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'host.json')
+DEFAULT_FUNCTION_TIMEOUT_SECONDS = 300  # consumption plan default when host.json sets none
+SLO_SETTING = 'FUNCTION_SLO_SECONDS'  # app setting that tightens the budget below functionTimeout
+DEADLINE_HEADER = 'x-deadline-ms'  # remaining budget passed on to the functions we call
+SAFETY_MARGIN = 0.9  # share of the timeout we plan with; the platform also counts start-up
+PERSIST_RESERVE_SECONDS = 15.0  # kept back for writing logs and state
+MIN_STAGE_SECONDS = 0.5  # a stage with less time than this is not started
+
+# Globals
+current = contextvars.ContextVar('deadline', default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when a stage cannot start or finish within the invocation budget."""
+
+
+def function_timeout(path=HOST_JSON):
+    """functionTimeout of host.json in seconds; "-1" (unbounded) and a missing file give the default."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            value = json.load(f).get('functionTimeout')
+    except (OSError, ValueError):
+        value = None
+    match = re.fullmatch(r'(?:(\d+)\.)?(\d+):(\d+):(\d+)(?:\.\d+)?', value or '')
+    if not match:
+        return DEFAULT_FUNCTION_TIMEOUT_SECONDS
+    days, hours, minutes, seconds = (int(part or 0) for part in match.groups())
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+class Deadline:
+    """Time budget of one invocation.
+
+    The last `reserve_seconds` are kept for persisting, so stages plan with
+    remaining() and only the final writes may use the reserve.
+    """
+
+    def __init__(self, seconds, reserve_seconds=PERSIST_RESERVE_SECONDS):
+        self.expires = time.monotonic() + seconds
+        self.reserve = min(reserve_seconds, seconds / 4)
+
+    def remaining(self):
+        """Seconds left for work before the persist reserve."""
+        return self.expires - self.reserve - time.monotonic()
+
+    def allows(self, seconds):
+        """True if a stage expected to take `seconds` still fits."""
+        return self.remaining() >= seconds
+
+    def timeout(self, cap, stage='stage'):
+        """Timeout for a stage: its own cap, shortened to the remaining budget."""
+        remaining = self.remaining()
+        if remaining < MIN_STAGE_SECONDS:
+            raise DeadlineExceeded(f'No time left for {stage}')
+        return min(cap, remaining)
+
+    def header(self):
+        """Budget to hand to a function we call, so that it finishes before we give up on it."""
+        remaining = self.remaining()
+        return None if math.isinf(remaining) else str(max(0, int(remaining * 1000)))
+
+
+def start_deadline(header_ms=None, slo_seconds=None):
+    """Start the budget of an invocation: functionTimeout, tightened by the SLO setting and a caller's header."""
+    budget = function_timeout() * SAFETY_MARGIN
+    slo_seconds = slo_seconds or os.environ.get(SLO_SETTING)
+    if slo_seconds:
+        budget = min(budget, float(slo_seconds))
+    if header_ms:
+        try:
+            budget = min(budget, int(header_ms) / 1000)
+        except ValueError:
+            logging.error(f'Ignoring invalid {DEADLINE_HEADER} header: {header_ms}')
+    deadline = Deadline(budget)
+    current.set(deadline)
+    logging.info(f'Invocation budget {budget:.0f}s, {deadline.reserve:.0f}s reserved for persisting')
+    return deadline
+
+
+def current_deadline():
+    """The budget of the running invocation; unbounded outside an invocation."""
+    deadline = current.get()
+    return deadline if deadline is not None else Deadline(math.inf)
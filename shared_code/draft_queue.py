@@ -0,0 +1,228 @@
+import ast
+import concurrent.futures
+import io
+import json
+import logging
+import time
+import uuid
+from shared_code.profiler import timed
+from shared_code.run_coordinator import MAX_CONFLICT_RETRIES, WriteConflict
+from shared_code.tweet_text import validate_tweet
+
+# Constants
+BATCH_ENDPOINT = '/v1/chat/completions'
+COMPLETION_WINDOW = '24h'
+LOCAL_MAX_WORKERS = 8
+SUBMIT_TIMEOUT_SECONDS = 600  # a job still without id after this long belongs to a run that died while submitting
+
+
+#### Executors
+class BatchApiExecutor:
+    """Runs chat completions through the OpenAI Batch API at bulk pricing."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def submit(self, requests):
+        """Submit {custom_id: body} and return a job id."""
+        lines = [json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': BATCH_ENDPOINT, 'body': body})
+                 for custom_id, body in requests.items()]
+        with timed('openai', 'batch submit'):
+            batch_file = self.client.files.create(file=('drafts.jsonl', io.BytesIO('\n'.join(lines).encode('utf-8'))),
+                                                  purpose='batch')
+            batch = self.client.batches.create(input_file_id=batch_file.id, endpoint=BATCH_ENDPOINT,
+                                               completion_window=COMPLETION_WINDOW)
+        logging.info(f'Batch {batch.id} submitted with {len(requests)} requests')
+        return batch.id
+
+    def collect(self, job_id):
+        """Return {custom_id: content} once the job finished, None while it is running."""
+        with timed('openai', 'batch status'):
+            batch = self.client.batches.retrieve(job_id)
+        if batch.status in ('validating', 'in_progress', 'finalizing'):
+            return None
+        if batch.status != 'completed' or not batch.output_file_id:
+            logging.error(f'Batch {job_id} ended with status {batch.status}')
+            return {}
+        results = {}
+        with timed('openai', 'batch output'):
+            output = self.client.files.content(batch.output_file_id).text
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = item.get('response') or {}
+            if response.get('status_code') == 200:
+                results[item['custom_id']] = response['body']['choices'][0]['message']['content']
+            else:
+                logging.error(f"Batch request {item['custom_id']} failed: {item.get('error')}")
+        return results
+
+
+class LocalBatchExecutor:
+    """Runs the same requests immediately on a thread pool, for tests or when the Batch API is unavailable."""
+
+    def __init__(self, client, max_workers=LOCAL_MAX_WORKERS):
+        self.client = client
+        self.max_workers = max_workers
+        self.results = {}
+
+    def _complete(self, body):
+        return self.client.chat.completions.create(**body).choices[0].message.content
+
+    def submit(self, requests):
+        # The pool threads do not see the profile, so the whole batch is timed
+        with timed('openai', f'local batch of {len(requests)}'), \
+                concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = {custom_id: pool.submit(self._complete, body) for custom_id, body in requests.items()}
+        job_id = f'local-{uuid.uuid4().hex[:12]}'
+        self.results[job_id] = {}
+        for custom_id, future in futures.items():
+            try:
+                self.results[job_id][custom_id] = future.result()
+            except Exception as ex:
+                logging.error(f'Request {custom_id} failed: {ex}')
+        return job_id
+
+    def collect(self, job_id):
+        # Jobs of a previous worker process are lost, treat them as finished without results
+        return self.results.pop(job_id, {})
+
+
+#### Drafts
+def parse_terms(content):
+    """Parse a list of terms returned by the model."""
+    try:
+        terms = ast.literal_eval(content.strip())
+    except (ValueError, SyntaxError):
+        terms = content.splitlines()
+    if isinstance(terms, str):
+        terms = [terms]
+    return [str(term).strip() for term in terms if str(term).strip()]
+
+
+def clean_tweet(tweet):
+    """Strip the wrapping quotes models like to add; returns None if the tweet is unusable."""
+    tweet = tweet.strip()
+    if len(tweet) > 1 and tweet[0] == tweet[-1] == '"':
+        tweet = tweet[1:-1].strip()
+    if validate_tweet(tweet):
+        return None
+    return tweet
+
+
+class DraftPipeline:
+    """Pre-generates term/tweet drafts in bulk and keeps the validated ones in a ready queue.
+
+    Generation runs in two bulk stages: one request for a list of new terms,
+    then one request per term for its tweet. The queue state, including the
+    jobs in flight, is a fenced document so that concurrent ticks never pop
+    the same draft.
+    """
+
+    def __init__(self, document, executor, term_request, tweet_request, batch_size=14, low_watermark=4):
+        self.document = document
+        self.executor = executor
+        self.term_request = term_request  # (old_terms, n) -> chat completion body
+        self.tweet_request = tweet_request  # term -> chat completion body
+        self.batch_size = batch_size
+        self.low_watermark = low_watermark
+
+    def _update(self, change):
+        """Apply change(state) to the latest state with a fenced write, skipped if nothing changed."""
+        for _ in range(MAX_CONFLICT_RETRIES):
+            data = self.document.read()
+            state = json.loads(data) if data else {'ready': [], 'jobs': []}
+            result = change(state)
+            updated = json.dumps(state)
+            if updated == data:
+                return result
+            try:
+                self.document.write(updated)
+                return result
+            except WriteConflict:
+                logging.info('Draft queue changed concurrently, retrying')
+        raise WriteConflict('Draft queue is busy')
+
+    def advance(self, state, old_terms, collected=None):
+        """Collect finished jobs and plan the next stage; returns the planned jobs as [(key, requests)].
+
+        Planned jobs enter the state as markers without an id and are only
+        submitted once that state is written, so a run that loses the write
+        reloads and sees them instead of submitting a second batch. Results
+        are kept in `collected`, so a retry after a conflict does not collect
+        a job twice; a local executor hands out its results only once.
+        """
+        collected = {} if collected is None else collected
+        pending = []
+        now = time.time()
+        for job in list(state['jobs']):
+            if job['id'] is None:
+                if now - job['submitted'] > SUBMIT_TIMEOUT_SECONDS:
+                    logging.error(f"Job {job['key']} was never submitted, dropping it")
+                    state['jobs'].remove(job)
+                continue
+            if job['id'] not in collected:
+                collected[job['id']] = self.executor.collect(job['id'])
+            results = collected[job['id']]
+            if results is None:
+                continue
+            state['jobs'].remove(job)
+            if job['stage'] == 'terms':
+                known = set(old_terms) | {draft['term'] for draft in state['ready']}
+                terms = [t for t in dict.fromkeys(parse_terms(results.get('terms', '[]'))) if t not in known]
+                if terms:
+                    pending.append(self._plan(state, 'tweets', {f'tweet-{i}': self.tweet_request(term)
+                                                                for i, term in enumerate(terms)}, terms=terms))
+            else:
+                for i, term in enumerate(job['terms']):
+                    tweet = clean_tweet(results.get(f'tweet-{i}', ''))
+                    if tweet is None:
+                        logging.info(f'Draft for {term} rejected')
+                        continue
+                    state['ready'].append({'term': term, 'tweet': tweet, 'created': now})
+
+        if len(state['ready']) < self.low_watermark and not state['jobs']:
+            known = list(old_terms) + [draft['term'] for draft in state['ready']]
+            pending.append(self._plan(state, 'terms', {'terms': self.term_request(known, self.batch_size)}))
+        return pending
+
+    def _plan(self, state, stage, requests, **fields):
+        key = uuid.uuid4().hex[:12]
+        state['jobs'].append({'id': None, 'key': key, 'stage': stage, 'submitted': time.time(), **fields})
+        return key, requests
+
+    def submit(self, pending):
+        """Submit the planned jobs and record their ids."""
+        submitted = {key: self.executor.submit(requests) for key, requests in pending}
+
+        def record(state):
+            # A fresh copy per attempt, as a conflict retries this on the reloaded state
+            ids = dict(submitted)
+            for job in state['jobs']:
+                if job.get('key') in ids:
+                    job['id'] = ids.pop(job['key'])
+            return ids
+        for key, job_id in self._update(record).items():
+            logging.error(f'Job {key} was dropped while submitting, batch {job_id} is orphaned')
+
+    def next_draft(self, old_terms):
+        """Advance the pipeline and pop the oldest ready draft, or None if none is ready."""
+        collected = {}
+
+        def step(state):
+            pending = self.advance(state, old_terms, collected)
+            popped = state['ready'].pop(0) if draft is None and state['ready'] else None
+            if not pending:
+                logging.info(f"Drafts ready: {len(state['ready'])}, jobs in flight: {len(state['jobs'])}")
+            return pending, popped
+
+        draft = None
+        # A local executor finishes jobs on submit, so keep advancing until nothing is left to submit
+        for _ in range(3):
+            pending, popped = self._update(step)
+            draft = draft or popped
+            if not pending:
+                break
+            self.submit(pending)
+        return draft
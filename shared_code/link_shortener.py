@@ -0,0 +1,114 @@
+import json
+import logging
+import httpx
+from azure.core.exceptions import ResourceExistsError
+from shared_code.deadline import current_deadline
+from shared_code.profiler import timed
+
+# Constants
+TIMEOUT_SECONDS = 3.0
+TINYURL_ENDPOINT = 'https://tinyurl.com/api-create.php'
+
+# Globals
+async_client = None  # httpx.AsyncClient shared by the async providers, created on first use
+
+
+def get_async_client():
+    global async_client
+    if async_client is None:
+        async_client = httpx.AsyncClient()
+    return async_client
+
+
+#### Providers
+class TinyUrlProvider:
+    """Shortens links with the public TinyURL API."""
+
+    name = 'tinyurl'
+
+    def __init__(self, timeout=TIMEOUT_SECONDS):
+        self.timeout = timeout
+
+    async def ashorten(self, url):
+        response = await get_async_client().get(TINYURL_ENDPOINT, params={'url': url},
+                                                timeout=current_deadline().timeout(self.timeout, 'link shortening'))
+        response.raise_for_status()
+        return self._short_url(response.text)
+
+    @staticmethod
+    def _short_url(text):
+        short_url = text.strip()
+        if not short_url.startswith('http'):
+            raise ValueError(f'Unexpected TinyURL response: {short_url[:100]}')
+        return short_url
+
+
+class PassthroughProvider:
+    """Keeps the original link; Twitter wraps every link in t.co and counts it as 23 characters anyway."""
+
+    name = 'passthrough'
+
+    async def ashorten(self, url):
+        return url
+
+
+#### Caches
+class AsyncBlobLinkCache:
+    """URL to short URL mapping kept in an append blob of JSON lines, on an azure.storage.blob.aio blob client."""
+
+    def __init__(self, blob_client):
+        self.blob_client = blob_client
+        self.links = None
+
+    async def _load(self):
+        if not await self.blob_client.exists():
+            try:
+                await self.blob_client.upload_blob('', blob_type='AppendBlob', overwrite=False)
+            except ResourceExistsError:
+                pass
+            return {}
+        downloader = await self.blob_client.download_blob()
+        data = await downloader.content_as_text()
+        return dict(tuple(json.loads(line)) for line in data.splitlines() if line.strip())
+
+    async def get(self, url):
+        if self.links is None:
+            self.links = await self._load()
+            logging.info(f'Link cache loaded: {len(self.links)} links')
+        return self.links.get(url)
+
+    async def put(self, url, short_url):
+        self.links[url] = short_url
+        await self.blob_client.append_block(json.dumps([url, short_url]) + '\n')
+
+
+class LinkShortener:
+    """Shortens links through an async provider, caching results and falling back to the raw link."""
+
+    def __init__(self, provider, cache=None):
+        self.provider = provider
+        self.cache = cache
+
+    async def ashorten(self, url):
+        if not url:
+            return url
+        if self.cache is not None:
+            try:
+                cached = await self.cache.get(url)
+            except Exception as ex:
+                logging.error(f'Link cache unavailable: {ex}')
+                cached = None
+            if cached:
+                return cached
+        try:
+            with timed('http', f'{self.provider.name} shorten'):
+                short_url = await self.provider.ashorten(url)
+        except Exception as ex:
+            logging.error(f'Shortening with {self.provider.name} failed, using the raw link: {ex}')
+            return url
+        if self.cache is not None and short_url != url:
+            try:
+                await self.cache.put(url, short_url)
+            except Exception as ex:
+                logging.error(f'Could not cache {short_url}: {ex}')
+        return short_url
@@ -0,0 +1,183 @@
+import collections
+import json
+import logging
+import math
+import os
+from shared_code.deadline import current_deadline
+from shared_code.profiler import timed
+
+# Constants
+REQUEST_TIMEOUT_SECONDS = 60.0  # per completion, shortened to the invocation's remaining budget
+MIN_ESCALATION_SECONDS = 10.0  # escalate only if the stronger model still has this much time
+POLICIES_SETTING = 'OPENAI_ROUTING'  # app setting with JSON policy overrides, e.g. {"novelty": {"min_confidence": 0.8}}
+DEFAULT_POLICY = {
+    'models': ['gpt-3.5-turbo'],  # tried in order, the last one is the fallback
+    'min_confidence': None,  # escalate when the least likely token of the answer is below this probability
+}
+# The first model of a policy is the cheap one; the ones after it are stronger, never just older or pricier
+DEFAULT_POLICIES = {
+    'relevance': {'models': ['gpt-4o-mini', 'gpt-4o'], 'min_confidence': 0.8},
+    'relevance_multi': {'models': ['gpt-4o-mini', 'gpt-4o'], 'min_confidence': 0.8},
+    'novelty': {'models': ['gpt-4o-mini', 'gpt-4-1106-preview'], 'min_confidence': 0.6},
+    'news_tweet': {'models': ['gpt-4o-mini', 'gpt-4o']},
+    'fact_term': {'models': ['gpt-4o-mini', 'gpt-4-1106-preview']},
+    'fact_tweet': {'models': ['gpt-4o-mini', 'gpt-4-1106-preview']},
+    'stoic_term': {'models': ['gpt-4o-mini', 'gpt-4o']},
+    'stoic_tweet': {'models': ['gpt-4o-mini', 'gpt-4o']},
+}
+
+
+class EscalationExhausted(ValueError):
+    """No model of a policy returned a valid answer."""
+
+    def __init__(self, task, content, reason):
+        super().__init__(f'{task}: no valid answer ({reason})')
+        self.task = task
+        self.content = content
+
+
+def load_policies(setting=POLICIES_SETTING):
+    """Default routing policies with the overrides of the app setting merged in."""
+    policies = {task: dict(policy) for task, policy in DEFAULT_POLICIES.items()}
+    overrides = os.environ.get(setting)
+    if overrides:
+        try:
+            for task, policy in json.loads(overrides).items():
+                policies[task] = {**policies.get(task, {}), **policy}
+        except (ValueError, AttributeError) as ex:
+            logging.error(f'Ignoring invalid {setting}: {ex}')
+    return policies
+
+
+def confidence(response):
+    """Probability of the least likely token of a completion, None without logprobs."""
+    logprobs = getattr(response.choices[0], 'logprobs', None)
+    tokens = getattr(logprobs, 'content', None)
+    if not tokens:
+        return None
+    return math.exp(min(token.logprob for token in tokens))
+
+
+def add_usage(usage, response):
+    """Add the token cost of a completion to a caller's usage dict."""
+    if usage is not None and getattr(response, 'usage', None) is not None:
+        usage['tokens'] = usage.get('tokens', 0) + response.usage.total_tokens
+
+
+class ModelRouter:
+    """Routes each chat completion through the model cascade of its task.
+
+    The cheapest model of the policy answers first. The answer moves on to
+    the next model when `validate` rejects it (raises) or when its logprobs
+    confidence is below the policy's min_confidence. The last model's
+    answer is used as long as it validates. A valid low-confidence answer
+    is kept when the stronger models only give invalid ones, or when the
+    invocation's budget is too tight to escalate. A router on
+    an AsyncOpenAI client runs the same cascade with acomplete().
+    """
+
+    def __init__(self, client, policies=None):
+        self.client = client
+        self.policies = load_policies() if policies is None else policies
+        self.stats = collections.defaultdict(collections.Counter)
+
+    def policy(self, task):
+        return {**DEFAULT_POLICY, **self.policies.get(task, {})}
+
+    def complete(self, task, messages, validate=None, usage=None, **params):
+        """Return validate(content) of the first acceptable answer; a 'model' in params is replaced."""
+        cascade = self._cascade(task, messages, validate, usage, params)
+        request = next(cascade)
+        while True:
+            with timed('openai', f"{task} on {request['model']}"):
+                response = self.client.chat.completions.create(**request)
+            try:
+                request = cascade.send(response)
+            except StopIteration as done:
+                return done.value
+
+    async def acomplete(self, task, messages, validate=None, usage=None, **params):
+        """complete() for a router on an AsyncOpenAI client."""
+        cascade = self._cascade(task, messages, validate, usage, params)
+        request = next(cascade)
+        while True:
+            with timed('openai', f"{task} on {request['model']}"):
+                response = await self.client.chat.completions.create(**request)
+            try:
+                request = cascade.send(response)
+            except StopIteration as done:
+                return done.value
+
+    def _cascade(self, task, messages, validate, usage, params):
+        """Yields the request for each model tried and receives its response; returns the accepted answer."""
+        policy = self.policy(task)
+        models = policy['models']
+        stats = self.stats[task]
+        stats['calls'] += 1
+        deadline = current_deadline()
+        fallback = None
+        last_content = None  # answer of the last model tried, handed to the caller if none is valid
+        for tier, model in enumerate(models):
+            if tier and not deadline.allows(MIN_ESCALATION_SECONDS):
+                stats['escalation_skipped'] += 1
+                if fallback is not None:
+                    logging.info(f'{task}: no time to escalate to {model}, keeping the answer')
+                    return fallback[0]
+                stats['failures'] += 1
+                raise EscalationExhausted(task, last_content, f'no time to escalate to {model}')
+            last = tier == len(models) - 1
+            request = {**params, 'model': model, 'messages': messages,
+                       'timeout': deadline.timeout(REQUEST_TIMEOUT_SECONDS, f'{task} on {model}')}
+            if policy['min_confidence'] and not last:
+                request['logprobs'] = True
+            response = yield request
+            stats[f'model.{model}'] += 1
+            add_usage(usage, response)
+            content = last_content = response.choices[0].message.content or ''
+            try:
+                value = validate(content) if validate else content
+            except Exception as ex:
+                reason = f'invalid answer from {model}: {ex}'
+                if last:
+                    if tier:
+                        stats['escalated'] += 1
+                    if fallback is not None:
+                        # A valid low-confidence answer beats none at all
+                        logging.info(f'{task}: {reason}, keeping the answer of the cheaper model')
+                        return fallback[0]
+                    stats['failures'] += 1
+                    logging.error(f'{task}: {reason}')
+                    raise EscalationExhausted(task, content, reason)
+                stats['escalated.invalid'] += 1
+                logging.info(f'{task}: {reason}, escalating')
+                continue
+            fallback = None
+            score = confidence(response)
+            if not last and policy['min_confidence'] and score is not None and score < policy['min_confidence']:
+                fallback = (value,)
+                stats['escalated.low_confidence'] += 1
+                logging.info(f'{task}: confidence {score:.2f} of {model} below {policy["min_confidence"]}, escalating')
+                continue
+            if tier:
+                stats['escalated'] += 1
+            return value
+
+    def report(self):
+        """Escalation and failure rates per task since the worker started."""
+        report = {}
+        for task, stats in sorted(self.stats.items()):
+            report[task] = {
+                'calls': stats['calls'],
+                'escalation_rate': round(stats['escalated'] / stats['calls'], 3) if stats['calls'] else 0.0,
+                'failure_rate': round(stats['failures'] / stats['calls'], 3) if stats['calls'] else 0.0,
+                'escalated_invalid': stats['escalated.invalid'],
+                'escalated_low_confidence': stats['escalated.low_confidence'],
+                'escalation_skipped': stats['escalation_skipped'],
+                'models': {key[len('model.'):]: value for key, value in stats.items() if key.startswith('model.')},
+            }
+        return report
+
+    def log_report(self):
+        for task, entry in self.report().items():
+            logging.info(f"Routing {task}: {entry['calls']} calls, escalation rate {entry['escalation_rate']}, "
+                         f"failure rate {entry['failure_rate']}, models {entry['models']}")
@@ -0,0 +1,120 @@
+import datetime as dt
+import json
+import logging
+import os
+from shared_code.run_coordinator import WriteConflict
+
+# Constants
+MIN_INTERVAL_MINUTES = 10  # the timer tick, polls cannot happen more often
+MAX_INTERVAL_MINUTES = 120  # the previous fixed schedule, so a story is never noticed later than before
+INITIAL_INTERVAL_MINUTES = 60
+BACKOFF_FACTOR = 2.0  # interval growth after a poll without new results
+BURST_NEW_RESULTS = 3  # new results in a single poll that count as a burst
+BURST_RATE_FACTOR = 3.0  # so does an arrival rate this many times the average
+TARGET_NEW_PER_POLL = 2.0  # outside bursts, poll about as often as this many new results arrive
+RATE_SMOOTHING = 0.3  # weight of the latest poll in the arrival rate average
+TICK_SLACK_SECONDS = 30  # a poll due a few seconds after a tick is run by that tick
+MAX_REMEMBERED_IDS = 200
+BUDGET_SETTING = 'NEWS_POLLS_PER_DAY'  # app setting with the poll budget per source and UTC day
+DEFAULT_POLLS_PER_DAY = 48
+
+
+def seconds_until_midnight(now):
+    moment = dt.datetime.fromtimestamp(now, dt.timezone.utc)
+    midnight = dt.datetime.combine(moment.date() + dt.timedelta(days=1), dt.time(), dt.timezone.utc)
+    return midnight.timestamp() - now
+
+
+class PollScheduler:
+    """Decides on each timer tick which news sources are worth polling.
+
+    Each source remembers the result IDs of its last poll, a smoothed
+    arrival rate of new results and its polling interval. A poll without
+    new results multiplies the interval by BACKOFF_FACTOR up to the
+    maximum. A burst, many new results or a sudden rise of the arrival
+    rate, drops it to the timer tick. Otherwise the interval follows the
+    arrival rate. Bursts may only spend the daily budget as
+    long as enough polls remain to cover the rest of the day at the
+    maximum interval.
+    """
+
+    def __init__(self, document, polls_per_day=None, min_interval_minutes=MIN_INTERVAL_MINUTES,
+                 max_interval_minutes=MAX_INTERVAL_MINUTES):
+        self.document = document
+        if polls_per_day is None:
+            polls_per_day = int(os.environ.get(BUDGET_SETTING, DEFAULT_POLLS_PER_DAY))
+        self.polls_per_day = polls_per_day
+        self.min_interval = min_interval_minutes * 60
+        self.max_interval = max_interval_minutes * 60
+
+    def load(self):
+        data = self.document.read()
+        return json.loads(data) if data else {'sources': {}, 'work_due': None}
+
+    def save(self, state):
+        try:
+            self.document.write(json.dumps(state))
+        except WriteConflict:
+            logging.info('Scheduler state changed concurrently, keeping the other run\'s state')
+
+    def source(self, state, name):
+        return state['sources'].setdefault(name, {
+            'interval': INITIAL_INTERVAL_MINUTES * 60, 'next_poll': 0, 'last_poll': None,
+            'rate': None, 'ids': [], 'day': None, 'polls_today': 0})
+
+    def polls_left(self, source, now):
+        day = dt.datetime.fromtimestamp(now, dt.timezone.utc).date().isoformat()
+        if source['day'] != day:
+            source['day'], source['polls_today'] = day, 0
+        return self.polls_per_day - source['polls_today']
+
+    def due(self, state, names, now):
+        """Sources whose next poll is due and whose budget is not spent."""
+        return [name for name in names
+                if self.source(state, name)['next_poll'] <= now + TICK_SLACK_SECONDS
+                and self.polls_left(self.source(state, name), now) > 0]
+
+    def work_due(self, state, now):
+        """True if the backlogs have work that does not need a poll, such as a pending publication."""
+        return state.get('work_due') is not None and state['work_due'] <= now + TICK_SLACK_SECONDS
+
+    def observe(self, state, name, ids, now):
+        """Record a poll of a source and schedule its next one; returns the IDs not seen before."""
+        source = self.source(state, name)
+        known = set(source['ids'])
+        new = [i for i in dict.fromkeys(ids) if i not in known]
+
+        average = source['rate'] or 0.0
+        sample = None
+        if source['last_poll'] is not None and now > source['last_poll']:
+            sample = len(new) * 3600 / (now - source['last_poll'])
+            source['rate'] = sample if source['rate'] is None else \
+                RATE_SMOOTHING * sample + (1 - RATE_SMOOTHING) * average
+
+        interval = source['interval']
+        if not new:
+            interval *= BACKOFF_FACTOR
+        elif len(new) >= BURST_NEW_RESULTS or (sample is not None and sample >= BURST_RATE_FACTOR * average):
+            interval = self.min_interval
+        elif source['rate']:
+            interval = TARGET_NEW_PER_POLL * 3600 / source['rate']
+        interval = min(max(interval, self.min_interval), self.max_interval)
+
+        self.polls_left(source, now)
+        source['polls_today'] += 1
+        left = self.polls_per_day - source['polls_today']
+        remaining = seconds_until_midnight(now)
+        if left <= 0:
+            delay = remaining
+        elif left <= remaining / self.max_interval:
+            # Keep enough budget to poll at the maximum interval until midnight
+            delay = max(interval, remaining / left)
+        else:
+            delay = interval
+
+        source['interval'] = interval
+        source['next_poll'] = now + delay
+        source['last_poll'] = now
+        source['ids'] = (new + source['ids'])[:MAX_REMEMBERED_IDS]
+        logging.info(f'{name}: {len(new)} new results, next poll in {delay / 60:.0f} minutes')
+        return new
@@ -0,0 +1,268 @@
+import builtins
+import contextlib
+import contextvars
+import cProfile
+import datetime as dt
+import functools
+import hashlib
+import hmac
+import inspect
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+
+# Constants
+FUNCTIONS_SETTING = 'PROFILE_FUNCTIONS'  # app setting: comma separated function names to profile, or '*'
+SIGNING_KEY_SETTING = 'PROFILE_SIGNING_KEY'  # app setting with the key that signs profile headers
+LOCAL_DIR_SETTING = 'PROFILE_DIR'  # app setting that writes profiles to a local directory instead of blobs
+PROFILE_HEADER = 'x-profile-token'  # '<expires unix time>.<hex HMAC-SHA256 of "<function>.<expires>">'
+MAX_TOKEN_SECONDS = 24 * 3600  # tokens that expire later than this are rejected
+PREFIX = 'profiles'
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 20
+TOP_IMPORTS = 30
+TRACEMALLOC_FRAMES = 1
+
+# Globals
+current = contextvars.ContextVar('profile', default=None)
+active = threading.Lock()  # cProfile and the import hook are process wide, so one profile at a time
+
+
+def sign(function, key, seconds=3600, now=None):
+    """Value of the profile header that enables profiling of `function` for the next `seconds`."""
+    expires = int((now or time.time()) + seconds)
+    digest = hmac.new(key.encode('utf-8'), f'{function}.{expires}'.encode('utf-8'), hashlib.sha256).hexdigest()
+    return f'{expires}.{digest}'
+
+
+def verify(function, token, key, now=None):
+    """True if `token` is a valid, unexpired profile header for `function`."""
+    try:
+        expires, digest = token.split('.', 1)
+        expires = int(expires)
+    except (AttributeError, ValueError):
+        return False
+    now = now or time.time()
+    if not now <= expires <= now + MAX_TOKEN_SECONDS:
+        return False
+    expected = hmac.new(key.encode('utf-8'), f'{function}.{expires}'.encode('utf-8'), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, digest)
+
+
+def reason_to_profile(function, headers=None):
+    """Why this invocation is profiled: 'setting', 'header' or None when it is not."""
+    enabled = os.environ.get(FUNCTIONS_SETTING, '')
+    if enabled.strip() == '*' or function in [name.strip() for name in enabled.split(',')]:
+        return 'setting'
+    token = headers.get(PROFILE_HEADER) if headers is not None else None
+    if token:
+        key = os.environ.get(SIGNING_KEY_SETTING)
+        if key and verify(function, token, key):
+            return 'header'
+        logging.error(f'Ignoring invalid {PROFILE_HEADER} header')
+    return None
+
+
+@contextlib.contextmanager
+def timed(kind, name):
+    """Annotate the running profile, if any, with the duration of a call such as an OpenAI request."""
+    profile = current.get()
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.annotate(kind, name, time.perf_counter() - started)
+
+
+def short_path(path):
+    """Last two components of a source path, enough to tell repository code from site-packages."""
+    return '/'.join(path.replace('\\', '/').split('/')[-2:])
+
+
+class Profile:
+    """cProfile, tracemalloc and import timings of one invocation, plus annotated call durations.
+
+    The profiler and the import hook see the whole worker thread, so on an
+    async worker other invocations running on the event loop show up too.
+    """
+
+    def __init__(self, function, reason):
+        self.function = function
+        self.reason = reason
+        self.id = uuid.uuid4().hex[:12]
+        self.started_at = dt.datetime.now(dt.timezone.utc)
+        self.calls = []
+        self.imports = []
+        self.profiler = cProfile.Profile()
+        self.traced = False
+        self.original_import = None
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules:
+            return self.original_import(name, globals, locals, fromlist, level)
+        started = time.perf_counter()
+        try:
+            return self.original_import(name, globals, locals, fromlist, level)
+        finally:
+            self.imports.append((name, time.perf_counter() - started))
+
+    def start(self):
+        # Enabled first, as it fails if another profiler is running
+        self.profiler.enable()
+        self.original_import = builtins.__import__
+        builtins.__import__ = self._import
+        # Leave tracemalloc alone if someone else is already tracing
+        self.traced = not tracemalloc.is_tracing()
+        if self.traced:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        self.started = time.perf_counter()
+
+    def stop(self):
+        self.profiler.disable()
+        self.duration = time.perf_counter() - self.started
+        builtins.__import__ = self.original_import
+        self.peak = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+        self.snapshot = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+        if self.traced:
+            tracemalloc.stop()
+
+    def annotate(self, kind, name, seconds):
+        self.calls.append((kind, name, seconds))
+
+    def artifact(self):
+        """Compact JSON-ready summary of the profile."""
+        stats = pstats.Stats(self.profiler).stats
+        functions = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:TOP_FUNCTIONS]
+        kinds = {}
+        for kind, _, seconds in self.calls:
+            entry = kinds.setdefault(kind, {'count': 0, 'total_ms': 0.0})
+            entry['count'] += 1
+            entry['total_ms'] = round(entry['total_ms'] + seconds * 1000, 3)
+        allocations = self.snapshot.statistics('lineno')[:TOP_ALLOCATIONS] if self.snapshot else []
+        return {
+            'function': self.function,
+            'id': self.id,
+            'reason': self.reason,
+            'started': self.started_at.isoformat(timespec='milliseconds'),
+            'duration_ms': round(self.duration * 1000, 3),
+            'functions': [{
+                'function': f'{short_path(path)}:{line}({name})',
+                'calls': calls,
+                'own_ms': round(own * 1000, 3),
+                'cumulative_ms': round(cumulative * 1000, 3),
+            } for (path, line, name), (_, calls, own, cumulative, _) in functions],
+            'calls': kinds,
+            'call_log': [{'kind': kind, 'name': name, 'ms': round(seconds * 1000, 3)}
+                         for kind, name, seconds in self.calls],
+            'imports': [{'module': name, 'ms': round(seconds * 1000, 3)} for name, seconds in
+                        sorted(self.imports, key=lambda item: item[1], reverse=True)[:TOP_IMPORTS]],
+            'memory': {
+                'peak_kb': round(self.peak / 1024, 1) if self.peak is not None else None,
+                'top': [{'where': f'{short_path(stat.traceback[0].filename)}:{stat.traceback[0].lineno}',
+                         'kb': round(stat.size / 1024, 1), 'count': stat.count} for stat in allocations],
+            },
+        }
+
+
+class ProfileStore:
+    """Writes profiles to blob storage, sync or aio client, or to a local directory."""
+
+    def __init__(self, blob_service_client, container, prefix=PREFIX):
+        self.blob_service_client = blob_service_client
+        self.container = container
+        self.prefix = prefix
+
+    def name(self, profile):
+        return f"{profile.function}/{profile.started_at.strftime('%Y%m%dT%H%M%S')}-{profile.id}.json"
+
+    def save(self, profile):
+        """Write the artifact; returns an awaitable for an aio blob client."""
+        data = json.dumps(profile.artifact(), separators=(',', ':'))
+        local_dir = os.environ.get(LOCAL_DIR_SETTING)
+        if local_dir:
+            path = os.path.join(local_dir, self.prefix, self.name(profile))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(data)
+            logging.info(f'Profile written to {path}')
+            return None
+        blob_client = self.blob_service_client.get_blob_client(container=self.container,
+                                                               blob=f'{self.prefix}/{self.name(profile)}')
+        logging.info(f'Profile written to {self.prefix}/{self.name(profile)}')
+        return blob_client.upload_blob(data, overwrite=True)
+
+
+def profiled(blob_service_client, container):
+    """Decorator for a function's main that profiles the invocations enabled by setting or signed header.
+
+    Invocations that are not profiled only pay for reading the setting.
+    """
+    store = ProfileStore(blob_service_client, container)
+
+    def decorator(main):
+        function = main.__module__.rsplit('.', 1)[-1]
+        # The worker passes bindings as keyword arguments, so the trigger is looked up by name
+        trigger = next(iter(inspect.signature(main).parameters), None)
+
+        def begin(args, kwargs):
+            request = args[0] if args else kwargs.get(trigger)
+            reason = reason_to_profile(function, getattr(request, 'headers', None))
+            if reason is None:
+                return None
+            if not active.acquire(blocking=False):
+                logging.info(f'Another invocation is being profiled, not profiling {function}')
+                return None
+            profile = Profile(function, reason)
+            try:
+                profile.start()
+            except Exception as ex:
+                active.release()
+                logging.error(f'Could not start profiling {function}: {ex}')
+                return None
+            return profile, current.set(profile)
+
+        def end(profile, token):
+            profile.stop()
+            current.reset(token)
+            active.release()
+            try:
+                return store.save(profile)
+            except Exception as ex:
+                logging.error(f'Could not save the profile of {function}: {ex}')
+
+        if inspect.iscoroutinefunction(main):
+            @functools.wraps(main)
+            async def wrapper(*args, **kwargs):
+                session = begin(args, kwargs)
+                if session is None:
+                    return await main(*args, **kwargs)
+                try:
+                    return await main(*args, **kwargs)
+                finally:
+                    saved = end(*session)
+                    if inspect.isawaitable(saved):
+                        try:
+                            await saved
+                        except Exception as ex:
+                            logging.error(f'Could not save the profile of {function}: {ex}')
+        else:
+            @functools.wraps(main)
+            def wrapper(*args, **kwargs):
+                session = begin(args, kwargs)
+                if session is None:
+                    return main(*args, **kwargs)
+                try:
+                    return main(*args, **kwargs)
+                finally:
+                    end(*session)
+        return wrapper
+    return decorator
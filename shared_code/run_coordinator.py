@@ -0,0 +1,350 @@
+import datetime as dt
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+
+# Constants
+LEASE_SECONDS = 60  # blob leases must be between 15 and 60 seconds
+RENEW_INTERVAL_SECONDS = LEASE_SECONDS / 3  # background renewals while a run holds the lease
+KEY_TTL_HOURS = 72.0  # idempotency keys older than this are forgotten
+MAX_CONFLICT_RETRIES = 5
+LOCAL_DIR_SETTING = 'RUN_COORDINATOR_LOCAL_DIR'  # app setting that selects the local lock-file stand-in
+
+
+class LeaseLost(Exception):
+    """Raised when a run no longer holds the lease it started with."""
+
+
+class WriteConflict(Exception):
+    """Raised when a fenced write finds that another writer changed the data."""
+
+
+def idempotency_key(title):
+    """Stable key for a candidate, independent of case and whitespace."""
+    return hashlib.sha256(' '.join(title.lower().split()).encode('utf-8')).hexdigest()[:32]
+
+
+#### Documents with optimistic concurrency
+class BlobDocument:
+    """Text blob whose writes only succeed if nobody wrote since our last read."""
+
+    def __init__(self, blob_client):
+        self.blob_client = blob_client
+        self.etag = None
+
+    def read(self):
+        """Return the blob content, or None if the blob does not exist."""
+        try:
+            downloader = self.blob_client.download_blob()
+        except ResourceNotFoundError:
+            self.etag = None
+            return None
+        self.etag = downloader.properties.etag
+        return downloader.content_as_text()
+
+    def write(self, data):
+        try:
+            if self.etag is None:
+                result = self.blob_client.upload_blob(data=data, overwrite=False)
+            else:
+                result = self.blob_client.upload_blob(data=data, overwrite=True, etag=self.etag,
+                                                      match_condition=MatchConditions.IfNotModified)
+        except (ResourceExistsError, ResourceModifiedError) as ex:
+            raise WriteConflict(f'{self.blob_client.blob_name} was changed by another writer') from ex
+        self.etag = result['etag']
+
+
+class AsyncBlobDocument:
+    """BlobDocument on an azure.storage.blob.aio blob client."""
+
+    def __init__(self, blob_client):
+        self.blob_client = blob_client
+        self.etag = None
+
+    async def read(self):
+        try:
+            downloader = await self.blob_client.download_blob()
+        except ResourceNotFoundError:
+            self.etag = None
+            return None
+        self.etag = downloader.properties.etag
+        return await downloader.content_as_text()
+
+    async def write(self, data):
+        try:
+            if self.etag is None:
+                result = await self.blob_client.upload_blob(data=data, overwrite=False)
+            else:
+                result = await self.blob_client.upload_blob(data=data, overwrite=True, etag=self.etag,
+                                                            match_condition=MatchConditions.IfNotModified)
+        except (ResourceExistsError, ResourceModifiedError) as ex:
+            raise WriteConflict(f'{self.blob_client.blob_name} was changed by another writer') from ex
+        self.etag = result['etag']
+
+
+class FileDocument:
+    """Local stand-in for BlobDocument; the etag is a hash of the file content."""
+
+    def __init__(self, path):
+        self.path = path
+        self.etag = None
+
+    def _current_etag(self):
+        try:
+            with open(self.path, 'rb') as f:
+                return hashlib.md5(f.read()).hexdigest()
+        except FileNotFoundError:
+            return None
+
+    def read(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.etag = None
+            return None
+        self.etag = hashlib.md5(data.encode('utf-8')).hexdigest()
+        return data
+
+    def write(self, data):
+        if self._current_etag() != self.etag:
+            raise WriteConflict(f'{self.path} was changed by another writer')
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+        self.etag = hashlib.md5(data.encode('utf-8')).hexdigest()
+
+
+#### Locks
+class BlobLeaseLock:
+    """Run lock held as a lease on a blob; each acquisition increments a fencing token."""
+
+    def __init__(self, blob_client, lease_seconds=LEASE_SECONDS):
+        self.blob_client = blob_client
+        self.lease_seconds = lease_seconds
+        self.lease = None
+        self.fence = None
+
+    def acquire(self):
+        """Try to take the lease; returns the fencing token, or None if another run holds it."""
+        try:
+            self.blob_client.upload_blob(data=b'', overwrite=False)
+        except ResourceExistsError:
+            pass
+        try:
+            self.lease = self.blob_client.acquire_lease(lease_duration=self.lease_seconds)
+        except HttpResponseError as ex:
+            logging.info(f'Run lease is held by another run: {ex}')
+            return None
+        metadata = self.blob_client.get_blob_properties(lease=self.lease).metadata or {}
+        self.fence = int(metadata.get('fence', 0)) + 1
+        self.blob_client.set_blob_metadata({'fence': str(self.fence)}, lease=self.lease)
+        return self.fence
+
+    def renew(self):
+        """Extend the lease; raises LeaseLost if another run took it over."""
+        try:
+            self.lease.renew()
+        except HttpResponseError as ex:
+            raise LeaseLost(f'Run lease {self.fence} lost') from ex
+
+    def release(self):
+        if self.lease is not None:
+            try:
+                self.lease.release()
+            except HttpResponseError as ex:
+                logging.info(f'Run lease {self.fence} already released: {ex}')
+            self.lease = None
+
+
+class FileLock:
+    """Local stand-in for BlobLeaseLock based on an exclusively created lock file."""
+
+    def __init__(self, path, lease_seconds=LEASE_SECONDS):
+        self.path = path
+        self.fence_path = f'{path}.fence'
+        self.lease_seconds = lease_seconds
+        self.fence = None
+
+    def _read(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write(self, flags):
+        fd = os.open(self.path, flags)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'fence': self.fence, 'expires': time.time() + self.lease_seconds}, f)
+
+    def acquire(self):
+        holder = self._read()
+        if holder is not None and holder['expires'] < time.time():
+            logging.info(f"Breaking expired run lock {holder['fence']}")
+            os.remove(self.path)
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            logging.info('Run lock is held by another run')
+            return None
+        os.close(fd)
+        try:
+            with open(self.fence_path, encoding='utf-8') as f:
+                self.fence = int(f.read() or 0) + 1
+        except FileNotFoundError:
+            self.fence = 1
+        with open(self.fence_path, 'w', encoding='utf-8') as f:
+            f.write(str(self.fence))
+        self._write(os.O_WRONLY | os.O_TRUNC)
+        return self.fence
+
+    def renew(self):
+        holder = self._read()
+        if holder is None or holder['fence'] != self.fence:
+            raise LeaseLost(f'Run lock {self.fence} lost')
+        self._write(os.O_WRONLY | os.O_TRUNC)
+
+    def release(self):
+        holder = self._read()
+        if holder is not None and holder['fence'] == self.fence:
+            os.remove(self.path)
+
+
+#### Idempotency keys
+class IdempotencyStore:
+    """Keys of published candidates, claimed with a fenced write before publishing."""
+
+    def __init__(self, document, ttl_hours=KEY_TTL_HOURS):
+        self.document = document
+        self.ttl = ttl_hours * 3600
+
+    def _load(self):
+        data = self.document.read()
+        keys = json.loads(data) if data else {}
+        now = time.time()
+        return {key: entry for key, entry in keys.items() if now - entry['ts'] <= self.ttl}
+
+    def _update(self, change):
+        for _ in range(MAX_CONFLICT_RETRIES):
+            keys = self._load()
+            result = change(keys)
+            try:
+                self.document.write(json.dumps(keys))
+                return result
+            except WriteConflict:
+                logging.info('Idempotency store changed concurrently, retrying')
+        raise WriteConflict('Idempotency store is busy')
+
+    def claim(self, key, owner):
+        """Claim a key; returns False if any run claimed it before."""
+        def change(keys):
+            if key in keys:
+                return False
+            keys[key] = {'status': 'claimed', 'owner': owner, 'ts': time.time()}
+            return True
+        return self._update(change)
+
+    def complete(self, key, status='published'):
+        def change(keys):
+            keys.setdefault(key, {'ts': time.time()})['status'] = status
+        self._update(change)
+
+    def release(self, key):
+        """Forget a claim whose publication failed, so that it can be retried."""
+        self._update(lambda keys: keys.pop(key, None))
+
+
+class RunCoordinator:
+    """Makes sure only one run at a time publishes and persists.
+
+    Stages such as a cascade of LLM requests can outlast the lease, so a
+    background thread renews it every RENEW_INTERVAL_SECONDS while the run
+    holds it. A lost lease is reported by the next checkpoint().
+    """
+
+    def __init__(self, lock, keys, renew_interval=RENEW_INTERVAL_SECONDS):
+        self.lock = lock
+        self.keys = keys
+        self.fence = None
+        self.renew_interval = renew_interval
+        self.renew_lock = threading.Lock()  # the lock files are rewritten on renewal, one writer at a time
+        self.stopped = threading.Event()
+        self.renewer = None
+        self.lost = None
+
+    def acquire(self):
+        self.fence = self.lock.acquire()
+        if self.fence is not None:
+            logging.info(f'Run lease acquired, fencing token {self.fence} at {dt.datetime.utcnow().isoformat()}')
+            self.stopped.clear()
+            self.lost = None
+            self.renewer = threading.Thread(target=self._renew_until_released, daemon=True,
+                                            name=f'lease-renewer-{self.fence}')
+            self.renewer.start()
+        return self.fence is not None
+
+    def _renew(self):
+        with self.renew_lock:
+            self.lock.renew()
+
+    def _renew_until_released(self):
+        while not self.stopped.wait(self.renew_interval):
+            try:
+                self._renew()
+            except LeaseLost as ex:
+                logging.error(f'{ex}, stopping renewals')
+                self.lost = ex
+                return
+            except Exception as ex:
+                # A failed request is retried on the next interval, the lease is still valid until it expires
+                logging.error(f'Run lease {self.fence} not renewed: {ex}')
+
+    def checkpoint(self):
+        """Verify that this run still holds the lease; call before every side effect and long stage."""
+        if self.lost is not None:
+            raise self.lost
+        self._renew()
+
+    def claim(self, title):
+        """Claim the right to publish a candidate; False if it was already published."""
+        self.checkpoint()
+        return self.keys.claim(idempotency_key(title), owner=self.fence)
+
+    def complete(self, title):
+        self.keys.complete(idempotency_key(title))
+
+    def release_claim(self, title):
+        self.keys.release(idempotency_key(title))
+
+    def release(self):
+        self.stopped.set()
+        if self.renewer is not None:
+            self.renewer.join()
+            self.renewer = None
+        self.lock.release()
+
+
+def document(blob_service_client, container, name):
+    """Fenced document for a blob, or a local file when the local stand-in is enabled."""
+    local_dir = os.environ.get(LOCAL_DIR_SETTING)
+    if local_dir:
+        return FileDocument(os.path.join(local_dir, name))
+    return BlobDocument(blob_service_client.get_blob_client(container=container, blob=name))
+
+
+def make_coordinator(blob_service_client, container, name):
+    """Coordinator for the run called `name`, backed by blob leases or local lock files."""
+    local_dir = os.environ.get(LOCAL_DIR_SETTING)
+    if local_dir:
+        os.makedirs(local_dir, exist_ok=True)
+        lock = FileLock(os.path.join(local_dir, f'{name}.lock'))
+    else:
+        lock = BlobLeaseLock(blob_service_client.get_blob_client(container=container, blob=f'{name}.lock'))
+    return RunCoordinator(lock, IdempotencyStore(document(blob_service_client, container, f'{name}_keys.json')))
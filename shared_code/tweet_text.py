@@ -0,0 +1,43 @@
+import re
+import unicodedata
+
+# Constants
+MAX_WEIGHTED_LENGTH = 280
+URL_LENGTH = 23  # every link is wrapped in t.co and counts as 23 characters
+# Code point ranges that count as one character, everything else (CJK, emoji, ...) counts as two
+LIGHT_RANGES = [(0, 4351), (8192, 8205), (8208, 8223), (8242, 8247)]
+URL_PATTERN = re.compile(r'https?://\S+', re.IGNORECASE)
+
+
+def char_weight(char):
+    code_point = ord(char)
+    return 1 if any(start <= code_point <= end for start, end in LIGHT_RANGES) else 2
+
+
+def weighted_length(text):
+    """Length of a tweet the way Twitter counts it (twitter-text v3 weighting)."""
+    text = unicodedata.normalize('NFC', text)
+    length = 0
+    position = 0
+    for match in URL_PATTERN.finditer(text):
+        length += sum(char_weight(c) for c in text[position:match.start()]) + URL_LENGTH
+        position = match.end()
+    return length + sum(char_weight(c) for c in text[position:])
+
+
+def validate_tweet(text):
+    """Return None if the tweet can be posted, otherwise the reason why not."""
+    if not isinstance(text, str) or not text.strip():
+        return 'empty tweet'
+    length = weighted_length(text)
+    if length > MAX_WEIGHTED_LENGTH:
+        return f'tweet too long: {length} > {MAX_WEIGHTED_LENGTH}'
+    return None
+
+
+def checked_tweet(text):
+    """Return the tweet if it can be posted, otherwise raise ValueError; as a router validator it escalates."""
+    reason = validate_tweet(text)
+    if reason:
+        raise ValueError(reason)
+    return text
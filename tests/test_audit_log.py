@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('azure.core')
+
+from shared_code.audit_log import AuditLog, LocalAuditBackend
+
+
+class MemoryDocument:
+    def __init__(self):
+        self.data = None
+
+    async def read(self):
+        return self.data
+
+    async def write(self, data):
+        self.data = data
+
+
+class AsyncMemoryBackend:
+    """Async backend that keeps the day blobs and the index in memory."""
+
+    def __init__(self):
+        self.days = {}
+        self.index = MemoryDocument()
+
+    async def append(self, day, data):
+        self.days[day] = self.days.get(day, b'') + data
+
+    async def read_index(self):
+        return {day: {} for day in self.days}
+
+    async def read_day(self, day):
+        return self.days.get(day, b'').decode('utf-8')
+
+
+def test_recent_returns_the_flushed_records(tmp_path):
+    audit_log = AuditLog(LocalAuditBackend(str(tmp_path)), 'test')
+    audit_log.record('1', 'first')
+    audit_log.record('2', 'second')
+    audit_log.flush()
+    assert [entry['tweet_id'] for entry in audit_log.recent()] == ['1', '2']
+    assert asyncio.run(audit_log.arecent()) == audit_log.recent()
+
+
+def test_arecent_reads_an_async_backend():
+    audit_log = AuditLog(AsyncMemoryBackend(), 'test')
+
+    async def publish():
+        audit_log.record('1', 'first', tokens=5)
+        await audit_log.aflush()
+        return await audit_log.arecent()
+
+    assert [(entry['tweet_id'], entry['tokens']) for entry in asyncio.run(publish())] == [('1', 5)]
+    with pytest.raises(TypeError):
+        audit_log.recent()
+
+
+class BrokenDocument:
+    async def read(self):
+        raise OSError('storage unavailable')
+
+    async def write(self, data):
+        raise OSError('storage unavailable')
+
+
+def test_a_failed_index_update_does_not_fail_the_flush():
+    backend = AsyncMemoryBackend()
+    backend.index = BrokenDocument()
+    audit_log = AuditLog(backend, 'test')
+    audit_log.record('1', 'first')
+    asyncio.run(audit_log.aflush())
+    assert list(backend.days.values())[0].count(b'\n') == 1
+    assert audit_log.buffer == []
@@ -0,0 +1,104 @@
+import asyncio
+import importlib
+import json
+import sys
+import types
+
+import pytest
+
+from benchmarks import fakes
+from shared_code import deadline
+
+
+@pytest.fixture(scope='module')
+def raw():
+    # The function app reads its Key Vault secrets on import, so it is loaded with the bench's stand-ins
+    before = dict(sys.modules)
+    fakes.install(fakes.Replay({'kinds': []}), fakes.FakeHttp())
+    try:
+        yield importlib.import_module('HttpCreateTwitterTweetRaw')
+    finally:
+        for name in set(sys.modules) - set(before):
+            del sys.modules[name]
+        sys.modules.update(before)
+
+
+@pytest.fixture(autouse=True)
+def unbounded_deadline():
+    token = deadline.current.set(None)
+    yield
+    deadline.current.reset(token)
+
+
+def scripted_poster(raw, monkeypatch, rate_limit_after=None):
+    """Replace create_tweet; the post after rate_limit_after successful ones gets a 429."""
+    posted = []
+
+    async def create_tweet(tweet):
+        await asyncio.sleep(0)
+        if rate_limit_after is not None and len(posted) >= rate_limit_after:
+            response = types.SimpleNamespace(headers={'x-rate-limit-reset': '1700000900'})
+            raise raw.tweepy.TooManyRequests(response)
+        posted.append(tweet)
+        return types.SimpleNamespace(data={'id': str(len(posted))})
+
+    monkeypatch.setattr(raw, 'create_tweet', create_tweet)
+    return posted
+
+
+def test_parse_a_json_array(raw):
+    assert raw.parse_tweets(json.dumps(['one', {'tweet': 'two'}])) == ['one', 'two']
+
+
+def test_parse_an_object_with_tweets(raw):
+    assert raw.parse_tweets(json.dumps({'tweets': ['one', {'tweet': 'two'}]})) == ['one', 'two']
+
+
+def test_parse_a_single_post(raw):
+    assert raw.parse_tweets(json.dumps({'tweet': 'one'})) == ['one']
+    assert raw.parse_tweets(json.dumps('one')) == ['one']
+
+
+def test_parse_ndjson(raw):
+    body = '\n'.join([json.dumps({'tweet': 'one'}), '', json.dumps('two'), json.dumps({'tweet': 'three'})]) + '\n'
+    assert raw.parse_tweets(body) == ['one', 'two', 'three']
+
+
+def test_parse_rejects_a_malformed_body(raw):
+    with pytest.raises(ValueError):
+        raw.parse_tweets('{"tweet": "one"}\nnot json')
+
+
+def test_invalid_posts_are_reported_without_being_posted(raw, monkeypatch):
+    posted = scripted_poster(raw, monkeypatch)
+    results = asyncio.run(raw.create_tweets(['fine', '', 'x' * 300, None, 'also fine']))
+    assert [r['status'] for r in results] == ['published', 'invalid', 'invalid', 'invalid', 'published']
+    assert sorted(posted) == ['also fine', 'fine']
+    assert results[0]['weighted_length'] == 4
+    assert all(r['error'] for r in results[1:4])
+
+
+def test_a_rate_limit_stops_the_remaining_posts(raw, monkeypatch):
+    posted = scripted_poster(raw, monkeypatch, rate_limit_after=2)
+    results = asyncio.run(raw.create_tweets([f'post {i}' for i in range(10)]))
+    statuses = [r['status'] for r in results]
+    assert statuses.count('published') == len(posted) == 2
+    assert statuses.count('rate_limited') == 8
+    # Posts already in flight get the 429 themselves, the rest are not attempted at all
+    retry_at = [r for r in results if r.get('retry_at')]
+    assert 1 <= len(retry_at) <= raw.MAX_CONCURRENT_POSTS
+    assert all(r['retry_at'] == '1700000900' for r in retry_at)
+    assert all(r['error'] == 'not attempted after a rate limit response' for r in results
+               if r['status'] == 'rate_limited' and 'retry_at' not in r)
+
+
+def test_other_errors_do_not_stop_the_batch(raw, monkeypatch):
+    async def create_tweet(tweet):
+        if tweet == 'bad':
+            raise RuntimeError('boom')
+        return types.SimpleNamespace(data={'id': tweet})
+
+    monkeypatch.setattr(raw, 'create_tweet', create_tweet)
+    results = asyncio.run(raw.create_tweets(['a', 'bad', 'b']))
+    assert [r['status'] for r in results] == ['published', 'error', 'published']
+    assert results[1]['error'] == 'boom'
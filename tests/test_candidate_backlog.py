@@ -0,0 +1,85 @@
+import random
+
+from shared_code.candidate_backlog import MAX_ATTEMPTS, CandidateBacklog
+
+HOUR = 3600
+NOW = 1_700_000_000
+
+
+def drain(backlog, now):
+    popped = []
+    while (candidate := backlog.pop(now)) is not None:
+        popped.append(candidate)
+    return popped
+
+
+def test_pop_order_matches_the_current_priority():
+    rng = random.Random(7)
+    backlog = CandidateBacklog()
+    for i in range(50):
+        backlog.push(f'story {i}', '', '', relevance=rng.random(), novelty=rng.randint(0, 4),
+                     now=NOW - rng.uniform(0, 20 * HOUR))
+    popped = drain(backlog, NOW)
+    priorities = [backlog.priority(c, NOW) for c in popped]
+    assert len(popped) == 50
+    assert priorities == sorted(priorities, reverse=True)
+
+
+def test_an_older_candidate_loses_to_a_fresher_one_of_equal_score():
+    backlog = CandidateBacklog()
+    backlog.push('old', '', '', relevance=0.8, now=NOW - 12 * HOUR)
+    backlog.push('fresh', '', '', relevance=0.8, now=NOW)
+    assert [c['title'] for c in drain(backlog, NOW)] == ['fresh', 'old']
+
+
+def test_order_survives_a_round_trip_through_json():
+    backlog = CandidateBacklog()
+    backlog.push('a', '', '', relevance=0.2, now=NOW)
+    backlog.push('b', '', '', relevance=0.9, novelty=2, now=NOW - HOUR)
+    backlog.push('c', '', '', relevance=0.5, now=NOW - 3 * HOUR)
+    restored = CandidateBacklog.from_json(backlog.to_json())
+    assert [c['title'] for c in drain(restored, NOW)] == [c['title'] for c in drain(backlog, NOW)]
+
+
+def test_pop_skips_expired_candidates():
+    backlog = CandidateBacklog(max_age_hours=24)
+    backlog.push('expired', '', '', relevance=1.0, now=NOW - 25 * HOUR)
+    backlog.push('current', '', '', relevance=0.1, now=NOW - HOUR)
+    assert backlog.pop(NOW)['title'] == 'current'
+    assert backlog.pop(NOW) is None
+
+
+def test_expire_drops_old_candidates_and_forgets_old_titles():
+    backlog = CandidateBacklog(max_age_hours=24, seen_ttl_hours=48)
+    backlog.push('expired', '', '', now=NOW - 25 * HOUR)
+    backlog.push('current', '', '', now=NOW - HOUR)
+    backlog.defer('stale pending', '', '', now=NOW - 30 * HOUR)
+    backlog.mark_seen('forgotten', now=NOW - 49 * HOUR)
+    backlog.expire(NOW)
+    assert [c['title'] for c in drain(backlog, NOW)] == ['current']
+    assert backlog.pending == []
+    assert backlog.is_known('Expired')
+    assert not backlog.is_known('forgotten')
+
+
+def test_retry_drops_a_candidate_after_max_attempts():
+    backlog = CandidateBacklog()
+    candidate = backlog.push('flaky', '', '', now=NOW)
+    for attempt in range(1, MAX_ATTEMPTS):
+        assert backlog.pop(NOW) is candidate
+        backlog.retry(candidate)
+        assert candidate['attempts'] == attempt
+        assert len(backlog) == 1
+    backlog.pop(NOW)
+    backlog.retry(candidate)
+    assert candidate['attempts'] == MAX_ATTEMPTS
+    assert len(backlog) == 0
+
+
+def test_requeue_does_not_count_an_attempt():
+    backlog = CandidateBacklog()
+    candidate = backlog.push('untried', '', '', now=NOW)
+    for _ in range(MAX_ATTEMPTS + 1):
+        backlog.requeue(backlog.pop(NOW))
+    assert candidate['attempts'] == 0
+    assert backlog.pop(NOW) is candidate
@@ -0,0 +1,103 @@
+import json
+
+import pytest
+
+pytest.importorskip('azure.core')
+
+from shared_code.draft_queue import DraftPipeline, LocalBatchExecutor, clean_tweet
+from shared_code.run_coordinator import FileDocument
+
+
+class RunningExecutor:
+    """Batch executor whose jobs never finish, counting the batches submitted."""
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, requests):
+        self.submitted.append(requests)
+        return f'batch-{len(self.submitted)}'
+
+    def collect(self, job_id):
+        return None
+
+
+class InterleavedDocument(FileDocument):
+    """FileDocument that lets another run go first when it is about to write the `at`-th time."""
+
+    def __init__(self, path, other_run, at=1):
+        super().__init__(path)
+        self.other_run = other_run
+        self.writes = 0
+        self.at = at
+
+    def write(self, data):
+        self.writes += 1
+        if self.writes == self.at:
+            self.other_run()
+        super().write(data)
+
+
+def touch(path):
+    """Another writer changing the queue state without touching its jobs or drafts."""
+    document = FileDocument(path)
+    state = json.loads(document.read())
+    state['touched'] = state.get('touched', 0) + 1
+    document.write(json.dumps(state))
+
+
+def pipeline(document, executor):
+    return DraftPipeline(document, executor, lambda old_terms, n: {'n': n}, lambda term: {'term': term})
+
+
+def test_concurrent_runs_submit_the_terms_batch_once(tmp_path):
+    path = str(tmp_path / 'drafts.json')
+    executor = RunningExecutor()
+    other = pipeline(FileDocument(path), executor)
+    first = pipeline(InterleavedDocument(path, lambda: other.next_draft([])), executor)
+    assert first.next_draft([]) is None
+    assert len(executor.submitted) == 1
+
+
+class Client:
+    """Chat client answering the term request with five terms and a tweet request with a tweet."""
+
+    def __init__(self):
+        self.chat = self
+        self.completions = self
+
+    def create(self, **body):
+        content = "['a', 'b', 'c', 'd', 'e']" if 'n' in body else f"Tweet about {body['term']}"
+        message = type('Message', (), {'content': content})
+        return type('Response', (), {'choices': [type('Choice', (), {'message': message})]})
+
+
+def test_local_executor_fills_the_queue_in_one_call(tmp_path):
+    drafts = pipeline(FileDocument(str(tmp_path / 'drafts.json')), LocalBatchExecutor(Client()))
+    draft = drafts.next_draft([])
+    assert (draft['term'], draft['tweet']) == ('a', 'Tweet about a')
+    assert drafts.next_draft(['a'])['term'] == 'b'
+
+
+def test_submitted_ids_are_recorded_after_a_conflict(tmp_path):
+    path = str(tmp_path / 'drafts.json')
+    executor = RunningExecutor()
+    # The second write records the batch id, another writer changes the state just before it
+    drafts = pipeline(InterleavedDocument(path, lambda: touch(path), at=2), executor)
+    assert drafts.next_draft([]) is None
+    jobs = json.loads(FileDocument(path).read())['jobs']
+    assert [job['id'] for job in jobs] == ['batch-1']
+    assert len(executor.submitted) == 1
+
+
+def test_collected_results_survive_a_conflict(tmp_path):
+    path = str(tmp_path / 'drafts.json')
+    # The third write stores the collected terms and plans their tweets
+    drafts = pipeline(InterleavedDocument(path, lambda: touch(path), at=3), LocalBatchExecutor(Client()))
+    draft = drafts.next_draft([])
+    assert draft['term'] == 'a'
+
+
+def test_drafts_are_validated_with_the_weighted_length():
+    assert clean_tweet('"' + 'a' * 280 + '"') == 'a' * 280
+    assert clean_tweet('漢' * 150) is None
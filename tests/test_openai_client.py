@@ -0,0 +1,129 @@
+import asyncio
+import json
+import math
+import types
+
+import pytest
+
+from shared_code import deadline
+from shared_code.openai_client import EscalationExhausted, ModelRouter, load_policies
+
+POLICIES = {'novelty': {'models': ['cheap', 'strong'], 'min_confidence': 0.6}}
+
+
+def response(content, confidence=None, tokens=10):
+    logprobs = None
+    if confidence is not None:
+        logprobs = types.SimpleNamespace(content=[types.SimpleNamespace(token='x', logprob=math.log(confidence))])
+    return types.SimpleNamespace(
+        choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=content), logprobs=logprobs)],
+        usage=types.SimpleNamespace(total_tokens=tokens))
+
+
+class ScriptedClient:
+    """Chat client that answers each model with the next scripted response."""
+
+    def __init__(self, answers):
+        self.answers = {model: list(responses) for model, responses in answers.items()}
+        self.requests = []
+        self.chat = types.SimpleNamespace(completions=self)
+
+    def create(self, **request):
+        self.requests.append(request)
+        return self.answers[request['model']].pop(0)
+
+
+class AsyncScriptedClient(ScriptedClient):
+    async def create(self, **request):
+        return ScriptedClient.create(self, **request)
+
+
+def number(answer):
+    return int(answer)
+
+
+@pytest.fixture(autouse=True)
+def unbounded_deadline():
+    token = deadline.current.set(None)
+    yield
+    deadline.current.reset(token)
+
+
+def test_confident_valid_answer_of_the_cheap_model_is_used():
+    client = ScriptedClient({'cheap': [response('1', 0.9)]})
+    router = ModelRouter(client, POLICIES)
+    assert router.complete('novelty', [], number, model='ignored') == 1
+    assert [r['model'] for r in client.requests] == ['cheap']
+    assert client.requests[0]['logprobs'] is True
+    assert router.stats['novelty']['escalated'] == 0
+
+
+def test_invalid_answer_is_escalated():
+    client = ScriptedClient({'cheap': [response('no number', 0.9)], 'strong': [response('4')]})
+    router = ModelRouter(client, POLICIES)
+    assert router.complete('novelty', [], number) == 4
+    assert 'logprobs' not in client.requests[1]
+    assert router.stats['novelty']['escalated.invalid'] == 1
+    assert router.stats['novelty']['escalated'] == 1
+
+
+def test_low_confidence_answer_is_escalated():
+    client = ScriptedClient({'cheap': [response('1', 0.3)], 'strong': [response('4')]})
+    router = ModelRouter(client, POLICIES)
+    assert router.complete('novelty', [], number) == 4
+    assert router.stats['novelty']['escalated.low_confidence'] == 1
+
+
+def test_low_confidence_answer_is_kept_when_the_last_model_is_invalid():
+    client = ScriptedClient({'cheap': [response('4', 0.3)], 'strong': [response('no number')]})
+    router = ModelRouter(client, POLICIES)
+    assert router.complete('novelty', [], number) == 4
+    assert router.stats['novelty']['failures'] == 0
+
+
+def test_no_valid_answer_raises_with_the_last_content():
+    client = ScriptedClient({'cheap': [response('a', 0.9)], 'strong': [response('b')]})
+    router = ModelRouter(client, POLICIES)
+    with pytest.raises(EscalationExhausted) as raised:
+        router.complete('novelty', [], number)
+    assert raised.value.content == 'b'
+    assert router.report()['novelty']['failure_rate'] == 1.0
+
+
+def test_low_confidence_answer_is_kept_without_time_to_escalate():
+    deadline.current.set(deadline.Deadline(5, reserve_seconds=0))
+    client = ScriptedClient({'cheap': [response('2', 0.3)]})
+    router = ModelRouter(client, POLICIES)
+    assert router.complete('novelty', [], number) == 2
+    assert router.stats['novelty']['escalation_skipped'] == 1
+    assert client.requests[0]['timeout'] <= 5
+
+
+def test_usage_adds_the_tokens_of_every_model_tried():
+    client = ScriptedClient({'cheap': [response('x', 0.9, tokens=7)], 'strong': [response('3', tokens=20)]})
+    usage = {}
+    ModelRouter(client, POLICIES).complete('novelty', [], number, usage=usage)
+    assert usage == {'tokens': 27}
+
+
+def test_acomplete_runs_the_same_cascade():
+    client = AsyncScriptedClient({'cheap': [response('4', 0.3)], 'strong': [response('no number')]})
+    router = ModelRouter(client, POLICIES)
+    assert asyncio.run(router.acomplete('novelty', [], number)) == 4
+    assert [r['model'] for r in client.requests] == ['cheap', 'strong']
+
+
+def test_policy_overrides_are_merged_from_the_app_setting(monkeypatch):
+    monkeypatch.setenv('OPENAI_ROUTING', json.dumps({'novelty': {'min_confidence': 0.9}, 'custom': {'models': ['m']}}))
+    policies = load_policies()
+    assert policies['novelty']['min_confidence'] == 0.9
+    assert policies['novelty']['models'] == ['gpt-4o-mini', 'gpt-4-1106-preview']
+    assert policies['custom'] == {'models': ['m']}
+
+
+def test_invalid_answer_without_time_to_escalate_raises_with_its_content():
+    deadline.current.set(deadline.Deadline(5, reserve_seconds=0))
+    client = ScriptedClient({'cheap': [response('no number', 0.9)]})
+    with pytest.raises(EscalationExhausted) as raised:
+        ModelRouter(client, POLICIES).complete('novelty', [], number)
+    assert raised.value.content == 'no number'
@@ -0,0 +1,89 @@
+import pytest
+
+pytest.importorskip('azure.core')
+
+from shared_code.poll_scheduler import (BACKOFF_FACTOR, INITIAL_INTERVAL_MINUTES, TICK_SLACK_SECONDS, PollScheduler,
+                                        seconds_until_midnight)
+
+MINUTE = 60
+HOUR = 3600
+MIDNIGHT = 1_700_006_400  # 2023-11-15 00:00 UTC
+
+
+def scheduler(polls_per_day=48):
+    return PollScheduler(None, polls_per_day=polls_per_day)
+
+
+def new_state():
+    return {'sources': {}, 'work_due': None}
+
+
+def test_seconds_until_midnight():
+    assert seconds_until_midnight(MIDNIGHT - 90) == 90
+    assert seconds_until_midnight(MIDNIGHT) == 24 * HOUR
+
+
+def test_polls_without_new_results_back_off_up_to_the_maximum():
+    polls, state = PollScheduler(None, polls_per_day=48, max_interval_minutes=480), new_state()
+    now = MIDNIGHT + HOUR
+    polls.observe(state, 'bing', ['a'], now)
+    intervals = []
+    for _ in range(4):
+        now = state['sources']['bing']['next_poll']
+        assert polls.observe(state, 'bing', ['a'], now) == []
+        intervals.append(state['sources']['bing']['interval'])
+    initial = INITIAL_INTERVAL_MINUTES * MINUTE
+    assert intervals == [initial * BACKOFF_FACTOR, initial * BACKOFF_FACTOR ** 2, 480 * MINUTE, 480 * MINUTE]
+
+
+def test_a_burst_of_new_results_polls_on_the_next_tick():
+    polls, state = scheduler(), new_state()
+    now = MIDNIGHT + HOUR
+    polls.observe(state, 'bing', ['a'], now)
+    now += polls.max_interval
+    assert polls.observe(state, 'bing', ['a', 'b', 'c', 'd'], now) == ['b', 'c', 'd']
+    assert state['sources']['bing']['interval'] == polls.min_interval
+    assert state['sources']['bing']['next_poll'] == now + polls.min_interval
+
+
+def test_a_sudden_rise_of_the_arrival_rate_is_a_burst():
+    polls, state = scheduler(), new_state()
+    now = MIDNIGHT + HOUR
+    for i in range(3):
+        polls.observe(state, 'bing', [str(i)], now + i * 2 * HOUR)
+    assert state['sources']['bing']['interval'] == polls.max_interval
+    # Two new results are not a burst by count, but arrive far faster than before
+    polls.observe(state, 'bing', ['3', '4'], now + 4 * HOUR + 10 * MINUTE)
+    assert state['sources']['bing']['interval'] == polls.min_interval
+
+
+def test_only_due_sources_are_polled():
+    polls, state = scheduler(), new_state()
+    now = MIDNIGHT + HOUR
+    assert polls.due(state, ['bing', 'hn'], now) == ['bing', 'hn']
+    polls.observe(state, 'bing', ['a'], now)
+    next_poll = state['sources']['bing']['next_poll']
+    assert polls.due(state, ['bing', 'hn'], next_poll - TICK_SLACK_SECONDS - 1) == ['hn']
+    assert polls.due(state, ['bing', 'hn'], next_poll - TICK_SLACK_SECONDS) == ['bing', 'hn']
+
+
+def test_a_burst_near_midnight_keeps_the_budget_for_the_rest_of_the_day():
+    polls, state = scheduler(polls_per_day=10), new_state()
+    now = MIDNIGHT - 4 * HOUR
+    polls.observe(state, 'bing', ['a'], now)
+    state['sources']['bing']['polls_today'] = 8
+    polls.observe(state, 'bing', ['b', 'c', 'd', 'a'], now + MINUTE)
+    # One poll is left for the last four hours, so the burst does not spend it early
+    assert state['sources']['bing']['interval'] == polls.min_interval
+    assert state['sources']['bing']['next_poll'] == MIDNIGHT
+
+
+def test_a_spent_budget_waits_for_midnight_and_then_resets():
+    polls, state = scheduler(polls_per_day=3), new_state()
+    now = MIDNIGHT - 30 * MINUTE
+    for i in range(3):
+        polls.observe(state, 'bing', [str(i)], now + i * MINUTE)
+    assert state['sources']['bing']['next_poll'] == MIDNIGHT
+    assert polls.due(state, ['bing'], MIDNIGHT - TICK_SLACK_SECONDS - 1) == []
+    assert polls.due(state, ['bing'], MIDNIGHT) == ['bing']
+    assert polls.polls_left(state['sources']['bing'], MIDNIGHT) == 3
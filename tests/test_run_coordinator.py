@@ -0,0 +1,41 @@
+import os
+import time
+
+import pytest
+
+pytest.importorskip('azure.core')
+
+from shared_code.run_coordinator import FileDocument, FileLock, IdempotencyStore, LeaseLost, RunCoordinator
+
+
+def coordinator(tmp_path, lease_seconds=1, renew_interval=0.1):
+    lock = FileLock(str(tmp_path / 'run.lock'), lease_seconds=lease_seconds)
+    return RunCoordinator(lock, IdempotencyStore(FileDocument(str(tmp_path / 'keys.json'))),
+                          renew_interval=renew_interval)
+
+
+def test_lease_is_renewed_in_the_background_during_a_long_stage(tmp_path):
+    run = coordinator(tmp_path)
+    assert run.acquire()
+    try:
+        time.sleep(1.5)
+        assert not coordinator(tmp_path).acquire()
+        run.checkpoint()
+    finally:
+        run.release()
+    assert not os.path.exists(tmp_path / 'run.lock')
+
+
+def test_checkpoint_reports_a_lease_lost_between_renewals(tmp_path):
+    run = coordinator(tmp_path)
+    assert run.acquire()
+    try:
+        os.remove(tmp_path / 'run.lock')
+        other = coordinator(tmp_path)
+        assert other.acquire()
+        time.sleep(0.3)
+        with pytest.raises(LeaseLost):
+            run.checkpoint()
+        other.release()
+    finally:
+        run.release()
@@ -0,0 +1,24 @@
+import pytest
+
+from shared_code.tweet_text import checked_tweet, validate_tweet, weighted_length
+
+
+def test_links_count_as_23_characters():
+    assert weighted_length('Read https://example.com/a/very/long/path/to/an/article') == 5 + 23
+
+
+def test_cjk_and_emoji_count_double():
+    assert weighted_length('漢字') == 4
+    assert weighted_length('🙂') == 2
+
+
+def test_validate_tweet_gives_the_reason():
+    assert validate_tweet('a' * 280) is None
+    assert validate_tweet('a' * 281) == 'tweet too long: 281 > 280'
+    assert validate_tweet('  ') == 'empty tweet'
+
+
+def test_checked_tweet_raises_for_the_router_to_escalate():
+    assert checked_tweet('fine') == 'fine'
+    with pytest.raises(ValueError, match='too long'):
+        checked_tweet('漢' * 141)